@@ -0,0 +1,5 @@
+"""
+Benchmarks for pystgres, over seeded synthetic datasets.
+
+Run them from the repository root with `python -m benchmarks`.
+"""
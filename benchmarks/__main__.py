@@ -0,0 +1,99 @@
+"""
+Run the benchmarks, or compare two sets of results.
+
+    python -m benchmarks run --rows 1000,100000 --output results.json
+    python -m benchmarks run --baseline baseline.json
+    python -m benchmarks compare baseline.json results.json
+"""
+import argparse
+import json
+import sys
+
+from benchmarks import runner
+from benchmarks import workloads
+
+
+def _print_comparisons(comparisons, file):
+    for workload, rows, old_seconds, new_seconds, verdict in comparisons:
+        ratio = new_seconds / old_seconds if old_seconds else float('inf')
+        print(
+            f"{workload:<20} {rows:>9} rows  {old_seconds:10.4f}s -> {new_seconds:10.4f}s"
+            f"  {ratio:6.2f}x  {verdict}",
+            file=file,
+        )
+    return sum(verdict in ('regression', 'changed') for *_, verdict in comparisons)
+
+
+def _load(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def _sizes(value):
+    try:
+        return [int(size) for size in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected comma-separated row counts, got {value!r}") from None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="run the benchmarks")
+    run_parser.add_argument(
+        "--rows",
+        type=_sizes,
+        default=runner.DEFAULT_ROWS,
+        help="comma-separated dataset sizes (default: %(default)s)",
+    )
+    run_parser.add_argument(
+        "--only",
+        type=lambda value: set(value.split(',')),
+        help="comma-separated workloads to run, out of: "
+        + ', '.join(workload.name for workload in workloads.WORKLOADS),
+    )
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--output", help="write the results to this JSON file")
+    run_parser.add_argument("--baseline", help="compare the results against this JSON file")
+    run_parser.add_argument("--threshold", type=float, default=runner.DEFAULT_THRESHOLD)
+
+    compare_parser = subparsers.add_parser('compare', help="compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=runner.DEFAULT_THRESHOLD)
+
+    args = parser.parse_args(argv)
+    if args.command == 'compare':
+        baseline, current = _load(args.baseline), _load(args.current)
+    else:
+        unknown = (args.only or set()) - {workload.name for workload in workloads.WORKLOADS}
+        if unknown:
+            parser.error(f"unknown workloads: {', '.join(sorted(unknown))}")
+        current = runner.run_benchmarks(
+            args.rows,
+            names=args.only,
+            repeat=args.repeat,
+            seed=args.seed,
+            log=lambda line: print(line, file=sys.stderr),
+        )
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(current, file, indent=2)
+                file.write('\n')
+        else:
+            json.dump(current, sys.stdout, indent=2)
+            print()
+        if not args.baseline:
+            return 0
+        baseline = _load(args.baseline)
+
+    # Out of the way of the results, if they went to stdout.
+    report_file = sys.stderr if args.command == 'run' and not args.output else sys.stdout
+    failures = _print_comparisons(runner.compare(baseline, current, threshold=args.threshold), report_file)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
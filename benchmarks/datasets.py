@@ -0,0 +1,99 @@
+"""
+Seeded synthetic datasets: the same seed and size always give the same rows.
+"""
+import io
+import random
+
+import attr
+
+import pystgres
+
+# Few enough that nested loop joins against them stay affordable.
+CUSTOMER_COUNT = 20
+REGIONS = ['north', 'south', 'east', 'west']
+STATUSES = ['pending', 'shipped', 'delivered', 'returned']
+ADJECTIVES = ['red', 'blue', 'green', 'large', 'small', 'fragile', 'heavy', 'spare']
+NOUNS = ['widget', 'gadget', 'bolt', 'crate', 'lamp', 'cable', 'panel', 'valve']
+
+# Orders reference customers 1-15, which exist, and 21-25, which don't, so
+# outer joins have unmatched rows on both sides.
+_ORDER_CUSTOMER_IDS = [*range(1, 16), *range(21, 26)]
+
+ORDERS_DDL = """
+    CREATE TABLE orders (
+        id BIGINT,
+        customer_id BIGINT,
+        amount INTEGER,
+        status TEXT,
+        note TEXT
+    );
+"""
+CUSTOMERS_DDL = """
+    CREATE TABLE customers (
+        id BIGINT,
+        name TEXT,
+        region TEXT
+    );
+"""
+
+
+@attr.s(frozen=True, slots=True)
+class Dataset:
+    """
+    Generated rows, and a database loaded with them.
+    """
+    size = attr.ib()
+    seed = attr.ib()
+    # (id, customer_id, amount, status, note) tuples.
+    orders = attr.ib(repr=False)
+    # (id, name, region) tuples.
+    customers = attr.ib(repr=False)
+    db = attr.ib(repr=False)
+
+    def orders_copy_text(self):
+        """
+        The orders, in COPY's text format.
+        """
+        return _copy_text(self.orders)
+
+
+def _copy_text(rows):
+    return ''.join('\t'.join(map(str, row)) + '\n' for row in rows)
+
+
+def generate_orders(size, rng):
+    return [
+        (
+            order_id,
+            rng.choice(_ORDER_CUSTOMER_IDS),
+            rng.randint(1, 1000),
+            rng.choice(STATUSES),
+            f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} #{rng.randint(1, 9999)}",
+        )
+        for order_id in range(1, size + 1)
+    ]
+
+
+def generate_customers(rng):
+    return [
+        (customer_id, f"customer {customer_id}", rng.choice(REGIONS))
+        for customer_id in range(1, CUSTOMER_COUNT + 1)
+    ]
+
+
+def load(db, table_ddl, relname, rows):
+    db.execute_one(table_ddl)
+    db.copy_expert(f"COPY {relname} FROM STDIN;", io.StringIO(_copy_text(rows)))
+
+
+def build(size, seed=0):
+    """
+    Generate a dataset of `size` orders, and load it into a new MockDatabase.
+    """
+    rng = random.Random(f"{seed}:{size}")
+    customers = generate_customers(rng)
+    orders = generate_orders(size, rng)
+    db = pystgres.MockDatabase()
+    load(db, CUSTOMERS_DDL, 'customers', customers)
+    load(db, ORDERS_DDL, 'orders', orders)
+    return Dataset(size=size, seed=seed, orders=orders, customers=customers, db=db)
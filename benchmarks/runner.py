@@ -0,0 +1,99 @@
+"""
+Timing workloads, and comparing the results of two runs.
+"""
+import datetime
+import gc
+import platform
+import statistics
+import time
+
+from benchmarks import datasets
+from benchmarks import workloads
+
+DEFAULT_ROWS = (1000, 100000, 1000000)
+# How much slower than the baseline counts as a regression.
+DEFAULT_THRESHOLD = 0.25
+# Differences below this are noise, however large they are relatively.
+MIN_SIGNIFICANT_SECONDS = 0.005
+RESULTS_VERSION = 1
+
+
+def run_benchmarks(sizes, *, names=None, repeat=3, seed=0, log=None):
+    """
+    Time each workload against a dataset of each size.
+
+    Returns the results as a JSON-serializable dict.
+    """
+    selected = [
+        workload for workload in workloads.WORKLOADS
+        if names is None or workload.name in names
+    ]
+    results = []
+    for size in sizes:
+        runnable = [workload for workload in selected if workload.runs_at(size)]
+        if not runnable:
+            continue
+        dataset = datasets.build(size, seed)
+        for workload in runnable:
+            times = []
+            for _ in range(repeat):
+                fn = workload.setup(dataset)
+                gc.collect()
+                start = time.perf_counter()
+                result_rows = fn()
+                times.append(time.perf_counter() - start)
+            result = {
+                'workload': workload.name,
+                'rows': size,
+                'result_rows': result_rows,
+                'times': times,
+                'min': min(times),
+                'median': statistics.median(times),
+            }
+            results.append(result)
+            if log is not None:
+                log(f"{workload.name:<20} {size:>9} rows  {result['min']:10.4f}s")
+    return {
+        'version': RESULTS_VERSION,
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+        },
+        'seed': seed,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(baseline, current, *, threshold=DEFAULT_THRESHOLD):
+    """
+    Match up two sets of results by workload and dataset size.
+
+    Returns (workload, rows, baseline seconds, current seconds, verdict) for
+    each pair, where the verdict is 'regression', 'improvement', 'ok', or
+    'changed' if the two runs produced different numbers of rows.
+    """
+    baseline_results = {
+        (result['workload'], result['rows']): result for result in baseline['results']
+    }
+    comparisons = []
+    for result in current['results']:
+        key = (result['workload'], result['rows'])
+        old = baseline_results.get(key)
+        if old is None:
+            continue
+        old_seconds, new_seconds = old['min'], result['min']
+        if old['result_rows'] != result['result_rows']:
+            verdict = 'changed'
+        elif abs(new_seconds - old_seconds) < MIN_SIGNIFICANT_SECONDS:
+            verdict = 'ok'
+        elif new_seconds > old_seconds * (1 + threshold):
+            verdict = 'regression'
+        elif new_seconds < old_seconds / (1 + threshold):
+            verdict = 'improvement'
+        else:
+            verdict = 'ok'
+        comparisons.append((*key, old_seconds, new_seconds, verdict))
+    return comparisons
@@ -0,0 +1,176 @@
+"""
+The workloads benchmarked, each against a Dataset.
+
+A workload's `setup` does any preparation that shouldn't be timed, and returns
+the function to time. That function returns how many rows it produced or
+wrote, which is recorded alongside the timings so a change in results shows up
+next to a change in speed.
+"""
+import io
+
+import attr
+import psqlparse
+
+import pystgres
+from benchmarks import datasets
+
+
+@attr.s(frozen=True, slots=True)
+class Workload:
+    name = attr.ib()
+    setup = attr.ib()
+    description = attr.ib()
+    # Largest dataset the workload runs against, for ones that don't scale linearly.
+    max_rows = attr.ib(default=None)
+
+    def runs_at(self, size):
+        return self.max_rows is None or size <= self.max_rows
+
+
+def _empty_orders_db():
+    db = pystgres.MockDatabase()
+    db.execute_one(datasets.ORDERS_DDL)
+    return db
+
+
+def _insert_executemany(dataset):
+    db = _empty_orders_db()
+
+    def run():
+        db.executemany(
+            "INSERT INTO orders (id, customer_id, amount, status, note) VALUES ($1, $2, $3, $4, $5);",
+            dataset.orders,
+        )
+        return dataset.size
+    return run
+
+
+def _copy_from(dataset):
+    db = _empty_orders_db()
+    text = dataset.orders_copy_text()
+
+    def run():
+        return db.copy_expert("COPY orders FROM STDIN;", io.StringIO(text))
+    return run
+
+
+def _query(query):
+    def setup(dataset):
+        db = dataset.db.session()
+        statement = db.prepare(query)
+        return lambda: len(statement.execute().rows)
+    return setup
+
+
+def _parse(dataset):
+    queries = [
+        f"SELECT o.id, o.amount, c.name FROM orders o JOIN customers c ON o.customer_id = c.id "
+        f"WHERE o.amount > {number % 1000} AND o.status = 'shipped' ORDER BY o.amount DESC LIMIT {number};"
+        for number in range(dataset.size)
+    ]
+
+    def run():
+        for query in queries:
+            psqlparse.parse(query)
+        return len(queries)
+    return run
+
+
+def _parse_and_execute(dataset):
+    db = dataset.db.session()
+    queries = [
+        f"SELECT name, region FROM customers WHERE id = {number % datasets.CUSTOMER_COUNT + 1};"
+        for number in range(dataset.size)
+    ]
+
+    def run():
+        return sum(len(db.execute_one(query).rows) for query in queries)
+    return run
+
+
+_JOIN_QUERY = "SELECT o.id, c.name FROM orders o {} customers c ON o.customer_id = c.id;"
+# Cross joins are nested loops, so they cost the product of both sides.
+_CROSS_JOIN_MAX_ROWS = 100000
+
+WORKLOADS = [
+    Workload(
+        name='insert_executemany',
+        setup=_insert_executemany,
+        description="INSERT ... VALUES of every order through executemany",
+    ),
+    Workload(
+        name='copy_from',
+        setup=_copy_from,
+        description="COPY FROM of every order",
+    ),
+    Workload(
+        name='scan',
+        setup=_query("SELECT id, amount FROM orders;"),
+        description="full scan, no filter",
+    ),
+    Workload(
+        name='scan_filter',
+        setup=_query("SELECT id, amount FROM orders WHERE amount > 500 AND status = 'shipped';"),
+        description="full scan with a selective filter",
+    ),
+    Workload(
+        name='like_filter',
+        setup=_query("SELECT id FROM orders WHERE note LIKE '%blue%';"),
+        description="LIKE with a leading wildcard",
+    ),
+    Workload(
+        name='like_prefix',
+        setup=_query("SELECT id FROM orders WHERE note LIKE 'red w%';"),
+        description="LIKE with a prefix pattern",
+    ),
+    Workload(
+        name='order_by',
+        setup=_query("SELECT id, amount FROM orders ORDER BY amount DESC, id;"),
+        description="sort on two keys",
+    ),
+    Workload(
+        name='join_inner',
+        setup=_query(_JOIN_QUERY.format("JOIN")),
+        description="inner join of orders to customers",
+    ),
+    Workload(
+        name='join_left',
+        setup=_query(_JOIN_QUERY.format("LEFT JOIN")),
+        description="left join of orders to customers",
+    ),
+    Workload(
+        name='join_right',
+        setup=_query(_JOIN_QUERY.format("RIGHT JOIN")),
+        description="right join of orders to customers",
+    ),
+    Workload(
+        name='join_full',
+        setup=_query(_JOIN_QUERY.format("FULL JOIN")),
+        description="full join of orders to customers",
+    ),
+    Workload(
+        name='join_cross',
+        setup=_query("SELECT o.id, c.id FROM orders o CROSS JOIN customers c WHERE c.id < 3;"),
+        description="cross join, filtered afterwards",
+        max_rows=_CROSS_JOIN_MAX_ROWS,
+    ),
+    Workload(
+        name='subquery_columns',
+        setup=_query(
+            "SELECT s.id FROM (SELECT id, amount * 2 AS doubled, note LIKE '%blue%' AS blue FROM orders) s;"
+        ),
+        description="subquery in FROM whose other outputs nothing reads",
+    ),
+    Workload(
+        name='parse',
+        setup=_parse,
+        description="parse one distinct statement per row",
+        max_rows=100000,
+    ),
+    Workload(
+        name='parse_execute',
+        setup=_parse_and_execute,
+        description="parse, plan and run one distinct point query per row",
+        max_rows=100000,
+    ),
+]
@@ -0,0 +1,427 @@
+"""
+In-process DB-API 2.0 (PEP 249) driver for pystgres.
+
+Connections sit directly on a MockDatabase: no sockets, no protocol encoding.
+"""
+import collections.abc
+import datetime
+import functools
+import re
+
+import psqlparse
+
+import exc
+import pystgres
+
+apilevel = '2.0'
+threadsafety = 1
+paramstyle = 'pyformat'
+PARAMSTYLES = ('pyformat', 'numeric')
+
+# How many statements each connection keeps parsed, keyed on their text.
+STATEMENT_CACHE_SIZE = 256
+
+
+class Warning(Exception):  # pylint: disable=redefined-builtin
+    pass
+
+
+class Error(Exception):
+    pgcode = None
+
+
+class InterfaceError(Error):
+    pass
+
+
+class DatabaseError(Error):
+    pass
+
+
+class DataError(DatabaseError):
+    pass
+
+
+class OperationalError(DatabaseError):
+    pass
+
+
+class IntegrityError(DatabaseError):
+    pass
+
+
+class InternalError(DatabaseError):
+    pass
+
+
+class ProgrammingError(DatabaseError):
+    pass
+
+
+class NotSupportedError(DatabaseError):
+    pass
+
+
+# DB-API exception for each SQLSTATE class.
+_ERROR_CLASSES = {
+    '0A': NotSupportedError,
+    '21': ProgrammingError,
+    '22': DataError,
+    '23': IntegrityError,
+    '25': OperationalError,
+    '26': ProgrammingError,
+    '34': ProgrammingError,
+    '40': OperationalError,
+    '42': ProgrammingError,
+    '55': OperationalError,
+    '57': OperationalError,
+}
+
+
+def _translate_error(error):
+    if isinstance(error, exc.PostgresError):
+        code = getattr(error, 'error_code', None)
+        error_cls = _ERROR_CLASSES.get(code and code[:2], DatabaseError)
+    elif isinstance(error, psqlparse.exceptions.PSqlParseError):
+        code = exc.PostgresSyntaxError.error_code
+        error_cls = ProgrammingError
+    elif isinstance(error, NotImplementedError):
+        code = exc.FeatureNotSupportedError.error_code
+        error_cls = NotSupportedError
+    else:
+        return error
+    translated = error_cls(str(error))
+    translated.pgcode = code
+    return translated
+
+
+class DBAPITypeObject:
+    def __init__(self, *type_names):
+        self._type_names = frozenset(type_names)
+
+    def __eq__(self, other):
+        return other in self._type_names
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._type_names)
+
+
+STRING = DBAPITypeObject('text', 'character varying')
+BINARY = DBAPITypeObject('bytea')
+NUMBER = DBAPITypeObject('smallint', 'integer', 'bigint', 'real', 'double precision', 'numeric')
+DATETIME = DBAPITypeObject('date', 'time', 'timestamp')
+ROWID = DBAPITypeObject('oid')
+
+Date = datetime.date
+Time = datetime.time
+Timestamp = datetime.datetime
+Binary = bytes
+
+
+def DateFromTicks(ticks):  # pylint: disable=invalid-name
+    return Date.fromtimestamp(ticks)
+
+
+def TimeFromTicks(ticks):  # pylint: disable=invalid-name
+    return Timestamp.fromtimestamp(ticks).time()
+
+
+def TimestampFromTicks(ticks):  # pylint: disable=invalid-name
+    return Timestamp.fromtimestamp(ticks)
+
+
+_PYTHON_TYPE_NAMES = [
+    (bool, 'boolean'),
+    (int, 'bigint'),
+    (float, 'double precision'),
+    (str, 'text'),
+]
+
+
+def _type_code(pgtype, rows, column):
+    if pgtype is not None and pgtype.name is not None:
+        return pgtype.name
+    for row in rows:
+        value = row[column]
+        if value is not None:
+            for python_type, type_name in _PYTHON_TYPE_NAMES:
+                if isinstance(value, python_type):
+                    return type_name
+            break
+    return None
+
+
+# Skip over literals, quoted identifiers and comments, so placeholders inside
+# them are left alone.
+_SQL_TOKEN_RE = re.compile(r"""
+    '(?:[^']|'')*'
+    | "(?:[^"]|"")*"
+    | --[^\n]*
+    | /\*.*?\*/
+    | ::
+    | %%
+    | %\((?P<name>[^)]+)\)s
+    | (?P<positional>%s)
+    | :(?P<number>\d+)
+""", re.VERBOSE | re.DOTALL)
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _to_dollar_params(operation, style):
+    """
+    Rewrite an operation's placeholders to `$n` parameters.
+
+    Returns the new operation and the names of its parameters in `$n` order:
+    None for `numeric` and positional `pyformat`.
+    """
+    names = []
+    positional = [0]
+
+    def replace(match):
+        token = match.group(0)
+        if style == 'pyformat':
+            if token == '%%':
+                return '%'
+            if match.group('name'):
+                name = match.group('name')
+                if name not in names:
+                    names.append(name)
+                return f"${names.index(name) + 1}"
+            if match.group('positional'):
+                positional[0] += 1
+                return f"${positional[0]}"
+        elif style == 'numeric' and match.group('number'):
+            return f"${match.group('number')}"
+        return token
+
+    operation = _SQL_TOKEN_RE.sub(replace, operation)
+    if names and positional[0]:
+        raise ProgrammingError("can't mix named and positional parameters")
+    return operation, tuple(names) if names else None
+
+
+def _bind(names, parameters):
+    if parameters is None:
+        return ()
+    if names is None:
+        if isinstance(parameters, collections.abc.Mapping):
+            raise ProgrammingError("named parameters need %(name)s placeholders")
+        return tuple(parameters)
+    if not isinstance(parameters, collections.abc.Mapping):
+        raise ProgrammingError("%(name)s placeholders need a mapping of parameters")
+    try:
+        return tuple(parameters[name] for name in names)
+    except KeyError as error:
+        raise ProgrammingError(f"missing parameter {error.args[0]!r}") from None
+
+
+def connect(db=None, *, paramstyle=paramstyle, autocommit=False):  # pylint: disable=redefined-outer-name
+    """
+    Open a connection to `db`, or to a new, empty MockDatabase.
+
+    Each connection runs its transactions in a session of its own.
+    """
+    if paramstyle not in PARAMSTYLES:
+        raise InterfaceError(f"unsupported paramstyle {paramstyle!r}")
+    return Connection(
+        pystgres.MockDatabase() if db is None else db.session(),
+        paramstyle=paramstyle,
+        autocommit=autocommit,
+    )
+
+
+class Connection:
+    Error = Error
+    Warning = Warning
+    InterfaceError = InterfaceError
+    DatabaseError = DatabaseError
+    DataError = DataError
+    OperationalError = OperationalError
+    IntegrityError = IntegrityError
+    InternalError = InternalError
+    ProgrammingError = ProgrammingError
+    NotSupportedError = NotSupportedError
+
+    def __init__(self, db, *, paramstyle, autocommit):  # pylint: disable=redefined-outer-name
+        self.db = db
+        self.paramstyle = paramstyle
+        self.autocommit = autocommit
+        self._closed = False
+        self._statements = collections.OrderedDict()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def _check_open(self):
+        if self._closed:
+            raise InterfaceError("connection already closed")
+
+    def cursor(self):
+        self._check_open()
+        return Cursor(self)
+
+    def commit(self):
+        self._check_open()
+        try:
+            self.db.commit()
+        except exc.PostgresError as error:
+            raise _translate_error(error) from error
+
+    def rollback(self):
+        self._check_open()
+        self.db.rollback()
+
+    def close(self):
+        if self._closed:
+            return
+        self.rollback()
+        self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def _prepare(self, operation):
+        """
+        Parse an operation into prepared statements, reusing recent parses.
+        """
+        key = (operation, self.paramstyle)
+        cached = self._statements.get(key)
+        if cached is not None:
+            self._statements.move_to_end(key)
+            return cached
+        query, names = _to_dollar_params(operation, self.paramstyle)
+        try:
+            statements = self.db.prepare_all(query)
+        except Exception as error:
+            raise _translate_error(error) from error
+        cached = self._statements[key] = (statements, names)
+        if len(self._statements) > STATEMENT_CACHE_SIZE:
+            self._statements.popitem(last=False)
+        return cached
+
+    def _begin(self):
+        if not self.autocommit:
+            self.db.begin()
+
+
+class Cursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.arraysize = 1
+        self.lastrowid = None
+        self._closed = False
+        self._reset()
+
+    def _reset(self):
+        self.description = None
+        self.rowcount = -1
+        self._rows = None
+        self._position = 0
+
+    def _check_open(self):
+        if self._closed:
+            raise InterfaceError("cursor already closed")
+        self.connection._check_open()
+
+    def close(self):
+        self._closed = True
+        self._rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def execute(self, operation, parameters=None):
+        self._check_open()
+        self._reset()
+        statements, names = self.connection._prepare(operation)
+        params = _bind(names, parameters)
+        self.connection._begin()
+        result = None
+        try:
+            for prepared in statements:
+                result = prepared.execute(params)
+        except Exception as error:
+            raise _translate_error(error) from error
+        self._set_result(result)
+        return self
+
+    def executemany(self, operation, seq_of_parameters):
+        self._check_open()
+        self._reset()
+        statements, names = self.connection._prepare(operation)
+        if len(statements) != 1:
+            raise ProgrammingError("executemany takes a single statement")
+        prepared, = statements
+        self.connection._begin()
+        try:
+            result = prepared.executemany(
+                [_bind(names, parameters) for parameters in seq_of_parameters]
+            )
+        except Exception as error:
+            raise _translate_error(error) from error
+        if result is not None:
+            self.rowcount = result.rowcount
+
+    def _set_result(self, result):
+        if result is None:
+            return
+        self.rowcount = result.rowcount
+        if isinstance(result, pystgres.ResultSet):
+            row_types = result.row_types or [None] * len(result.row_names)
+            self.description = [
+                (name, _type_code(pgtype, result.rows, column), None, None, None, None, None)
+                for column, (name, pgtype) in enumerate(zip(result.row_names, row_types))
+            ]
+            self._rows = result.rows
+
+    def _check_result(self):
+        self._check_open()
+        if self._rows is None:
+            raise ProgrammingError("no results to fetch")
+
+    def fetchone(self):
+        self._check_result()
+        if self._position >= len(self._rows):
+            return None
+        row = self._rows[self._position]
+        self._position += 1
+        return row
+
+    def fetchmany(self, size=None):
+        self._check_result()
+        if size is None:
+            size = self.arraysize
+        rows = self._rows[self._position:self._position + size]
+        self._position += len(rows)
+        return rows
+
+    def fetchall(self):
+        self._check_result()
+        rows = self._rows[self._position:]
+        self._position = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def callproc(self, procname, parameters=None):
+        raise NotSupportedError("stored procedures are not supported")
+
+    def setinputsizes(self, sizes):
+        pass
+
+    def setoutputsize(self, size, column=None):
+        pass
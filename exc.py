@@ -72,3 +72,95 @@ class UndefinedObjectError(PostgresError):
 
 class InvalidTextRepresentationError(PostgresError):
     error_code = '22P02'
+
+
+class InvalidParameterValueError(PostgresError):
+    error_code = '22023'
+
+
+class FeatureNotSupportedError(PostgresError):
+    error_code = '0A000'
+
+
+class BadCopyFileFormatError(PostgresError):
+    error_code = '22P04'
+
+
+class DuplicateColumnError(PostgresError):
+    error_code = '42701'
+
+
+class UndefinedParameterError(PostgresError):
+    error_code = '42P02'
+
+
+class InFailedSqlTransactionError(PostgresError):
+    error_code = '25P02'
+
+
+class DuplicatePreparedStatementError(PostgresError):
+    error_code = '42P05'
+
+
+class InvalidSqlStatementNameError(PostgresError):
+    error_code = '26000'
+
+
+class InvalidCursorNameError(PostgresError):
+    error_code = '34000'
+
+
+class QueryCanceled(PostgresError):
+    error_code = '57014'
+
+
+class SerializationFailure(PostgresError):
+    error_code = '40001'
+
+
+class ActiveSqlTransactionError(PostgresError):
+    error_code = '25001'
+
+
+class TooManyConnectionsError(PostgresError):
+    error_code = '53300'
+
+
+class GroupingError(PostgresError):
+    error_code = '42803'
+
+
+class InvalidColumnReferenceError(PostgresError):
+    error_code = '42P10'
+
+
+class WrongObjectTypeError(PostgresError):
+    error_code = '42809'
+
+
+class CardinalityViolation(PostgresError):
+    error_code = '21000'
+
+
+class InvalidRecursionError(PostgresError):
+    error_code = '42P19'
+
+
+class WindowingError(PostgresError):
+    error_code = '42P20'
+
+
+class DuplicateTableError(PostgresError):
+    error_code = '42P07'
+
+
+class ObjectNotInPrerequisiteStateError(PostgresError):
+    error_code = '55000'
+
+
+class SequenceGeneratorLimitExceeded(PostgresError):
+    error_code = '2200H'
+
+
+class NumericValueOutOfRange(PostgresError):
+    error_code = '22003'
@@ -1,13 +1,30 @@
 from __future__ import generator_stop
 
 import argparse
+import asyncio
+import bisect
 import collections
+import concurrent.futures
 import contextlib
+import contextvars
+import decimal
 import functools
+import gc
+import hashlib
+import heapq
+import itertools
+import logging
 import math
 import numbers
 import operator
+import pickle
+import random
 import re
+import signal
+import sys
+import tempfile
+import threading
+import time
 import traceback
 import typing
 
@@ -17,6 +34,8 @@ import psqlparse
 
 import exc
 
+logger = logging.getLogger(__name__)
+
 
 class frozendict(frozendict_lib.frozendict):
     """
@@ -28,6 +47,293 @@ class frozendict(frozendict_lib.frozendict):
         return super(frozendict, cls).__new__(cls)
 
 
+# Parameters bound to the statement currently executing, for `$n` references.
+_bound_params = contextvars.ContextVar('bound_params', default=())
+
+
+@contextlib.contextmanager
+def _bind_params(params):
+    token = _bound_params.set(tuple(params))
+    try:
+        yield
+    finally:
+        _bound_params.reset(token)
+
+
+def _get_param(number):
+    params = _bound_params.get()
+    if not 0 < number <= len(params):
+        raise exc.UndefinedParameterError(f"there is no parameter ${number}")
+    return params[number - 1]
+
+
+# {parameter number: PgType} of the `$n` parameters whose types the statement
+# being described implies, or None if no statement is being described.
+_param_types = contextvars.ContextVar('param_types', default=None)
+
+
+def _note_param_type(node, pgtype):
+    """
+    Record that `node`, if it's a `$n` parameter, is used as a `pgtype`.
+    """
+    param_types = _param_types.get()
+    if param_types is not None and pgtype is not None and isinstance(node, psqlparse.nodes.ParamRef):
+        param_types.setdefault(node.number, pgtype)
+
+
+def _highest_param(node):
+    """
+    The highest `$n` parameter number under `node`, or 0 if it has none.
+    """
+    if isinstance(node, list):
+        return max(map(_highest_param, node), default=0)
+    if isinstance(node, psqlparse.nodes.ParamRef):
+        return node.number
+    if not hasattr(node, '__dict__'):
+        return 0
+    return max(
+        (_highest_param(value) for field, value in vars(node).items() if not field.startswith('_')),
+        default=0,
+    )
+
+
+# Rows of the queries enclosing the correlated subquery being run, innermost last.
+_outer_rows = contextvars.ContextVar('outer_rows', default=())
+
+
+@contextlib.contextmanager
+def _bind_outer_row(row):
+    token = _outer_rows.set((*_outer_rows.get(), row))
+    try:
+        yield
+    finally:
+        _outer_rows.reset(token)
+
+
+# The MockDatabase running the current statement, for functions that keep
+# per-session state, like nextval().
+_current_session = contextvars.ContextVar('current_session')
+
+
+@contextlib.contextmanager
+def _bind_session(session):
+    token = _current_session.set(session)
+    try:
+        yield
+    finally:
+        _current_session.reset(token)
+
+
+class _StatementTiming:
+    """
+    Time the statement currently executing has spent planning, for statement statistics.
+    """
+    __slots__ = ('plan_time', 'planning')
+
+    def __init__(self):
+        self.plan_time = 0.0
+        self.planning = False
+
+
+# The _StatementTiming of the statement executing, or None if neither
+# statement statistics nor execution hooks are on.
+_statement_timing = contextvars.ContextVar('statement_timing', default=None)
+
+
+@contextlib.contextmanager
+def _planning():
+    """
+    Count the time inside as planning the current statement.
+
+    Plans compiled while planning, like those of subqueries, count once.
+    """
+    timing = _statement_timing.get()
+    if timing is None or timing.planning:
+        yield
+        return
+    hooks = _active_hooks.get()
+    timing.planning = True
+    _call_hooks(hooks, 'plan_start')
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.plan_time += time.perf_counter() - start
+        timing.planning = False
+        _call_hooks(hooks, 'plan_end')
+
+
+class ExecutionHooks:
+    """
+    Callbacks on what a MockDatabase is doing, for profiling and tracing.
+
+    Subclass and override the callbacks wanted, and register an instance with
+    MockDatabase.add_hook(). Every callback does nothing by default. Each
+    `_start` callback is followed by its `_end` on the same thread, even if
+    what it's timing fails.
+    """
+    def parse_start(self, query):
+        pass
+
+    def parse_end(self, query, statements):
+        """
+        `statements` is None if parsing failed.
+        """
+
+    def statement_start(self, statement, text):
+        """
+        `text` is the statement's source, where it's known.
+        """
+
+    def statement_end(self, statement, text, result, error):
+        """
+        `error` is the exception the statement raised, if it failed.
+        """
+
+    def plan_start(self):
+        pass
+
+    def plan_end(self):
+        pass
+
+    def operator_open(self, operator):
+        """
+        An Operator of a running plan was asked for its first row.
+        """
+
+    def operator_next(self, operator, row):
+        """
+        An Operator produced a row.
+
+        Runs for every row, so leave it alone unless the rows are needed.
+        """
+
+    def operator_close(self, operator, rows):
+        """
+        An Operator finished, or was abandoned, after producing `rows` rows.
+
+        Operators can be abandoned out of order, like a subquery that stops at
+        its first row. `operator.finished` says which it was.
+        """
+
+    def write_start(self, table, operation, rows):
+        """
+        `operation` is 'INSERT', 'UPDATE', 'DELETE', 'COPY', 'VACUUM' or
+        'ANALYZE', and `rows` how many rows it writes. VACUUM counts the rows
+        it removes, and ANALYZE, which only writes the table's statistics,
+        the rows it gathers them from.
+        """
+
+    def write_end(self, table, operation, rows):
+        pass
+
+
+@attr.s(slots=True, eq=False)
+class Operator:
+    """
+    One step of a running plan, as execution hooks see it.
+    """
+    name = attr.ib()
+    # What it works on, like a table's name.
+    detail = attr.ib(default=None)
+    # Whether it ran out of rows, rather than being abandoned.
+    finished = attr.ib(default=False, init=False)
+
+
+# ExecutionHooks of the statement executing.
+_active_hooks = contextvars.ContextVar('active_hooks', default=())
+
+
+def _call_hooks(hooks, callback, *args):
+    for hook in hooks:
+        getattr(hook, callback)(*args)
+
+
+def _traced(hooks, operator, rows):
+    """
+    Yield `rows`, an operator's output, between its open and close callbacks.
+
+    `rows` may instead be a function returning them, for operators that do
+    their work up front, like sorts. It isn't called until the operator opens.
+    """
+    row_hooks = [
+        hook for hook in hooks
+        if type(hook).operator_next is not ExecutionHooks.operator_next
+    ]
+    _call_hooks(hooks, 'operator_open', operator)
+    count = 0
+    try:
+        for row in rows() if callable(rows) else rows:
+            count += 1
+            for hook in row_hooks:
+                hook.operator_next(operator, row)
+            yield row
+        operator.finished = True
+    finally:
+        _call_hooks(hooks, 'operator_close', operator, count)
+
+
+def _trace(operator_name, rows, detail=None):
+    """
+    `rows`, traced as an operator if there are execution hooks.
+    """
+    hooks = _active_hooks.get()
+    if not hooks:
+        return rows() if callable(rows) else rows
+    return _traced(hooks, Operator(operator_name, detail), rows)
+
+
+@contextlib.contextmanager
+def _writing(table, operation, rows):
+    hooks = _active_hooks.get()
+    if not hooks:
+        yield
+        return
+    _call_hooks(hooks, 'write_start', table, operation, rows)
+    try:
+        yield
+    finally:
+        _call_hooks(hooks, 'write_end', table, operation, rows)
+
+
+class _PlanShape(ExecutionHooks):
+    """
+    Records the operators a statement ran, for the slow statement log.
+    """
+    def __init__(self):
+        self.operators = []
+        # Operators opened but not closed yet, in the order they opened.
+        self.running = {}
+
+    def operator_open(self, operator):
+        self.running[operator] = None
+
+    def operator_close(self, operator, rows):
+        self.running.pop(operator, None)
+        self.operators.append((operator, rows))
+
+    def describe(self):
+        """
+        The operators, in the order they finished: inputs before what reads them.
+
+        Operators abandoned partway, as when a statement fails, say how far
+        they got. Ones still open come last, also inputs first.
+        """
+        return ' -> '.join([
+            *(
+                self._describe_operator(operator, f"{rows} rows" if operator.finished else f"stopped after {rows} rows")
+                for operator, rows in self.operators
+            ),
+            *(self._describe_operator(operator, "running") for operator in reversed(list(self.running))),
+        ]) or 'no operators'
+
+    @staticmethod
+    def _describe_operator(operator, progress):
+        if operator.detail is None:
+            return f"{operator.name} ({progress})"
+        return f"{operator.name} ({operator.detail}, {progress})"
+
+
 def first(iterable):
     return next(iter(iterable))
 
@@ -101,6 +407,17 @@ class AbstractRow(frozendict):
         super().__init__(*args, **kwargs)
         self._address_extra()
 
+    @classmethod
+    def _from_trusted(cls, mapping):
+        """
+        Build a row without validating its columns.
+
+        Only for callers that have already checked the columns against the rowtype.
+        """
+        row = cls.__new__(cls)
+        super(AbstractRow, row).__init__(mapping)
+        return row
+
     def _address_missing(self):
         """
         Fill defaults of missing columns, or raise if a missing column has no default.
@@ -127,118 +444,979 @@ class AbstractRow(frozendict):
         return self[key]
 
 
-@attr.s(slots=True, frozen=True)
-class Table:
-    schema = attr.ib()
-    relname = attr.ib()
-    rowtype = attr.ib(repr=False)
-    rows = attr.ib(default=(), repr=False)
+class _Heap:
+    """
+    Backing lists shared by every snapshot of a RowStore.
 
-    def insert(self, rows):
-        # TODO: constraints
-        return Table(
-            schema=self.schema,
-            relname=self.relname,
-            rowtype=self.rowtype,
-            rows=self.rows + tuple(rows),
-        )
+    Rows never move once appended. Deleting one records the heap version it
+    was deleted in, so snapshots from before then still see it.
+    """
+    __slots__ = ('rows', 'ids', 'deleted', 'next_id', 'version', 'lineage', 'lock')
+
+    def __init__(self, rows=(), ids=None, *, deleted=(), next_id=None, version=0, lineage=None):
+        self.rows = list(rows)
+        # Row ids, in increasing order. They stay the same through forks and compaction.
+        self.ids = list(range(len(self.rows))) if ids is None else list(ids)
+        # {row id: version it was deleted in}
+        self.deleted = dict(deleted)
+        if next_id is None:
+            next_id = self.ids[-1] + 1 if self.ids else 0
+        self.next_id = next_id
+        self.version = version
+        # Shared by forks of the same heap, whose row ids mean the same rows.
+        self.lineage = object() if lineage is None else lineage
+        self.lock = threading.Lock()
+
+
+class _MemoryCounter:
+    """
+    Adds up the memory objects take, counting each object once however many
+    times it's reached.
 
-    @classmethod
-    def generate_rowtype(cls, column_data):
-        columns = [
-            column.colname
-            for column in column_data
-        ]
-        return type('Row', (AbstractRow,), {'columns': columns})
+    Objects are followed to everything they refer to, except types, which are
+    shared with everything else of their type.
+    """
+    __slots__ = ('_seen',)
+
+    def __init__(self):
+        self._seen = set()
+
+    def exclude(self, *objects):
+        """
+        Count `objects` as already counted, and so don't follow them either.
+        """
+        self._seen.update(map(id, objects))
+
+    def add(self, *objects):
+        """
+        Bytes taken by `objects` and what they refer to, not counting anything counted before.
+        """
+        seen = self._seen
+        total = 0
+        while objects:
+            unseen = []
+            for obj in objects:
+                if id(obj) not in seen:
+                    seen.add(id(obj))
+                    total += sys.getsizeof(obj)
+                    unseen.append(obj)
+            # Untracked containers, like dicts of plain values, still have referents.
+            objects = [obj for obj in gc.get_referents(*unseen) if not isinstance(obj, type)]
+        return total
 
 
 @attr.s(slots=True, frozen=True)
-class ResultSet:
-    row_names = attr.ib()
-    rows = attr.ib(converter=list)
+class RowChanges:
+    # Ids of the older snapshot's rows that were deleted or updated since.
+    deleted = attr.ib()
+    # Rows appended since, including new versions of updated rows.
+    appended = attr.ib()
 
 
-class Element(typing.NamedTuple):
-    value: typing.Any
-    name: str = None
+@attr.s(slots=True, frozen=True)
+class RowStore:
+    """
+    Row storage, shared between snapshots of a table.
 
-    def eval(self, row):
-        return self.value(row)
+    Every snapshot sees a prefix of the same backing heap, as of one version of
+    it. Writing to the newest snapshot only costs the rows written: deleted
+    rows stay behind as tombstones until `compact()`, and updates delete the
+    old version of a row and append the new one. Writing to an older snapshot
+    forks off a copy of the heap it sees first.
+    """
+    _heap = attr.ib(factory=_Heap, repr=False)
+    # How much of the heap this snapshot sees.
+    _length = attr.ib(default=0)
+    _version = attr.ib(default=0)
+    # Rows this snapshot sees, not counting tombstones.
+    _live = attr.ib(default=0)
+
+    def __len__(self):
+        return self._live
+
+    def __iter__(self):
+        if self._live == self._length:
+            return itertools.islice(self._heap.rows, self._length)
+        return (row for _, row in self.items())
+
+    @property
+    def tombstones(self):
+        return self._length - self._live
+
+    def items(self, start=0):
+        """
+        (row id, row) pairs of the rows this snapshot sees, from heap position `start` on.
+        """
+        heap = self._heap
+        deleted = heap.deleted
+        version = self._version
+        for row_id, row in zip(
+            itertools.islice(heap.ids, start, self._length),
+            itertools.islice(heap.rows, start, self._length),
+        ):
+            deleted_in = deleted.get(row_id)
+            if deleted_in is None or deleted_in > version:
+                yield row_id, row
+
+    def extend(self, rows):
+        return self.update((), rows)
+
+    def last_ids(self, count):
+        """
+        Row ids of the last `count` rows of the heap this snapshot sees.
+        """
+        return self._heap.ids[self._length - count:self._length]
 
+    def delete(self, row_ids):
+        return self.update(row_ids, ())
 
-class Constant(typing.NamedTuple):
-    value: typing.Any
-    name: str = None
+    def update(self, row_ids, rows):
+        """
+        Delete the rows with `row_ids`, and append `rows`, as one write.
+        """
+        heap = self._heap
+        with heap.lock:
+            if heap.version != self._version:
+                heap = self._fork()
+            heap.version += 1
+            deleted = heap.deleted
+            for row_id in row_ids:
+                deleted[row_id] = heap.version
+            start = len(heap.rows)
+            heap.rows.extend(rows)
+            added = len(heap.rows) - start
+            heap.ids.extend(range(heap.next_id, heap.next_id + added))
+            heap.next_id += added
+            return RowStore(
+                heap=heap,
+                length=len(heap.rows),
+                version=heap.version,
+                live=self._live - len(row_ids) + added,
+            )
 
-    def eval(self, row):
-        del row
-        return self.value
+    def _fork(self):
+        heap = self._heap
+        version = self._version
+        return _Heap(
+            itertools.islice(heap.rows, self._length),
+            itertools.islice(heap.ids, self._length),
+            deleted={row_id: deleted_in for row_id, deleted_in in heap.deleted.items() if deleted_in <= version},
+            version=version,
+            lineage=heap.lineage,
+        )
 
+    def compact(self):
+        """
+        This snapshot without its tombstones, in a heap of its own.
+        """
+        if not self.tombstones:
+            return self
+        ids = []
+        rows = []
+        for row_id, row in self.items():
+            ids.append(row_id)
+            rows.append(row)
+        heap = _Heap(rows, ids, next_id=self._heap.next_id)
+        return RowStore(heap=heap, length=len(rows), live=len(rows))
+
+    def heap_size(self, counter):
+        """
+        Bytes taken by the rows of the heap.
 
-@attr.s(frozen=True, slots=True)
-class Schema:
-    tables = attr.ib(default=(), converter=frozendict)
-    functions = attr.ib(default=(), converter=frozendict)
-    types = attr.ib(default=(), converter=frozendict)
+        That's every row of it, not just the ones this snapshot sees: rows
+        deleted or appended by other snapshots stay in memory as long as any
+        of them does.
+        """
+        return counter.add(self._heap.rows)
 
+    def bookkeeping_size(self, counter):
+        """
+        Bytes taken by the heap's row ids and record of deletions.
+        """
+        heap = self._heap
+        return counter.add(heap.ids, heap.deleted)
 
-@attr.s(frozen=True, slots=True)
-class Function:
-    fn = attr.ib()
+    def has_rows(self, row_ids):
+        """
+        Whether this snapshot sees every row in `row_ids`.
+        """
+        heap = self._heap
+        ids = heap.ids
+        deleted = heap.deleted
+        for row_id in row_ids:
+            position = bisect.bisect_left(ids, row_id, 0, self._length)
+            if position == self._length or ids[position] != row_id:
+                return False
+            deleted_in = deleted.get(row_id)
+            if deleted_in is not None and deleted_in <= self._version:
+                return False
+        return True
 
+    def changes_since(self, older):
+        """
+        RowChanges from the `older` snapshot to this one, or None if this one
+        didn't come from it.
+        """
+        heap = self._heap
+        if heap.lineage is not older._heap.lineage or older._version > self._version \
+                or older._length > self._length:
+            return None
+        last_id = heap.ids[older._length - 1] if older._length else -1
+        with heap.lock:
+            deleted = [
+                row_id
+                for row_id, deleted_in in heap.deleted.items()
+                if older._version < deleted_in <= self._version and row_id <= last_id
+            ]
+        return RowChanges(
+            deleted=deleted,
+            appended=[row for _, row in self.items(older._length)],
+        )
 
-@attr.s(frozen=True, slots=True)
-class SortByStrategy:
-    _sortby_dir = attr.ib(repr=False)
-    _sortby_nulls = attr.ib(repr=False)
-    asc = attr.ib(init=False)
-    desc = attr.ib(init=False)
-    nulls_last = attr.ib(init=False)
-    nulls_first = attr.ib(init=False)
 
-    @asc.default
-    def _(self):
-        return self._sortby_dir != 2
+# Selectivities the planner falls back on when statistics can't tell it better, as in postgres.
+DEFAULT_EQ_SEL = 0.005
+DEFAULT_INEQ_SEL = 1 / 3
+# Rows ANALYZE samples per unit of statistics target.
+_ROWS_PER_STATISTICS_TARGET = 300
 
-    @desc.default
-    def _(self):
-        return not self.asc
 
-    @nulls_last.default
-    def _(self):
-        if self._sortby_nulls == 0:
-            return self.asc
-        return self._sortby_nulls == 2
+def _estimate_distinct(counts, sample_rows, total_rows):
+    """
+    Estimate how many distinct values `total_rows` values have, from `counts` of a sample of them.
 
-    @nulls_first.default
-    def _(self):
-        return not self.nulls_last
+    This is the Haas-Stokes estimator postgres uses.
+    """
+    distinct = len(counts)
+    if sample_rows >= total_rows:
+        return distinct
+    seen_once = sum(1 for count in counts.values() if count == 1)
+    if not seen_once:
+        # Every value turned up more than once, so the sample probably found them all.
+        return distinct
+    if seen_once == sample_rows:
+        # Every value was unique, so the column probably is too.
+        return total_rows
+    estimate = sample_rows * distinct / (sample_rows - seen_once + seen_once * sample_rows / total_rows)
+    return min(max(estimate, distinct), total_rows)
 
 
-@attr.s(eq=False, order=False)
-class SortByKey:
-    strat = attr.ib()
-    value = attr.ib()
+@attr.s(frozen=True, slots=True)
+class ColumnStatistics:
+    """
+    What ANALYZE found out about a column, from a sample of its table's rows.
+    """
+    null_frac = attr.ib()
+    # Distinct non-null values: a count, or if negative, minus their number as a
+    # fraction of the table's rows, for columns whose values grow with the table.
+    n_distinct = attr.ib()
+    # The values more common than most, most common first, and the fraction of rows with each.
+    most_common_vals = attr.ib(converter=tuple)
+    most_common_freqs = attr.ib(converter=tuple)
+    # Bounds splitting the other values into buckets of about as many rows each.
+    histogram_bounds = attr.ib(converter=tuple)
 
-    def _cmp_compatible(self, other):
+    @classmethod
+    def collect(cls, values, total_rows, target):
         """
-        Return if `self` is comparable to `other`.
+        Statistics of a column from `values`, a sample of the `total_rows` it has.
+
+        `target` is how many most common values and histogram buckets to keep at most.
         """
-        return (
-            type(other) == type(self)
-            and self.strat == other.strat
-        )
+        sample_rows = len(values)
+        non_null = [value for value in values if value is not None]
+        null_frac = (sample_rows - len(non_null)) / sample_rows if sample_rows else 0.0
+        try:
+            counts = collections.Counter(non_null)
+        except TypeError:
+            # Arrays and the like, which can't be counted.
+            return cls(
+                null_frac=null_frac, n_distinct=0, most_common_vals=(), most_common_freqs=(), histogram_bounds=(),
+            )
 
-    def __lt__(self, other):
-        if not self._cmp_compatible(other):
-            return NotImplemented
-        if self.value == other.value:
-            return False
-        if self.value is None:
-            return self.strat.nulls_first
-        if other.value is None:
-            return self.strat.nulls_last
-        return (self.value < other.value) == self.strat.asc
+        total_non_null = round(total_rows * (1 - null_frac))
+        n_distinct = _estimate_distinct(counts, len(non_null), total_non_null)
+        if n_distinct > 0.1 * total_rows:
+            n_distinct = -n_distinct / total_rows
+
+        common = counts.most_common(target)
+        if len(counts) > len(common) or n_distinct < 0:
+            # Not every value fits, so only keep ones that stand out from the average.
+            minimum = max(2, 1.25 * len(non_null) / len(counts)) if counts else 2
+            common = [(value, count) for value, count in common if count >= minimum]
+        common_values = {value for value, _ in common}
+
+        rest = [value for value in non_null if value not in common_values]
+        bounds = ()
+        if len(set(rest)) > 1:
+            try:
+                rest.sort()
+            except TypeError:
+                pass
+            else:
+                buckets = min(target, len(rest) - 1)
+                bounds = [rest[index * (len(rest) - 1) // buckets] for index in range(buckets + 1)]
+        return cls(
+            null_frac=null_frac,
+            n_distinct=n_distinct,
+            most_common_vals=[value for value, _ in common],
+            most_common_freqs=[count / sample_rows for _, count in common],
+            histogram_bounds=bounds,
+        )
+
+    def distinct(self, reltuples):
+        """
+        Estimated distinct non-null values in a table of `reltuples` rows.
+        """
+        if self.n_distinct >= 0:
+            return self.n_distinct
+        return -self.n_distinct * reltuples
+
+    def eq_selectivity(self, value, reltuples):
+        """
+        Estimated fraction of rows where the column equals `value`.
+        """
+        if value is None:
+            return self.null_frac
+        for common_value, freq in zip(self.most_common_vals, self.most_common_freqs):
+            if common_value == value:
+                return freq
+        other_rows = max(1 - self.null_frac - sum(self.most_common_freqs), 0)
+        other_values = self.distinct(reltuples) - len(self.most_common_vals)
+        return other_rows / other_values if other_values >= 1 else 0.0
+
+    def compare_selectivity(self, compare, value):
+        """
+        Estimated fraction of rows where `compare(column, value)` holds, for `compare` like `<`.
+
+        Raises TypeError if `value` can't be compared with the column's values.
+        """
+        if value is None:
+            return 0.0
+        common = sum(
+            freq
+            for common_value, freq in zip(self.most_common_vals, self.most_common_freqs)
+            if compare(common_value, value)
+        )
+        other_rows = max(1 - self.null_frac - sum(self.most_common_freqs), 0)
+        bounds = self.histogram_bounds
+        if bounds:
+            fraction = sum(1 for bound in bounds if compare(bound, value)) / len(bounds)
+        else:
+            fraction = DEFAULT_INEQ_SEL
+        return common + fraction * other_rows
+
+
+@attr.s(frozen=True, slots=True)
+class TableStatistics:
+    """
+    Planner statistics of a table, as of its last ANALYZE.
+    """
+    reltuples = attr.ib()
+    # {column name: ColumnStatistics}
+    columns = attr.ib(converter=frozendict)
+
+    @classmethod
+    def collect(cls, table, columns, target, previous=None):
+        """
+        Statistics of the `columns` of `table`, plus those of its other columns in `previous`.
+
+        Tables of more than `target` times 300 rows are sampled. The sample is
+        random, but the same every time, so plans don't change from one
+        ANALYZE to the next unless the data does.
+        """
+        total_rows = len(table.rows)
+        sample_size = _ROWS_PER_STATISTICS_TARGET * target
+        if total_rows > sample_size:
+            chosen = set(random.Random(0).sample(range(total_rows), sample_size))
+            sample = [row for position, row in enumerate(table.rows) if position in chosen]
+        else:
+            sample = list(table.rows)
+        statistics = dict(previous.columns) if previous is not None else {}
+        for column in columns:
+            statistics[column] = ColumnStatistics.collect(
+                [row[column] for row in sample], total_rows, target,
+            )
+        return cls(reltuples=total_rows, columns=statistics)
+
+
+@attr.s(slots=True, frozen=True)
+class Table:
+    schema = attr.ib()
+    relname = attr.ib()
+    rowtype = attr.ib(repr=False)
+    rows = attr.ib(factory=RowStore, repr=False)
+    # MaterializedView, for materialized views.
+    view = attr.ib(default=None, repr=False)
+    # TableStatistics from the last ANALYZE, kept as the rows change until the next one.
+    statistics = attr.ib(default=None, repr=False, eq=False)
+
+    def insert(self, rows):
+        # TODO: constraints
+        return attr.evolve(self, rows=self.rows.extend(rows))
+
+    def update(self, row_ids, rows):
+        """
+        Replace the rows with `row_ids` with `rows`, their new versions.
+        """
+        return attr.evolve(self, rows=self.rows.update(row_ids, rows))
+
+    def delete(self, row_ids):
+        return attr.evolve(self, rows=self.rows.delete(row_ids))
+
+    def relation_size(self, counter=None):
+        """
+        Bytes of memory taken by the table's rows.
+
+        Storage is shared with other snapshots of the table, and values with
+        whatever else they were copied into, so the sizes of tables can add up
+        to more than the database's. Pass a `counter` to leave out what it has
+        already counted.
+        """
+        counter = _MemoryCounter() if counter is None else counter
+        return self.rows.heap_size(counter)
+
+    def total_relation_size(self, counter=None):
+        """
+        Bytes of memory taken by the table's rows, their bookkeeping and its rowtype.
+        """
+        counter = _MemoryCounter() if counter is None else counter
+        rowtype = self.rowtype
+        # Types and defaults belong to the catalog and the sequences.
+        counter.exclude(*rowtype.column_types.values(), *rowtype.defaults.values())
+        return (
+            self.relation_size(counter)
+            + self.rows.bookkeeping_size(counter)
+            + counter.add(rowtype, rowtype.columns, rowtype.column_types, rowtype.not_null, rowtype.defaults)
+        )
+
+    @classmethod
+    def generate_rowtype(cls, columns, column_types=(), not_null=(), defaults=(), ambiguous=()):
+        return type('Row', (AbstractRow,), {
+            'columns': list(columns),
+            # Names more than one column of a derived table goes by, which can't be referred to.
+            'ambiguous': frozenset(ambiguous),
+            'column_types': frozendict(column_types),
+            'not_null': frozenset(not_null),
+            # {column: ColumnDefault}, for columns with a DEFAULT.
+            'defaults': frozendict(defaults),
+        })
+
+
+class Sequence:
+    """
+    A sequence generator.
+
+    Unlike a table, its position is shared by every snapshot and never rolls
+    back: values handed out stay used, as in postgres. Sessions take them a
+    block at a time and hand them out from their own cache.
+    """
+    __slots__ = ('schema', 'relname', 'increment', 'min_value', 'max_value', 'cache', 'cycle',
+                 '_next', '_lock')
+
+    def __init__(self, schema, relname, *, increment=1, min_value=None, max_value=None,
+                 start=None, cache=1, cycle=False):
+        if increment == 0:
+            raise exc.InvalidParameterValueError("INCREMENT must not be zero")
+        if min_value is None:
+            min_value = 1 if increment > 0 else -(2 ** 63) + 1
+        if max_value is None:
+            max_value = 2 ** 63 - 1 if increment > 0 else -1
+        if min_value >= max_value:
+            raise exc.InvalidParameterValueError(
+                f"MINVALUE ({min_value}) must be less than MAXVALUE ({max_value})"
+            )
+        if start is None:
+            start = min_value if increment > 0 else max_value
+        if not min_value <= start <= max_value:
+            raise exc.InvalidParameterValueError(
+                f"START value ({start}) cannot be outside MINVALUE ({min_value}) and MAXVALUE ({max_value})"
+            )
+        if cache < 1:
+            raise exc.InvalidParameterValueError(f"CACHE ({cache}) must be greater than zero")
+        self.schema = schema
+        self.relname = relname
+        self.increment = increment
+        self.min_value = min_value
+        self.max_value = max_value
+        self.cache = cache
+        self.cycle = cycle
+        # The value the next allocation starts from. May be past the bounds,
+        # once the sequence is used up.
+        self._next = start
+        self._lock = threading.Lock()
+
+    def allocate(self, count):
+        """
+        Reserve up to `count` values, and return them.
+
+        Only stops short at the end of a sequence that doesn't cycle, and
+        raises if there's nothing left at all.
+        """
+        increment = self.increment
+        blocks = []
+        total = 0
+        with self._lock:
+            while total < count:
+                start = self._next
+                if increment > 0:
+                    available = max(0, (self.max_value - start) // increment + 1)
+                else:
+                    available = max(0, (start - self.min_value) // -increment + 1)
+                if not available:
+                    if blocks:
+                        break
+                    if not self.cycle:
+                        bound = 'maximum' if increment > 0 else 'minimum'
+                        limit = self.max_value if increment > 0 else self.min_value
+                        raise exc.SequenceGeneratorLimitExceeded(
+                            f'nextval: reached {bound} value of sequence "{self.relname}" ({limit})'
+                        )
+                    self._next = self.min_value if increment > 0 else self.max_value
+                    continue
+                size = min(available, count - total)
+                blocks.append(range(start, start + size * increment, increment))
+                total += size
+                self._next = start + size * increment
+                if not self.cycle:
+                    break
+        if len(blocks) == 1:
+            return blocks[0]
+        return list(itertools.chain.from_iterable(blocks))
+
+    def set(self, value, is_called=True):
+        """
+        Move the sequence to `value`, as setval() does.
+        """
+        if not self.min_value <= value <= self.max_value:
+            raise exc.NumericValueOutOfRange(
+                f'setval: value {value} is out of bounds for sequence "{self.relname}" '
+                f"({self.min_value}..{self.max_value})"
+            )
+        with self._lock:
+            self._next = value + self.increment if is_called else value
+
+    def relation_size(self, counter=None):
+        counter = _MemoryCounter() if counter is None else counter
+        return counter.add(self)
+
+    total_relation_size = relation_size
+
+
+@attr.s(frozen=True, slots=True)
+class ColumnDefault:
+    """
+    A column's DEFAULT, compiled once when its table is created.
+    """
+    # Element computing the default, evaluated for each row.
+    element = attr.ib(default=None)
+    # The Sequence of a `nextval('...')` default, which hands out whole blocks at once.
+    sequence = attr.ib(default=None)
+
+    def generate(self, count):
+        """
+        Default values for `count` new rows.
+        """
+        if self.sequence is not None:
+            return _current_session.get().next_values(self.sequence, count)
+        element = self.element
+        return [element.eval(None) for _ in range(count)]
+
+
+@attr.s(frozen=True, slots=True, eq=False)
+class MaterializedView:
+    """
+    The query a materialized view is refreshed from.
+    """
+    query = attr.ib()
+    # IncrementalView, if inserts into the base table are applied as they happen.
+    incremental = attr.ib(default=None)
+
+
+class _GroupStates:
+    """
+    Aggregate states of an incremental view's groups, shared by every snapshot of the view.
+
+    Like a _Heap, only the newest snapshot writes to it, in place. An older
+    snapshot can't get its own groups back, so it recomputes the view instead.
+    """
+    __slots__ = ('groups', 'row_ids', 'version', 'lock')
+
+    def __init__(self):
+        # {group key: (first row, states)}
+        self.groups = {}
+        # {group key: row id of its output row in the view}
+        self.row_ids = {}
+        self.version = 0
+        self.lock = threading.Lock()
+
+
+@attr.s(frozen=True, slots=True, eq=False)
+class IncrementalView:
+    """
+    Keeps a materialized view up to date as rows are appended to its one base table.
+
+    Views that only filter and project append the output of each new row.
+    Aggregating views keep the aggregate states of every group, and only
+    replace the output rows of the groups new rows fall into. Deleting or
+    updating base rows recomputes the whole view.
+    """
+    # (schema, relname) of the base table.
+    base = attr.ib()
+    # (table, alias) the compiled expressions read base rows under.
+    source = attr.ib()
+    select_list = attr.ib()
+    null_row = attr.ib(repr=False)
+    # For aggregating views.
+    _states = attr.ib(factory=_GroupStates, repr=False)
+    _version = attr.ib(default=0)
+
+    def apply(self, view_table, base_rows):
+        """
+        Return `view_table` with `base_rows`, newly appended to the base table, applied.
+
+        Returns None if a newer snapshot of the view has applied rows since,
+        and the view needs rebuilding instead.
+        """
+        source = self.source
+        select_list = self.select_list
+        rows = ({source: row} for row in base_rows)
+        if select_list.where is not None:
+            rows = filter(select_list.where.eval, rows)
+        columns = view_table.rowtype.columns
+        targets = select_list.targets
+        make_row = view_table.rowtype._from_trusted
+
+        def output_row(row):
+            return make_row(dict(zip(columns, [target.eval(row) for target in targets])))
+
+        grouping = select_list.grouping
+        if grouping is None:
+            return view_table.insert([output_row(row) for row in rows])
+
+        states = self._states
+        with states.lock:
+            if states.version != self._version:
+                return None
+            # Before anything changes, so a write that fails halfway leaves
+            # every snapshot needing a rebuild rather than trusting the states.
+            states.version += 1
+            groups = states.groups
+            row_ids = states.row_ids
+            touched = {}
+            grouping.accumulate(groups, rows, touched)
+            if not groups:
+                empty = grouping.empty_group(self.null_row)
+                if empty is not None:
+                    groups[()] = empty
+                    touched[()] = None
+            if not touched:
+                states.version = self._version
+                return view_table
+            old_ids = []
+            new_keys = []
+            new_rows = []
+            for key in touched:
+                row_id = row_ids.pop(key, None)
+                if row_id is not None:
+                    old_ids.append(row_id)
+                group_row = grouping.group_row(*groups[key])
+                if select_list.having is None or select_list.having.eval(group_row):
+                    new_keys.append(key)
+                    new_rows.append(output_row(group_row))
+            view_table = view_table.update(old_ids, new_rows)
+            row_ids.update(zip(new_keys, view_table.rows.last_ids(len(new_rows))))
+            incremental = attr.evolve(self, version=states.version)
+        return attr.evolve(view_table, view=attr.evolve(view_table.view, incremental=incremental))
+
+    def rebuild(self, view_table, base_rows):
+        """
+        Return `view_table` recomputed from all of `base_rows`.
+        """
+        empty = attr.evolve(self, states=_GroupStates(), version=0)
+        view_table = attr.evolve(
+            view_table,
+            rows=RowStore(),
+            view=attr.evolve(view_table.view, incremental=empty),
+        )
+        return empty.apply(view_table, base_rows)
+
+
+# Stands in for DEFAULT among the values of an INSERT or UPDATE, until the
+# column's default is generated for the row.
+_DEFAULT = object()
+
+
+@attr.s(frozen=True, slots=True)
+class InsertPlan:
+    """
+    Column mapping and type coercion for an INSERT, resolved once per statement.
+    """
+    rowtype = attr.ib()
+    col_names = attr.ib(converter=tuple)
+    _pgtypes = attr.ib(converter=tuple, repr=False)
+    _missing = attr.ib(converter=frozendict, repr=False)
+    # (column, ColumnDefault) for missing columns with a DEFAULT.
+    _defaults = attr.ib(converter=tuple, repr=False)
+
+    @classmethod
+    def create(cls, table, col_names):
+        rowtype = table.rowtype
+        seen = set()
+        for col_name in col_names:
+            if col_name not in rowtype.columns:
+                raise exc.UndefinedColumnError(
+                    f'column "{col_name}" of relation "{table.relname}" does not exist'
+                )
+            if col_name in seen:
+                raise exc.DuplicateColumnError(f'column "{col_name}" specified more than once')
+            seen.add(col_name)
+        return cls(
+            rowtype=rowtype,
+            col_names=col_names,
+            pgtypes=[rowtype.column_types[col_name] for col_name in col_names],
+            missing=dict.fromkeys(
+                col for col in rowtype.columns if col not in seen and col not in rowtype.defaults
+            ),
+            defaults=[
+                (col, rowtype.defaults[col])
+                for col in rowtype.columns
+                if col not in seen and col in rowtype.defaults
+            ],
+        )
+
+    def build_rows(self, value_rows):
+        """
+        Coerce tuples of values into validated rows of this plan's rowtype.
+
+        Values may be _DEFAULT, for the column's default, or NULL if it has none.
+        """
+        col_names = self.col_names
+        converters = [pgtype.converter for pgtype in self._pgtypes]
+        missing = self._missing
+        make_row = self.rowtype._from_trusted
+        # Generated for all the rows up front, so sequences hand out one block.
+        defaults = [
+            (col, iter(default.generate(len(value_rows))))
+            for col, default in self._defaults
+        ]
+        rows = []
+        # {column: rows setting it to DEFAULT}
+        set_to_default = collections.defaultdict(list)
+        for values in value_rows:
+            try:
+                row = dict(zip(col_names, [
+                    value if value is None or value is _DEFAULT else converter(value)
+                    for converter, value in zip(converters, values)
+                ]))
+            except (ValueError, ArithmeticError):
+                raise _text_input_error(self._pgtypes, values) from None
+            if _DEFAULT in values:
+                for col, value in row.items():
+                    if value is _DEFAULT:
+                        set_to_default[col].append(row)
+            if missing:
+                row.update(missing)
+            for col, generated in defaults:
+                row[col] = next(generated)
+            rows.append(row)
+        for col, col_rows in set_to_default.items():
+            default = self.rowtype.defaults.get(col)
+            generated = [None] * len(col_rows) if default is None else default.generate(len(col_rows))
+            for row, value in zip(col_rows, generated):
+                row[col] = value
+        rows = [make_row(row) for row in rows]
+        _check_not_null(self.rowtype, rows)
+        return rows
+
+
+def _check_not_null(rowtype, rows):
+    for col_name in rowtype.not_null:
+        for row in rows:
+            if row[col_name] is None:
+                failing_row = ', '.join(
+                    'null' if value is None else _copy_output_text(value)
+                    for value in map(row.get, rowtype.columns)
+                )
+                raise exc.NotNullViolation(
+                    f'null value in column "{col_name}" violates not-null constraint\n'
+                    f"Failing row contains ({failing_row})."
+                )
+
+
+@attr.s(slots=True, frozen=True)
+class ResultSet:
+    row_names = attr.ib()
+    rows = attr.ib(converter=list)
+    # PgType of each column, where it's known statically.
+    row_types = attr.ib(default=None)
+
+    @property
+    def tag(self):
+        return f"SELECT {len(self.rows)}"
+
+    @property
+    def rowcount(self):
+        return len(self.rows)
+
+
+@attr.s(slots=True, frozen=True)
+class StatementDescription:
+    """
+    What a prepared statement takes and returns, worked out without running it.
+    """
+    # PgType of each `$n` parameter, or None where nothing implies one.
+    param_types = attr.ib(converter=tuple)
+    # None if the statement doesn't return rows.
+    row_names = attr.ib(default=None)
+    # PgType of each column, or None where it isn't known statically.
+    row_types = attr.ib(default=None)
+
+
+@attr.s(slots=True, frozen=True)
+class CommandStatus:
+    """
+    Result of a statement that doesn't return rows.
+    """
+    tag = attr.ib()
+
+    @property
+    def rowcount(self):
+        """
+        Number of rows the command affected, or -1 if that doesn't apply.
+        """
+        *_, count = self.tag.split()
+        return int(count) if count.isdigit() else -1
+
+
+@attr.s(frozen=True, slots=True)
+class PgType:
+    converter = attr.ib()
+    description = attr.ib()
+    name = attr.ib(default=None)
+
+
+class Element(typing.NamedTuple):
+    value: typing.Any
+    name: str = None
+    pgtype: PgType = None
+
+    def eval(self, row):
+        return self.value(row)
+
+
+class Constant(typing.NamedTuple):
+    value: typing.Any
+    name: str = None
+    pgtype: PgType = None
+
+    def eval(self, row):
+        del row
+        return self.value
+
+
+@attr.s(frozen=True, slots=True)
+class Schema:
+    tables = attr.ib(default=(), converter=frozendict)
+    functions = attr.ib(default=(), converter=frozendict)
+    types = attr.ib(default=(), converter=frozendict)
+    sequences = attr.ib(default=(), converter=frozendict)
+
+
+@attr.s(frozen=True, slots=True)
+class Function:
+    fn = attr.ib()
+    # Whether the result can change between calls with the same arguments.
+    volatile = attr.ib(default=False)
+
+
+@attr.s(frozen=True, slots=True)
+class Aggregate:
+    """
+    An aggregate function, as operations on an accumulated state.
+    """
+    # Returns a fresh state.
+    init = attr.ib()
+    # Folds one value into a state, returning the new state.
+    step = attr.ib()
+    # Turns a state into the aggregate's result. None returns the state as it is.
+    final = attr.ib(default=None)
+    # Whether NULL inputs are skipped, as they are for most aggregates.
+    strict = attr.ib(default=True)
+    # pg_catalog name of the result type: 'anyelement' for the argument's type,
+    # or None if it isn't known.
+    return_type = attr.ib(default=None)
+    volatile = False
+
+
+@attr.s(frozen=True, slots=True)
+class WindowFunction:
+    """
+    A window function, computed a whole partition at a time.
+    """
+    # Takes a partition's rows in window order, the peer group number of each
+    # row and the argument Elements, and returns the result for each row.
+    evaluate = attr.ib()
+    # How many arguments it takes.
+    min_args = attr.ib(default=0)
+    max_args = attr.ib(default=0)
+    # As for Aggregate.
+    return_type = attr.ib(default=None)
+    volatile = False
+
+
+@attr.s(frozen=True, slots=True)
+class SortByStrategy:
+    _sortby_dir = attr.ib(repr=False)
+    _sortby_nulls = attr.ib(repr=False)
+    asc = attr.ib(init=False)
+    desc = attr.ib(init=False)
+    nulls_last = attr.ib(init=False)
+    nulls_first = attr.ib(init=False)
+
+    @asc.default
+    def _(self):
+        return self._sortby_dir != 2
+
+    @desc.default
+    def _(self):
+        return not self.asc
+
+    @nulls_last.default
+    def _(self):
+        if self._sortby_nulls == 0:
+            return self.asc
+        return self._sortby_nulls == 2
+
+    @nulls_first.default
+    def _(self):
+        return not self.nulls_last
+
+
+@attr.s(eq=False, order=False)
+class SortByKey:
+    strat = attr.ib()
+    value = attr.ib()
+
+    def _cmp_compatible(self, other):
+        """
+        Return if `self` is comparable to `other`.
+        """
+        return (
+            type(other) == type(self)
+            and self.strat == other.strat
+        )
+
+    def __lt__(self, other):
+        if not self._cmp_compatible(other):
+            return NotImplemented
+        if self.value == other.value:
+            return False
+        if self.value is None:
+            return self.strat.nulls_first
+        if other.value is None:
+            return self.strat.nulls_last
+        return (self.value < other.value) == self.strat.asc
 
     def __eq__(self, other):
         if not self._cmp_compatible(other):
@@ -246,487 +1424,4632 @@ class SortByKey:
         return self.value == other.value
 
 
-@attr.s(frozen=True, slots=True)
-class PgType:
-    converter = attr.ib()
-    description = attr.ib()
+# Constraint types, numbered as in libpg_query's ConstrType.
+CONSTR_NOTNULL = 1
+CONSTR_DEFAULT = 2
+CONSTR_PRIMARY = 4
+
+# TransactionStmtKind
+TRANS_STMT_BEGIN = 0
+TRANS_STMT_START = 1
+TRANS_STMT_COMMIT = 2
+TRANS_STMT_ROLLBACK = 3
+
+# VariableSetKind
+VAR_SET_VALUE = 0
+VAR_SET_DEFAULT = 1
+VAR_SET_CURRENT = 2
+VAR_SET_MULTI = 3
+VAR_RESET = 4
+VAR_RESET_ALL = 5
+
+# DiscardMode
+DISCARD_ALL = 0
+DISCARD_SEQUENCES = 2
+
+# SubLinkType
+EXISTS_SUBLINK = 0
+ALL_SUBLINK = 1
+ANY_SUBLINK = 2
+EXPR_SUBLINK = 4
+ARRAY_SUBLINK = 6
+
+# SetOperation
+SETOP_NONE = 0
+SETOP_UNION = 1
+SETOP_INTERSECT = 2
+SETOP_EXCEPT = 3
+_SETOP_NAMES = {SETOP_UNION: 'UNION', SETOP_INTERSECT: 'INTERSECT', SETOP_EXCEPT: 'EXCEPT'}
+
+# A_Expr_Kind
+AEXPR_OP = 0
+
+# JoinType
+_JOIN_TYPE_NAMES = {0: 'INNER', 1: 'LEFT', 2: 'FULL', 3: 'RIGHT'}
+
+# CTEMaterialize
+CTE_MATERIALIZE_DEFAULT = 0
+CTE_MATERIALIZE_ALWAYS = 1
+CTE_MATERIALIZE_NEVER = 2
+
+# ObjectType
+OBJECT_MATVIEW = 22
+OBJECT_TABLE = 32
+
+# VacuumOption bits
+VACOPT_VACUUM = 0x1
+VACOPT_ANALYZE = 0x2
+VACOPT_VERBOSE = 0x4
+VACOPT_FULL = 0x10
+
+# WindowDef frame_options bits
+FRAMEOPTION_NONDEFAULT = 0x1
+FRAMEOPTION_RANGE = 0x2
+FRAMEOPTION_ROWS = 0x4
+FRAMEOPTION_BETWEEN = 0x8
+FRAMEOPTION_START_UNBOUNDED_PRECEDING = 0x10
+FRAMEOPTION_END_UNBOUNDED_FOLLOWING = 0x80
+FRAMEOPTION_END_CURRENT_ROW = 0x200
+
+# Run-time settings every session starts with. SET and RESET only touch the session.
+DEFAULT_SETTINGS = {
+    'application_name': '',
+    'client_encoding': 'UTF8',
+    'DateStyle': 'ISO, MDY',
+    # How many most common values and histogram buckets ANALYZE keeps per column.
+    'default_statistics_target': '100',
+    'enable_hashjoin': 'on',
+    'enable_mergejoin': 'on',
+    # FROM lists longer than this are joined in the order they're written.
+    'from_collapse_limit': '8',
+    'integer_datetimes': 'on',
+    'IntervalStyle': 'postgres',
+    'is_superuser': 'on',
+    # Milliseconds, or a number with a unit. -1 logs no statements, 0 all of them.
+    'log_min_duration_statement': '-1',
+    'search_path': '"$user", public',
+    # Milliseconds, or a number with a unit. 0 lets statements run as long as they like.
+    'statement_timeout': '0',
+    'server_encoding': 'UTF8',
+    'server_version': '9.5.0',
+    'standard_conforming_strings': 'on',
+    'TimeZone': 'UTC',
+    'work_mem': '4MB',
+}
+_SETTING_NAMES = {name.lower(): name for name in DEFAULT_SETTINGS}
+
+# Pseudo-types that CREATE TABLE rewrites to an integer type plus a default.
+SERIAL_TYPES = {
+    'smallserial': 'int2',
+    'serial2': 'int2',
+    'serial': 'int4',
+    'serial4': 'int4',
+    'bigserial': 'int8',
+    'serial8': 'int8',
+}
+
+
+def _average(state):
+    total, count = state
+    if not count:
+        return None
+    if isinstance(total, int):
+        return decimal.Decimal(total) / count
+    return total / count
+
+
+def _append(values, value):
+    values.append(value)
+    return values
+
+
+def _row_number(rows, peers, args):
+    return range(1, len(rows) + 1)
+
+
+def _rank(rows, peers, args):
+    ranks = []
+    for position, peer in enumerate(peers):
+        if not position or peer != peers[position - 1]:
+            rank = position + 1
+        ranks.append(rank)
+    return ranks
+
+
+def _dense_rank(rows, peers, args):
+    return [peer + 1 for peer in peers]
+
+
+def _offset_value(direction):
+    """
+    lag() and lead(): the value from `offset` rows behind or ahead, or
+    `default` if that's outside the partition.
+    """
+    def evaluate(rows, peers, args):
+        value, offset, default = [*args, None, None][:3]
+        values = [value.eval(row) for row in rows]
+        results = []
+        for position, row in enumerate(rows):
+            distance = 1 if offset is None else offset.eval(row)
+            if distance is None:
+                results.append(None)
+                continue
+            target = position + direction * distance
+            if 0 <= target < len(rows):
+                results.append(values[target])
+            else:
+                results.append(None if default is None else default.eval(row))
+        return results
+    return evaluate
+
+
+def _nextval(name):
+    if name is None:
+        return None
+    session = _current_session.get()
+    values = session.next_values(session.resolve_sequence(name), 1)
+    return values[0]
+
+
+def _currval(name):
+    if name is None:
+        return None
+    session = _current_session.get()
+    return session.currval(session.resolve_sequence(name))
+
+
+def _pg_stat_statements_reset():
+    _current_session.get()._get_statement_stats().reset()
+
+
+def _split_relation_name(name):
+    """
+    (relname, schema name or None) of a relation's name as text.
+    """
+    parts = [
+        part[1:-1].replace('""', '"') if part.startswith('"') else part.lower()
+        for part in name.split('.')
+    ]
+    if len(parts) > 2:
+        raise exc.FeatureNotSupportedError(f"cross-database references are not implemented: {name}")
+    relname, *schema_name = parts[::-1]
+    return relname, schema_name[0] if schema_name else None
+
+
+def _pg_relation_size(name):
+    if name is None:
+        return None
+    return _current_session.get().resolve_relation(name).relation_size()
+
+
+def _pg_total_relation_size(name):
+    if name is None:
+        return None
+    return _current_session.get().resolve_relation(name).total_relation_size()
+
+
+def _pg_database_size(name):
+    if name is None:
+        return None
+    # There's only the one database to size.
+    return _current_session.get()._db.database_size()
+
+
+def pg_size_pretty(size):
+    """
+    `size` bytes in the largest unit that keeps at least two digits, like postgres does.
+    """
+    if size is None:
+        return None
+    limit = 10 * 1024
+    if abs(size) < limit:
+        return f"{size} bytes"
+    # One bit more than needed, to round to the nearest unit with.
+    size >>= 9
+    for unit in ('kB', 'MB', 'GB', 'TB'):
+        if abs(size) < limit * 2 - 1 or unit == 'TB':
+            break
+        size >>= 10
+    sign = -1 if size < 0 else 1
+    return f"{sign * ((abs(size) + 1) // 2)} {unit}"
+
+
+def _setval(name, value, is_called=True):
+    if name is None or value is None or is_called is None:
+        return None
+    session = _current_session.get()
+    session.setval(session.resolve_sequence(name), value, is_called)
+    return value
+
+
+def create_pg_catalog():
+    def pg_integer(value):
+        # Rounded half away from zero, like postgres, where int() would truncate.
+        if isinstance(value, (float, decimal.Decimal)):
+            return int(decimal.Decimal(value).to_integral_value(rounding=decimal.ROUND_HALF_UP))
+        return int(value)
+
+    integer = PgType(
+        converter=pg_integer,
+        description="-2 billion to 2 billion integer, 4-byte storage",  # TODO: ha ha ha
+        name='integer',
+    )
+    smallint = PgType(
+        converter=pg_integer,
+        description="-32 thousand to 32 thousand, 2-byte storage",
+        name='smallint',
+    )
+    bigint = PgType(
+        converter=pg_integer,
+        description="~18 digit integer, 8-byte storage",
+        name='bigint',
+    )
+
+    def pg_bool(value):
+        if value is None:
+            return None
+        if value in ('t', 'f'):
+            return value == 't'
+        if isinstance(value, str):
+            original = value
+            value = value.strip().lower()
+            if value:
+                if 'true'.startswith(value):
+                    return True
+                if 'false'.startswith(value):
+                    return False
+            raise exc.InvalidTextRepresentationError(
+                f"invalid input syntax for type boolean: {original!r}"
+            )
+        if isinstance(value, int):
+            return bool(value)
+        raise NotImplementedError(type(value))
+
+
+    def pg_text(value):
+        if value is None or isinstance(value, str):
+            return value
+        if value in (True, False):
+            return str(value).lower()
+        return str(value)
+
+
+    return Schema(
+        functions={
+            'length': Function(fn=len),
+            'nextval': Function(fn=_nextval, volatile=True),
+            'currval': Function(fn=_currval, volatile=True),
+            'setval': Function(fn=_setval, volatile=True),
+            'pg_stat_statements_reset': Function(fn=_pg_stat_statements_reset, volatile=True),
+            'pg_relation_size': Function(fn=_pg_relation_size, volatile=True),
+            'pg_total_relation_size': Function(fn=_pg_total_relation_size, volatile=True),
+            'pg_database_size': Function(fn=_pg_database_size, volatile=True),
+            'pg_size_pretty': Function(fn=pg_size_pretty),
+            'count': Aggregate(
+                init=lambda: 0,
+                step=lambda count, value: count + 1,
+                return_type='int8',
+            ),
+            'sum': Aggregate(
+                init=lambda: None,
+                step=lambda total, value: value if total is None else total + value,
+                return_type='anyelement',
+            ),
+            'min': Aggregate(
+                init=lambda: None,
+                step=lambda low, value: value if low is None or value < low else low,
+                return_type='anyelement',
+            ),
+            'max': Aggregate(
+                init=lambda: None,
+                step=lambda high, value: value if high is None or value > high else high,
+                return_type='anyelement',
+            ),
+            'avg': Aggregate(
+                init=lambda: (0, 0),
+                step=lambda state, value: (state[0] + value, state[1] + 1),
+                final=_average,
+                return_type='numeric',
+            ),
+            'array_agg': Aggregate(
+                init=list,
+                step=_append,
+                final=list,
+                strict=False,
+            ),
+            'bool_and': Aggregate(
+                init=lambda: None,
+                step=lambda result, value: value if result is None else result and value,
+                return_type='bool',
+            ),
+            'bool_or': Aggregate(
+                init=lambda: None,
+                step=lambda result, value: value if result is None else result or value,
+                return_type='bool',
+            ),
+            'row_number': WindowFunction(evaluate=_row_number, return_type='int8'),
+            'rank': WindowFunction(evaluate=_rank, return_type='int8'),
+            'dense_rank': WindowFunction(evaluate=_dense_rank, return_type='int8'),
+            'lag': WindowFunction(
+                evaluate=_offset_value(-1),
+                min_args=1,
+                max_args=3,
+                return_type='anyelement',
+            ),
+            'lead': WindowFunction(
+                evaluate=_offset_value(1),
+                min_args=1,
+                max_args=3,
+                return_type='anyelement',
+            ),
+        },
+        types={
+            'bool': PgType(
+                converter=pg_bool,
+                description="boolean, 'true'/'false'",
+                name='boolean',
+            ),
+            'integer': integer,
+            'int4': integer,
+            'int2': smallint,
+            'int8': bigint,
+            'float4': PgType(
+                converter=float,
+                description="single-precision floating point number, 4-byte storage",
+                name='real',
+            ),
+            'float8': PgType(
+                converter=float,
+                description="double-precision floating point number, 8-byte storage",
+                name='double precision',
+            ),
+            'numeric': PgType(
+                converter=decimal.Decimal,
+                description="numeric(precision, decimal), arbitrary precision number",
+                name='numeric',
+            ),
+            'text': PgType(
+                converter=pg_text,
+                description="variable-length string, no limit specified",
+                name='text',
+            ),
+            'varchar': PgType(
+                converter=pg_text,
+                description="varchar(length), non-blank-padded string, variable storage length",
+                name='character varying',
+            ),
+            # Relations are looked up by name when they're used, so this is only text.
+            'regclass': PgType(
+                converter=pg_text,
+                description="registered class",
+                name='regclass',
+            ),
+        },
+    )
+
+
+PG_CATALOG = create_pg_catalog()
+
+PG_STAT_STATEMENTS_COLUMNS = [
+    ('queryid', 'int8'),
+    ('query', 'text'),
+    ('calls', 'int8'),
+    ('total_time', 'float8'),
+    ('min_time', 'float8'),
+    ('max_time', 'float8'),
+    ('mean_time', 'float8'),
+    ('rows', 'int8'),
+    ('parse_time', 'float8'),
+    ('plan_time', 'float8'),
+    ('exec_time', 'float8'),
+]
+_PG_STAT_STATEMENTS_ROWTYPE = Table.generate_rowtype(
+    [name for name, _ in PG_STAT_STATEMENTS_COLUMNS],
+    column_types={name: PG_CATALOG.types[type_name] for name, type_name in PG_STAT_STATEMENTS_COLUMNS},
+)
+
+# Arrays are written out as text, since there's no array type.
+PG_STATS_COLUMNS = [
+    ('schemaname', 'text'),
+    ('tablename', 'text'),
+    ('attname', 'text'),
+    ('null_frac', 'float4'),
+    ('n_distinct', 'float4'),
+    ('most_common_vals', 'text'),
+    ('most_common_freqs', 'text'),
+    ('histogram_bounds', 'text'),
+]
+
+_PG_STATS_ROWTYPE = Table.generate_rowtype(
+    [name for name, _ in PG_STATS_COLUMNS],
+    column_types={name: PG_CATALOG.types[type_name] for name, type_name in PG_STATS_COLUMNS},
+)
+
+
+def _array_text(values):
+    """
+    `values` written out the way postgres writes an array, or None if there aren't any.
+    """
+    if not values:
+        return None
+    elements = []
+    for value in values:
+        text = _format_result(value)
+        if not text or text.upper() == 'NULL' or any(char in text for char in '{},"\\ '):
+            text = '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        elements.append(text)
+    return '{' + ','.join(elements) + '}'
+
+
+@attr.s(frozen=True, slots=True)
+class Database:
+    schemas = attr.ib(
+        converter=frozendict,
+        default={
+            'public': Schema(),
+            'pg_catalog': PG_CATALOG,
+        },
+    )
+    # {(schema, relname) of a table: ((schema, relname) of each of its incremental views, ...)}
+    views = attr.ib(converter=frozendict, factory=dict)
+
+    def database_size(self):
+        """
+        Bytes of memory taken by every table and sequence, counting what they share once.
+        """
+        counter = _MemoryCounter()
+        return sum(
+            relation.total_relation_size(counter)
+            for schema in self.schemas.values()
+            for relation in itertools.chain(schema.tables.values(), schema.sequences.values())
+        )
+
+    def _get_table(self, relname, schema_name=None):
+        if schema_name is None:
+            # TODO: a real search path
+            search_path = ['public']
+            for schema_name in search_path:
+                schema = self.schemas[schema_name]
+                if relname in schema.tables:
+                    return schema.tables[relname]
+            raise exc.UndefinedTableError(table=relname)
+        try:
+            return self.schemas[schema_name].tables[relname]
+        except KeyError:
+            raise exc.UndefinedTableError(table=f"{schema_name}.{relname}") from None
+
+    def _find_table(self, relname, schema_name=None):
+        """
+        Look up a table like `_get_table`, but return None if it doesn't exist.
+        """
+        try:
+            return self._get_table(relname, schema_name)
+        except exc.UndefinedTableError:
+            return None
+
+    def _get_sequence(self, relname, schema_name=None):
+        schema_names = ['public'] if schema_name is None else [schema_name]
+        for name in schema_names:
+            schema = self.schemas.get(name)
+            if schema is None:
+                continue
+            if relname in schema.sequences:
+                return schema.sequences[relname]
+            if relname in schema.tables:
+                raise exc.WrongObjectTypeError(f'"{relname}" is not a sequence')
+        display_name = relname if schema_name is None else f"{schema_name}.{relname}"
+        raise exc.UndefinedTableError(table=display_name)
+
+    def _relation_exists(self, relname, schema_name):
+        schema = self.schemas.get(schema_name)
+        return schema is not None and (relname in schema.tables or relname in schema.sequences)
+
+    def create_table(self, table):
+        return self._update_table(table)
+
+    def create_sequence(self, sequence):
+        schemas = dict(self.schemas)
+        schema = schemas.get(sequence.schema) or Schema()
+        sequences = dict(schema.sequences)
+        sequences[sequence.relname] = sequence
+        schemas[sequence.schema] = attr.evolve(schema, sequences=sequences)
+        return attr.evolve(self, schemas=schemas)
+
+    def update_table(self, table):
+        """
+        Replace a table, bringing its incremental views up to date.
+        """
+        old_table = self._find_table(table.relname, table.schema)
+        db = self._update_table(table)
+        if old_table is None or table.rows is old_table.rows:
+            return db
+        changes = False
+        for schema_name, relname in self.views.get((table.schema, table.relname), ()):
+            view_table = self.schemas[schema_name].tables[relname]
+            incremental = view_table.view.incremental
+            if changes is False:
+                changes = table.rows.changes_since(old_table.rows)
+            if changes is None or changes.deleted:
+                view_table = incremental.rebuild(view_table, table.rows)
+            elif changes.appended:
+                view_table = (
+                    incremental.apply(view_table, changes.appended)
+                    or incremental.rebuild(view_table, table.rows)
+                )
+            db = db._update_table(view_table)
+        return db
+
+    def _update_table(self, table):
+        schemas = dict(self.schemas)
+        schema = schemas.get(table.schema)
+        # TODO: this should be an error, but danged if it doesn't make testing easier.
+        if not schema:
+            schema = Schema()
+        old_base = _incremental_base(schema.tables.get(table.relname))
+        new_base = _incremental_base(table)
+        views = self.views
+        if old_base != new_base:
+            name = (table.schema, table.relname)
+            views = dict(views)
+            if old_base is not None:
+                views[old_base] = tuple([view for view in views[old_base] if view != name])
+            if new_base is not None:
+                views[new_base] = views.get(new_base, ()) + (name,)
+        tables = dict(schema.tables)
+        tables[table.relname] = table
+        schemas[table.schema] = attr.evolve(schema, tables=tables)
+        return Database(schemas=schemas, views=views)
+
+    def parse_select_expr(self, expr, sources=None):
+        expr_type = type(expr).__name__
+        expr_method = {
+            'AConst': lambda expr, sources: Constant(expr.val.val),
+            'ColumnRef': self._parse_select_column_ref,
+            'AExpr': self._parse_select_aexpr,
+            'BoolExpr': self._parse_select_boolexpr,
+            'TypeCast': self._parse_select_typecast,
+            'FuncCall': self._parse_select_funccall,
+            'ParamRef': self._parse_select_paramref,
+            'SubLink': self._parse_select_sublink,
+        }.get(expr_type)
+        if not expr_method:
+            raise NotImplementedError(expr_type)
+        grouping = sources.grouping if sources is not None else None
+        if grouping is not None and grouping.is_key(expr):
+            # Columns inside a GROUP BY expression don't need grouping themselves.
+            with grouping.grouped_expression():
+                return expr_method(expr=expr, sources=sources)
+        return expr_method(expr=expr, sources=sources)
+
+    def _parse_select_column_ref(self, expr, sources):
+        last = expr.fields[-1]
+        if isinstance(last, psqlparse.nodes.AStar):
+            raise NotImplementedError("star select is not implemented")
+        column = last.str
+        column_ref = [piece.str for piece in expr.fields[::-1]]
+        scope = sources.scope if sources is not None else None
+        if scope is not None and scope.substitutions:
+            substitute = scope.substitutions.get(tuple(column_ref))
+            if substitute is not None:
+                with scope.substituting(None):
+                    return self.parse_select_expr(substitute, sources)
+        # Columns not found here are looked up in enclosing queries, innermost first.
+        depth = 0
+        level = sources
+        while True:
+            try:
+                column_source = level.get_column_source(*column_ref)
+                break
+            except (exc.UndefinedColumnError, exc.UndefinedTableError) as error:
+                if level is sources:
+                    missing = error
+                scope = level.scope
+                if scope is None or scope.outer is None:
+                    raise missing from None
+                if not scope.allow_outer:
+                    raise exc.FeatureNotSupportedError(
+                        "JOIN conditions in subqueries can't refer to enclosing queries"
+                    ) from None
+                scope.correlated = True
+                level = scope.outer
+                depth += 1
+        table, _ = column_source
+        if column in table.rowtype.ambiguous:
+            raise exc.AmbiguousColumnError(f"column reference {column!r} is ambiguous")
+        if level.grouping is not None:
+            level.grouping.check_column(column_source, column)
+        if depth:
+            return Element(
+                lambda row: _outer_rows.get()[-depth][column_source][column],
+                name=column,
+                pgtype=table.rowtype.column_types.get(column),
+            )
+        return Element(
+            lambda row: row[column_source][column],
+            name=column,
+            pgtype=table.rowtype.column_types.get(column),
+        )
+
+    def _parse_select_paramref(self, expr, sources):
+        del sources
+        number = expr.number
+        return Element(lambda row: _get_param(number))
+
+    def _parse_select_aexpr(self, expr, sources):
+        if expr.lexpr is None:
+            return self._parse_prefix_aexpr(expr, sources)
+        if expr.rexpr is None:
+            return self._parse_postfix_aexpr(expr, sources)
+        return self._parse_binary_aexpr(expr, sources)
+
+    def _parse_select_boolexpr(self, expr, sources):
+        # TODO: might wanna emulate postgres's strict boolean typechecking
+        bool_fn = {
+            0: self._parse_bool_and,
+            1: self._parse_bool_or,
+            2: self._parse_bool_not,
+        }[expr.boolop]
+        return bool_fn(expr, sources)
+
+    def _parse_bool_and(self, expr, sources):
+        left, right = expr.args
+        left_element = self.parse_select_expr(left, sources)
+        right_element = self.parse_select_expr(right, sources)
+        return Element(lambda row: left_element.eval(row) and right_element.eval(row))
+
+    def _parse_bool_or(self, expr, sources):
+        left, right = expr.args
+        left_element = self.parse_select_expr(left, sources)
+        right_element = self.parse_select_expr(right, sources)
+        return Element(lambda row: left_element.eval(row) or right_element.eval(row))
+
+    def _parse_bool_not(self, expr, sources):
+        [subexpr] = expr.args
+        element = self.parse_select_expr(subexpr, sources)
+
+        def negate(row):
+            value = element.eval(row)
+            # NOT NULL is NULL, so x NOT IN (...) is NULL when x IN (...) is.
+            return None if value is None else not value
+
+        return Element(negate)
+
+    def _parse_prefix_aexpr(self, expr, sources):
+        right_element = self.parse_select_expr(expr.rexpr, sources)
+        operation = _get_prefix_aexpr_op(expr.name[0].val)
+        return Element(lambda row: operation(right_element.eval(row)))
+
+    def _parse_postfix_aexpr(self, expr, sources):
+        left_element = self.parse_select_expr(expr.lexpr, sources)
+        operation = _get_postfix_aexpr_op(expr.name[0].val)
+        return Element(lambda row: operation(left_element.eval(row)))
+
+    def _parse_binary_aexpr(self, expr, sources):
+        left_element = self.parse_select_expr(expr.lexpr, sources)
+        right_element = self.parse_select_expr(expr.rexpr, sources)
+        left_element = self._typed_operand(expr.lexpr, left_element, right_element.pgtype)
+        right_element = self._typed_operand(expr.rexpr, right_element, left_element.pgtype)
+        symbol = expr.name[0].val
+        operation = _get_binary_aexpr_op(symbol)
+        if symbol not in _COMMUTED_OPERATORS:
+            return Element(lambda row: operation(left_element.eval(row), right_element.eval(row)))
+
+        def compare(row):
+            left, right = left_element.eval(row), right_element.eval(row)
+            # Comparing with NULL is NULL, like an empty scalar subquery.
+            if left is None or right is None:
+                return None
+            return operation(left, right)
+
+        return Element(compare)
+
+    @staticmethod
+    def _typed_operand(node, element, pgtype):
+        """
+        Treat a `$n` parameter operand as the `pgtype` of the other operand.
+
+        Like postgres's parameters of unknown type, string values, which is
+        how clients send parameters without a type, are converted to it.
+        """
+        if not isinstance(node, psqlparse.nodes.ParamRef) or pgtype is None:
+            return element
+        _note_param_type(node, pgtype)
+        converter = pgtype.converter
+
+        def coerce(row):
+            value = element.eval(row)
+            if not isinstance(value, str):
+                return value
+            try:
+                return converter(value)
+            except (ValueError, ArithmeticError):
+                raise exc.InvalidTextRepresentationError(
+                    f'invalid input syntax for type {pgtype.name}: "{value}"'
+                ) from None
+        return Element(coerce, pgtype=pgtype)
+
+    def _parse_select_typecast(self, expr, sources):
+        verify_implemented(expr, ['arg', 'type_name'])
+        verify_implemented(
+            expr.type_name,
+            ['names'],
+            # I don't really understand what typemod is.
+            # https://doxygen.postgresql.org/format__type_8c_source.html
+            expected_values={'typemod': -1},
+        )
+        type_name = expr.type_name.names[-1].str
+        type_ref = [name.str for name in expr.type_name.names[::-1]]
+        pgtype = self._get_type(*type_ref)
+        elem = self.parse_select_expr(expr.arg, sources)
+        _note_param_type(expr.arg, pgtype)
+        return Element(
+            lambda row: pgtype.converter(elem.eval(row)),
+            name=type_name,
+            pgtype=pgtype,
+        )
+
+    def _parse_select_funccall(self, expr, sources):
+        func_ref = [piece.str for piece in expr.funcname[::-1]]
+        func = self._get_function(*func_ref)
+        if expr.over is not None:
+            return self._parse_window_call(expr, func, sources)
+        if isinstance(func, WindowFunction):
+            raise exc.WindowingError(f"window function {expr.funcname[-1].str} requires an OVER clause")
+        if isinstance(func, Aggregate):
+            return self._parse_aggregate_call(expr, func, sources)
+        args = [self.parse_select_expr(arg, sources) for arg in expr.args or ()]
+        return Element(
+            lambda row: func.fn(*(arg.eval(row) for arg in args)),
+            name=expr.funcname[-1].str,
+        )
+
+    def _parse_aggregate_call(self, expr, aggregate, sources):
+        verify_implemented(expr, ['funcname', 'args', 'agg_star', 'agg_distinct'])
+        name = expr.funcname[-1].str
+        grouping = sources.grouping if sources is not None else None
+        if grouping is None:
+            raise exc.GroupingError("aggregate functions are not allowed here")
+        if grouping.in_aggregate:
+            raise exc.GroupingError("aggregate function calls cannot be nested")
+        arg = None
+        if not expr.agg_star:
+            args = expr.args or []
+            if len(args) != 1:
+                raise exc.UndefinedFunctionError(f"function {name}() does not exist")
+            with grouping.aggregate_arguments():
+                arg = self.parse_select_expr(args[0], sources)
+
+        index = grouping.add_aggregate(
+            AggregateCall(aggregate=aggregate, arg=arg, distinct=bool(expr.agg_distinct))
+        )
+        if aggregate.return_type == 'anyelement':
+            pgtype = arg.pgtype if arg is not None else None
+        else:
+            pgtype = self._get_schema('pg_catalog').types.get(aggregate.return_type)
+        return Element(lambda row: row[_AGGREGATE_VALUES][index], name=name, pgtype=pgtype)
+
+    def _parse_window_call(self, expr, func, sources):
+        verify_implemented(expr, ['funcname', 'args', 'agg_star', 'agg_distinct', 'over'])
+        name = expr.funcname[-1].str
+        windowing = sources.windowing if sources is not None else None
+        if windowing is None:
+            raise exc.WindowingError("window functions are not allowed here")
+        if sources.grouping is not None and sources.grouping.in_aggregate:
+            raise exc.GroupingError("aggregate function calls cannot contain window function calls")
+        if expr.agg_distinct:
+            raise exc.FeatureNotSupportedError("DISTINCT is not implemented for window functions")
+        # Arguments and window clauses can't have window calls of their own.
+        inner_sources = attr.evolve(sources, windowing=None)
+        args = [self.parse_select_expr(arg, inner_sources) for arg in expr.args or ()]
+        partition_clause, order_clause, frame_options = windowing.resolve(expr.over)
+
+        if isinstance(func, WindowFunction):
+            if expr.agg_star or not func.min_args <= len(args) <= func.max_args:
+                raise exc.UndefinedFunctionError(f"function {name}() does not exist")
+            call = WindowCall(function=func, args=args)
+            return_type = func.return_type
+        elif isinstance(func, Aggregate):
+            if not expr.agg_star and len(args) != 1:
+                raise exc.UndefinedFunctionError(f"function {name}() does not exist")
+            supported = (
+                FRAMEOPTION_NONDEFAULT | FRAMEOPTION_RANGE | FRAMEOPTION_ROWS | FRAMEOPTION_BETWEEN
+                | FRAMEOPTION_START_UNBOUNDED_PRECEDING
+                | FRAMEOPTION_END_CURRENT_ROW | FRAMEOPTION_END_UNBOUNDED_FOLLOWING
+            )
+            if frame_options & ~supported or not frame_options & FRAMEOPTION_START_UNBOUNDED_PRECEDING:
+                raise exc.FeatureNotSupportedError(
+                    "window frames must run from UNBOUNDED PRECEDING to CURRENT ROW or UNBOUNDED FOLLOWING"
+                )
+            call = WindowAggregateCall(
+                call=AggregateCall(aggregate=func, arg=None if expr.agg_star else args[0]),
+                running=bool(frame_options & FRAMEOPTION_END_CURRENT_ROW),
+                with_peers=not frame_options & FRAMEOPTION_ROWS,
+            )
+            return_type = func.return_type
+        else:
+            raise exc.WrongObjectTypeError(
+                f"OVER specified, but {name} is not a window function nor an aggregate function"
+            )
+
+        index = windowing.add_call(
+            partition_clause,
+            order_clause,
+            call,
+            lambda: self._compile_window(partition_clause, order_clause, inner_sources),
+        )
+        if return_type == 'anyelement':
+            pgtype = args[0].pgtype if args else None
+        else:
+            pgtype = self._get_schema('pg_catalog').types.get(return_type)
+        return Element(lambda row: row[_WINDOW_VALUES][index], name=name, pgtype=pgtype)
+
+    def _compile_window(self, partition_clause, order_clause, sources):
+        return Window(
+            partition=[self.parse_select_expr(expr, sources) for expr in partition_clause or ()],
+            order=[
+                (
+                    SortByStrategy(sortby_dir=expr.sortby_dir, sortby_nulls=expr.sortby_nulls),
+                    self.parse_select_expr(expr.node, sources),
+                )
+                for expr in order_clause or ()
+            ],
+        )
+
+    def _parse_select_sublink(self, expr, sources):
+        verify_implemented(expr, ['sub_link_type', 'testexpr', 'oper_name', 'subselect'])
+        scope = sources.scope if sources is not None else None
+        if scope is None:
+            raise NotImplementedError("subqueries aren't supported here")
+        plan = scope.compile_subquery(expr.subselect, sources)
+        kind = expr.sub_link_type
+        bool_type = self._get_type('bool', 'pg_catalog')
+        if kind == EXISTS_SUBLINK:
+            # Stops at the first row.
+            exists = plan.evaluator(lambda rows: next(rows, None) is not None)
+            return Element(exists, name='exists', pgtype=bool_type)
+
+        if len(plan.names) != 1:
+            raise exc.PostgresSyntaxError("subquery must return only one column")
+        if kind == EXPR_SUBLINK:
+            return Element(
+                plan.evaluator(_scalar_subquery_value),
+                name=plan.names[0],
+                pgtype=plan.row_types[0],
+            )
+        if kind == ARRAY_SUBLINK:
+            return Element(plan.evaluator(lambda rows: [value for value, in rows]), name='array')
+        if kind not in (ANY_SUBLINK, ALL_SUBLINK):
+            raise NotImplementedError(f"subquery type {kind}")
+
+        test = self.parse_select_expr(expr.testexpr, sources)
+        # Newer parsers leave the operator out of `IN (subquery)`.
+        symbol = expr.oper_name[-1].val if expr.oper_name else '='
+        values = plan.evaluator(SubqueryValues)
+        if kind == ANY_SUBLINK and symbol == '=':
+            return Element(lambda row: values(row).contains(test.eval(row)), pgtype=bool_type)
+        operation = _get_binary_aexpr_op(symbol)
+        require_all = kind == ALL_SUBLINK
+        return Element(
+            lambda row: values(row).compare(operation, test.eval(row), require_all=require_all),
+            pgtype=bool_type,
+        )
+
+    def _get_schema(self, schema_name):
+        if schema_name not in self.schemas:
+            raise exc.InvalidSchemaNameError(f"schema {schema_name!r} does not exist")
+        return self.schemas[schema_name]
+
+    def _get_function(self, func_name, schema_name=None):
+        if schema_name is None:
+            display_name = func_name
+            schema_name = 'pg_catalog'
+        else:
+            display_name = f"{schema_name}.{func_name}"
+
+        schema = self._get_schema(schema_name)
+        if func_name not in schema.functions:
+            raise exc.UndefinedFunctionError(
+                f"function {display_name}() does not exist"
+            )
+        return schema.functions[func_name]
+
+    def _get_type(self, type_name, schema_name=None):
+        if schema_name is None:
+            display_name = type_name
+            schema_name = 'pg_catalog'
+        else:
+            display_name = f"{schema_name}.{type_name}"
+        schema = self._get_schema(schema_name)
+        if type_name not in schema.types:
+            raise exc.UndefinedObjectError(f'type "{display_name}" does not exist')
+        return schema.types[type_name]
+
+
+# Key of a grouped row's aggregate results, alongside its tables' rows.
+_AGGREGATE_VALUES = object()
+# Key of a row's window call results.
+_WINDOW_VALUES = object()
+
+
+@attr.s(frozen=True, slots=True)
+class AggregateCall:
+    aggregate = attr.ib()
+    # Element for the argument, or None for `agg(*)`.
+    arg = attr.ib()
+    distinct = attr.ib(default=False)
+
+    def init(self):
+        state = self.aggregate.init()
+        return (set(), state) if self.distinct else state
+
+    def step(self, state, row):
+        if self.arg is None:
+            return self.aggregate.step(state, None)
+        value = self.arg.eval(row)
+        if value is None and self.aggregate.strict:
+            return state
+        if self.distinct:
+            seen, inner = state
+            if value in seen:
+                return state
+            seen.add(value)
+            return seen, self.aggregate.step(inner, value)
+        return self.aggregate.step(state, value)
+
+    def final(self, state):
+        if self.distinct:
+            _, state = state
+        if self.aggregate.final is None:
+            return state
+        return self.aggregate.final(state)
+
+
+class Grouping:
+    """
+    GROUP BY keys and aggregate calls of a SELECT.
+
+    Aggregate calls are collected as the target list and HAVING clause are
+    parsed, along with any column references that aren't grouped.
+    """
+    def __init__(self, *, has_having=False):
+        self.keys = []
+        self.aggregates = []
+        self.has_having = has_having
+        self._key_fingerprints = set()
+        self._key_columns = set()
+        self._ungrouped_columns = []
+        # Depth of aggregate arguments and grouped expressions being parsed.
+        self._exempt = 0
+        self._in_aggregate = False
+
+    def add_key(self, expr, element, column_key=None):
+        self.keys.append(element)
+        self._key_fingerprints.add(fingerprint(expr).key)
+        if column_key is not None:
+            self._key_columns.add(column_key)
+
+    def is_key(self, expr):
+        return bool(self._key_fingerprints) and fingerprint(expr).key in self._key_fingerprints
+
+    @contextlib.contextmanager
+    def grouped_expression(self):
+        self._exempt += 1
+        try:
+            yield
+        finally:
+            self._exempt -= 1
+
+    @property
+    def in_aggregate(self):
+        return self._in_aggregate
+
+    @contextlib.contextmanager
+    def aggregate_arguments(self):
+        self._in_aggregate = True
+        try:
+            with self.grouped_expression():
+                yield
+        finally:
+            self._in_aggregate = False
+
+    def add_aggregate(self, call):
+        self.aggregates.append(call)
+        return len(self.aggregates) - 1
+
+    def check_column(self, column_source, column):
+        if not self._exempt and (column_source, column) not in self._key_columns:
+            self._ungrouped_columns.append((column_source, column))
+
+    @property
+    def active(self):
+        return bool(self.keys or self.aggregates or self.has_having)
+
+    def verify(self):
+        for (table, alias), column in self._ungrouped_columns:
+            raise exc.GroupingError(
+                f'column "{alias or table.relname}.{column}" must appear in the GROUP BY clause '
+                "or be used in an aggregate function"
+            )
+
+    def accumulate(self, groups, rows, touched=None):
+        """
+        Fold rows into `groups`, a {group key: (first row, states)} dict, in place.
+
+        If `touched` is a dict, the keys of the groups rows fall into are added
+        to it, in the order they're first touched.
+        """
+        keys = self.keys
+        calls = self.aggregates
+        for row in rows:
+            key = tuple([key.eval(row) for key in keys])
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = (row, [call.init() for call in calls])
+            if touched is not None:
+                touched[key] = None
+            states = group[1]
+            for index, call in enumerate(calls):
+                states[index] = call.step(states[index], row)
+
+    def empty_group(self, null_row):
+        """
+        The one group of an ungrouped aggregate over no rows, if there is one.
+        """
+        if self.keys:
+            return None
+        return (null_row, [call.init() for call in self.aggregates])
+
+    def group_row(self, first_row, states):
+        return {
+            **first_row,
+            _AGGREGATE_VALUES: tuple([
+                call.final(state)
+                for call, state in zip(self.aggregates, states)
+            ]),
+        }
+
+    def run(self, rows, null_row):
+        groups = {}
+        self.accumulate(groups, rows)
+        if not groups:
+            empty = self.empty_group(null_row)
+            if empty is not None:
+                groups[()] = empty
+        return [self.group_row(*group) for group in groups.values()]
+
+
+@attr.s(frozen=True, slots=True)
+class WindowCall:
+    function = attr.ib()
+    args = attr.ib()
+
+    def evaluate(self, rows, peers):
+        return self.function.evaluate(rows, peers, self.args)
+
+
+@attr.s(frozen=True, slots=True)
+class WindowAggregateCall:
+    """
+    An aggregate over a frame starting at the beginning of the partition.
+
+    Frames ending at the current row keep a running state, folding in each
+    row once instead of folding the whole frame again for every row.
+    """
+    call = attr.ib()
+    # Whether the frame ends at the current row, rather than the end of the partition.
+    running = attr.ib()
+    # Whether the frame takes in the current row's peers, as RANGE frames do.
+    with_peers = attr.ib()
+
+    def evaluate(self, rows, peers):
+        call = self.call
+        state = call.init()
+        if not self.running:
+            for row in rows:
+                state = call.step(state, row)
+            return [call.final(state)] * len(rows)
+        results = []
+        if not self.with_peers:
+            for row in rows:
+                state = call.step(state, row)
+                results.append(call.final(state))
+            return results
+        start = 0
+        for _, group in itertools.groupby(peers):
+            end = start + len(list(group))
+            for row in rows[start:end]:
+                state = call.step(state, row)
+            results.extend([call.final(state)] * (end - start))
+            start = end
+        return results
+
+
+@attr.s(slots=True)
+class Window:
+    """
+    A PARTITION BY and ORDER BY, and the window calls over them.
+    """
+    # Elements.
+    partition = attr.ib()
+    # (SortByStrategy, Element) pairs.
+    order = attr.ib()
+    # (index of the result, call) pairs.
+    calls = attr.ib(factory=list)
+
+    def run(self, rows, positions, results):
+        """
+        Sort `positions` into `rows` by partition and order, then fill in
+        `results` for each call, one partition at a time.
+        """
+        partition_keys = [tuple([element.eval(row) for element in self.partition]) for row in rows]
+        order_keys = [tuple([element.eval(row) for _, element in self.order]) for row in rows]
+        partition_strat = SortByStrategy(sortby_dir=0, sortby_nulls=0)
+        positions.sort(key=lambda position: (
+            *(SortByKey(strat=partition_strat, value=value) for value in partition_keys[position]),
+            *(
+                SortByKey(strat=strat, value=value)
+                for (strat, _), value in zip(self.order, order_keys[position])
+            ),
+        ))
+        for _, partition in itertools.groupby(positions, key=partition_keys.__getitem__):
+            partition = list(partition)
+            peers = []
+            for position, previous in zip(partition, [None, *partition]):
+                if previous is None:
+                    peers.append(0)
+                else:
+                    peers.append(peers[-1] + (order_keys[position] != order_keys[previous]))
+            partition_rows = [rows[position] for position in partition]
+            for index, call in self.calls:
+                for position, value in zip(partition, call.evaluate(partition_rows, peers)):
+                    results[position][index] = value
+
+
+class Windowing:
+    """
+    Window calls of a SELECT, collected as its target list and ORDER BY are parsed.
+
+    Calls over the same PARTITION BY and ORDER BY share a Window, and so a sort.
+    """
+    def __init__(self, window_clause=()):
+        self.definitions = {}
+        for window_def in window_clause:
+            if window_def.name in self.definitions:
+                raise exc.WindowingError(f'window "{window_def.name}" is already defined')
+            self.definitions[window_def.name] = window_def
+        self.windows = {}
+        self.call_count = 0
+
+    def resolve(self, window_def):
+        """
+        The partition clause, order clause and frame options of an OVER clause,
+        following references to the WINDOW clause.
+        """
+        if window_def.name is not None and window_def.refname is None and \
+                window_def.partition_clause is None and window_def.order_clause is None:
+            # A plain `OVER name`.
+            if window_def.name not in self.definitions:
+                raise exc.UndefinedObjectError(f'window "{window_def.name}" does not exist')
+            window_def = self.definitions[window_def.name]
+            if window_def.refname is None:
+                return window_def.partition_clause, window_def.order_clause, window_def.frame_options
+        if window_def.refname is None:
+            return window_def.partition_clause, window_def.order_clause, window_def.frame_options
+        if window_def.refname not in self.definitions:
+            raise exc.UndefinedObjectError(f'window "{window_def.refname}" does not exist')
+        partition_clause, order_clause, frame_options = self.resolve(self.definitions[window_def.refname])
+        if window_def.partition_clause is not None:
+            raise exc.WindowingError(f'cannot override PARTITION BY clause of window "{window_def.refname}"')
+        if window_def.order_clause is not None:
+            if order_clause is not None:
+                raise exc.WindowingError(f'cannot override ORDER BY clause of window "{window_def.refname}"')
+            order_clause = window_def.order_clause
+        if frame_options & FRAMEOPTION_NONDEFAULT:
+            raise exc.WindowingError(f'cannot copy window "{window_def.refname}" because it has a frame clause')
+        return partition_clause, order_clause, window_def.frame_options
+
+    def add_call(self, partition_clause, order_clause, call, compile_window):
+        key = fingerprint([partition_clause or [], order_clause or []]).key
+        window = self.windows.get(key)
+        if window is None:
+            window = self.windows[key] = compile_window()
+        index = self.call_count
+        self.call_count += 1
+        window.calls.append((index, call))
+        return index
+
+    @property
+    def active(self):
+        return bool(self.call_count)
+
+    def run(self, rows):
+        """
+        Return `rows` with their window call results added.
+
+        Each window sorts the rows again, so they come out in the order of the last one.
+        """
+        rows = list(rows)
+        results = [[None] * self.call_count for _ in rows]
+        positions = list(range(len(rows)))
+        for window in self.windows.values():
+            window.run(rows, positions, results)
+        return [{**rows[position], _WINDOW_VALUES: tuple(results[position])} for position in positions]
+
+
+@attr.s(frozen=True, slots=True)
+class SelectList:
+    """
+    A SELECT's expressions, compiled against the tables of its FROM clause.
+    """
+    where = attr.ib()
+    # None if the query doesn't group or aggregate.
+    grouping = attr.ib()
+    having = attr.ib()
+    targets = attr.ib()
+    names = attr.ib()
+    # (SortByStrategy, Element) pairs.
+    sort_keys = attr.ib(default=())
+    # Whether this is a SELECT DISTINCT.
+    distinct = attr.ib(default=False)
+    # Elements of a SELECT DISTINCT ON.
+    distinct_on = attr.ib(default=())
+    # None if the query has no window calls.
+    windowing = attr.ib(default=None)
+
+    def filter_and_group(self, rows, *, null_row):
+        if self.where is not None:
+            rows = _trace('Filter', filter(self.where.eval, rows))
+        if self.grouping is not None:
+            rows = _trace('Aggregate', self.grouping.run(_interruptible(rows), null_row))
+            if self.having is not None:
+                rows = _trace('Filter', filter(self.having.eval, rows))
+        if self.windowing is not None:
+            rows = _trace('WindowAgg', self.windowing.run(_interruptible(rows)))
+        return rows
+
+
+@attr.s(slots=True)
+class QueryScope:
+    """
+    What the expressions of one query level can see besides its FROM clause.
+    """
+    # Compiles a subquery found in this level's expressions into a SelectPlan,
+    # given the QueryTables it was found in.
+    compile_subquery = attr.ib()
+    # QueryTables of the enclosing query, for subqueries.
+    outer = attr.ib(default=None)
+    # False while parsing JOIN conditions, which are only evaluated once.
+    allow_outer = attr.ib(default=True)
+    # Set once an expression refers to a column of an enclosing query.
+    correlated = attr.ib(default=False)
+    # {name: CommonTableExpression} of the WITH queries in view.
+    ctes = attr.ib(factory=collections.ChainMap)
+    # {column reference: expression} to parse in place of column references,
+    # while pushing predicates down into an inlined WITH query.
+    substitutions = attr.ib(default=None)
+    # The SELECT this level compiles.
+    statement = attr.ib(default=None, repr=False)
+
+    @contextlib.contextmanager
+    def substituting(self, substitutions):
+        previous = self.substitutions
+        self.substitutions = substitutions
+        try:
+            yield
+        finally:
+            self.substitutions = previous
+
+
+class _Plan:
+    """
+    Base class of compiled queries.
+    """
+    __slots__ = ()
+
+    def evaluator(self, consume):
+        """
+        Build a function of the enclosing query's row that runs this subquery
+        and returns what `consume` makes of its result tuples.
+
+        Uncorrelated subqueries only run the first time they're evaluated.
+        """
+        cached = []
+
+        def evaluate(row):
+            if self.correlated:
+                with _bind_outer_row(row):
+                    return consume(self.run())
+            if not cached:
+                cached.append(consume(self.run()))
+            return cached[0]
+        return evaluate
+
+
+@attr.s(slots=True)
+class SelectPlan(_Plan):
+    """
+    A compiled SELECT, ready to run.
+    """
+    scope = attr.ib()
+    # QueryTables the select list was compiled against.
+    sources = attr.ib(repr=False)
+    select_list = attr.ib()
+    null_row = attr.ib(repr=False)
+    # Rows of the FROM clause. A one-shot iterator, unless the plan is a
+    # correlated subquery, which runs again for each row of its enclosing query.
+    _from_rows = attr.ib(repr=False)
+    # Bytes DISTINCT may hash rows into before spilling the rest to files.
+    work_mem = attr.ib(default=None, repr=False)
+
+    @property
+    def names(self):
+        return self.select_list.names
+
+    @property
+    def row_types(self):
+        return [target.pgtype for target in self.select_list.targets]
+
+    @property
+    def correlated(self):
+        return self.scope.correlated
+
+    def run(self):
+        """
+        Return an iterator over the result tuples.
+        """
+        from_rows = self._from_rows
+        if self.scope.correlated and not isinstance(from_rows, list):
+            # The FROM clause can't refer to enclosing queries, so its rows stay the same.
+            from_rows = self._from_rows = list(from_rows)
+        select_list = self.select_list
+        rows = select_list.filter_and_group(from_rows, null_row=self.null_row)
+        if select_list.sort_keys:
+            rows = _trace('Sort', functools.partial(sorted, _interruptible(rows), key=lambda row: tuple(
+                SortByKey(strat=strat, value=element.eval(row))
+                for strat, element in select_list.sort_keys
+            )))
+        if select_list.distinct_on:
+            rows = _trace('Unique', _distinct_on(rows, select_list.distinct_on))
+        targets = select_list.targets
+        result = _trace('Result', (tuple([target.eval(row) for target in targets]) for row in rows))
+        if select_list.distinct:
+            result = _trace('Unique', _distinct_rows(result, self.work_mem))
+        return result
+
+
+@attr.s(slots=True)
+class SetOperationPlan(_Plan):
+    """
+    A compiled UNION, INTERSECT or EXCEPT, ready to run.
+    """
+    op = attr.ib()
+    all = attr.ib()
+    left = attr.ib()
+    right = attr.ib()
+    # (SortByStrategy, column index) pairs.
+    sort_keys = attr.ib(default=())
+    # Bytes UNION may hash rows into before spilling the rest to files.
+    work_mem = attr.ib(default=None, repr=False)
+
+    @property
+    def names(self):
+        return self.left.names
+
+    @property
+    def row_types(self):
+        return self.left.row_types
+
+    @property
+    def correlated(self):
+        return self.left.correlated or self.right.correlated
+
+    def run(self):
+        """
+        Return an iterator over the result tuples.
+        """
+        rows = _trace('SetOp', {
+            SETOP_UNION: self._union,
+            SETOP_INTERSECT: self._intersect,
+            SETOP_EXCEPT: self._except,
+        }[self.op], _SETOP_NAMES[self.op])
+        if self.sort_keys:
+            rows = _trace('Sort', functools.partial(sorted, _interruptible(rows), key=lambda row: tuple(
+                SortByKey(strat=strat, value=row[index])
+                for strat, index in self.sort_keys
+            )))
+        return iter(rows)
+
+    def _union(self):
+        rows = itertools.chain.from_iterable(plan.run() for plan in (self.left, self.right))
+        if self.all:
+            return rows
+        return _distinct_rows(rows, self.work_mem)
+
+    def _intersect(self):
+        right = collections.Counter(self.right.run())
+        for row in self.left.run():
+            if right[row] > 0:
+                right[row] = right[row] - 1 if self.all else 0
+                yield row
+
+    def _except(self):
+        right = collections.Counter(self.right.run())
+        if self.all:
+            for row in self.left.run():
+                if right[row] > 0:
+                    right[row] -= 1
+                else:
+                    yield row
+        else:
+            emitted = set()
+            for row in self.left.run():
+                if row not in right and row not in emitted:
+                    emitted.add(row)
+                    yield row
+
+
+# Distinct rows whose size is measured, to estimate what hashing the rest takes.
+_ROW_SIZE_SAMPLE = 64
+# Files the rows DISTINCT can't hash in memory are split among, by hash.
+_SPILL_PARTITIONS = 32
+# Most rows written to a spill file at a time.
+_SPILL_BATCH = 256
+
+
+def _row_size(row):
+    return sys.getsizeof(row) + sum(map(sys.getsizeof, row))
+
+
+def _hashable(value):
+    """
+    `value`, with any arrays in it made into tuples, so it can be hashed.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(map(_hashable, value))
+    return value
+
+
+class _SpillFile:
+    """
+    Items written out to a temporary file, to be read back in the same order.
+    """
+    __slots__ = ('_file', '_batch', '_batch_size')
+
+    def __init__(self, batch_size):
+        self._file = tempfile.TemporaryFile()
+        # Pickled `batch_size` items at a time, which is much faster than one at a time.
+        self._batch = []
+        self._batch_size = batch_size
+
+    def write(self, item):
+        batch = self._batch
+        batch.append(item)
+        if len(batch) >= self._batch_size:
+            self._flush()
+
+    def _flush(self):
+        pickle.dump(self._batch, self._file, pickle.HIGHEST_PROTOCOL)
+        self._batch = []
+
+    def read(self):
+        """
+        Yield the items written, then close the file.
+        """
+        file = self._file
+        try:
+            if self._batch:
+                self._flush()
+            file.seek(0)
+            while True:
+                try:
+                    batch = pickle.load(file)
+                except EOFError:
+                    break
+                yield from batch
+        finally:
+            file.close()
+
+
+def _distinct_rows(rows, budget):
+    """
+    Yield each distinct row of `rows` the first time it shows up.
+    """
+    return (row for _, row in _distinct_numbered(enumerate(rows), budget))
+
+
+def _distinct_numbered(items, budget, depth=0):
+    """
+    Yield the (index, row) pairs of `items`, in increasing index order, whose
+    row hasn't shown up before.
+
+    Rows are deduplicated through a hash table of at most `budget` bytes. Once
+    it's full, the rest of the rows it doesn't have are spilled to files, split
+    among them by hash so that duplicates land in the same one. Each file is
+    then deduplicated on its own, one at a time, and what's left of them is
+    merged back into index order.
+    """
+    items = iter(items)
+    seen = set()
+    limit = None
+    sampled = 0
+    for index, row in items:
+        key = row
+        try:
+            if key in seen:
+                continue
+        except TypeError:
+            key = _hashable(row)
+            if key in seen:
+                continue
+        seen.add(key)
+        yield index, row
+        if limit is None:
+            sampled += _row_size(row)
+            if len(seen) >= _ROW_SIZE_SAMPLE or sampled > budget:
+                limit = max(budget * len(seen) // sampled, 1)
+        if limit is not None and len(seen) >= limit:
+            break
+    else:
+        return
+
+    # Small enough that the batches held while merging files back stay around the budget too.
+    batch_size = min(max(limit // (2 * _SPILL_PARTITIONS), 1), _SPILL_BATCH)
+    partitions = [_SpillFile(batch_size) for _ in range(_SPILL_PARTITIONS)]
+    for item in items:
+        key = item[1]
+        try:
+            if key in seen:
+                continue
+        except TypeError:
+            key = _hashable(key)
+            if key in seen:
+                continue
+        # Salted by depth, so rows that shared a file split up when it's spilled again.
+        partitions[hash((depth, key)) % _SPILL_PARTITIONS].write(item)
+    seen = None
+    survivors = []
+    for partition in partitions:
+        spilled = _SpillFile(batch_size)
+        for item in _distinct_numbered(partition.read(), budget, depth + 1):
+            spilled.write(item)
+        survivors.append(spilled.read())
+    yield from heapq.merge(*survivors, key=operator.itemgetter(0))
+
+
+def _distinct_on(rows, keys):
+    seen = set()
+    for row in rows:
+        key = tuple([key.eval(row) for key in keys])
+        if key not in seen:
+            seen.add(key)
+            yield row
+
+
+def _set_operation_leaves(plan):
+    if isinstance(plan, SetOperationPlan):
+        yield from _set_operation_leaves(plan.left)
+        yield from _set_operation_leaves(plan.right)
+    else:
+        yield plan
+
+
+_DURATION_UNITS = {'us': 0.001, 'ms': 1, 's': 1000, 'min': 60 * 1000, 'h': 60 * 60 * 1000, 'd': 24 * 60 * 60 * 1000}
+
+
+@functools.lru_cache(maxsize=64)
+def _duration_setting_ms(name, value):
+    """
+    Milliseconds in a duration setting: milliseconds, or a number with a unit.
+    """
+    match = re.fullmatch(r'\s*(-?\d+(?:\.\d+)?)\s*(us|ms|s|min|h|d)?\s*', str(value))
+    if not match:
+        raise exc.InvalidParameterValueError(f'invalid value for parameter "{name}": "{value}"')
+    number, unit = match.groups()
+    return float(number) * _DURATION_UNITS[unit or 'ms']
+
+
+@functools.lru_cache(maxsize=64)
+def _bool_setting(name, value):
+    """
+    Whether a boolean setting is on: on/off, true/false, yes/no or 1/0.
+    """
+    normalized = str(value).strip().lower()
+    if normalized in ('on', 'true', 'yes', '1'):
+        return True
+    if normalized in ('off', 'false', 'no', '0'):
+        return False
+    raise exc.InvalidParameterValueError(f'parameter "{name}" requires a Boolean value')
+
+
+def _integer_setting(minimum, maximum):
+    """
+    A function(name, value) reading an integer setting from `minimum` to `maximum`.
+    """
+    @functools.lru_cache(maxsize=64)
+    def parse(name, value):
+        try:
+            number = int(str(value).strip())
+        except ValueError:
+            raise exc.InvalidParameterValueError(f'invalid value for parameter "{name}": "{value}"') from None
+        if not minimum <= number <= maximum:
+            raise exc.InvalidParameterValueError(
+                f'{number} is outside the valid range for parameter "{name}" ({minimum} .. {maximum})'
+            )
+        return number
+    return parse
+
+
+_statistics_target_setting = _integer_setting(1, 10000)
+_collapse_limit_setting = _integer_setting(1, 2 ** 31 - 1)
+
+
+def _memory_setting_bytes(name, value):
+    """
+    Bytes in a memory setting like work_mem: kilobytes, or a number with a unit.
+    """
+    match = re.fullmatch(r'\s*(\d+)\s*(kB|MB|GB|TB)?\s*', str(value))
+    if not match:
+        raise exc.InvalidParameterValueError(f'invalid value for parameter "{name}": "{value}"')
+    number, unit = match.groups()
+    kilobytes = int(number) * 1024 ** ('kB', 'MB', 'GB', 'TB').index(unit or 'kB')
+    if not 64 <= kilobytes <= 2 ** 31 - 1:
+        raise exc.InvalidParameterValueError(
+            f'{kilobytes} kB is outside the valid range for parameter "{name}" (64 .. {2 ** 31 - 1})'
+        )
+    return kilobytes * 1024
+
+
+# {setting: function(name, value) raising if a value isn't valid}, checked by SET.
+_SETTING_VALIDATORS = {
+    'default_statistics_target': _statistics_target_setting,
+    'enable_hashjoin': _bool_setting,
+    'enable_mergejoin': _bool_setting,
+    'from_collapse_limit': _collapse_limit_setting,
+    'log_min_duration_statement': _duration_setting_ms,
+    'statement_timeout': _duration_setting_ms,
+    'work_mem': _memory_setting_bytes,
+}
+
+
+@attr.s(slots=True, eq=False)
+class CommonTableExpression:
+    """
+    A WITH query, for one execution of the statement that defines it.
+    """
+    name = attr.ib()
+    query = attr.ib()
+    col_names = attr.ib()
+    # {name: CommonTableExpression} of the WITH queries `query` can see.
+    ctes = attr.ib(repr=False)
+    # Whether references scan one computed result, rather than running the query inline.
+    materialized = attr.ib()
+    recursive = attr.ib(default=False)
+    # Names of the columns the statement reads from it, or None for all of them.
+    read = attr.ib(default=None, repr=False)
+    # The computed result, once a reference needed it.
+    table = attr.ib(default=None, repr=False)
+    # While running a recursive term: the rows the last iteration added.
+    working_table = attr.ib(default=None, repr=False)
+    running = attr.ib(default=False, repr=False)
+
+
+class InlineCteScan:
+    """
+    Rows of an inlined WITH query, streamed from its plan as the FROM clause is read.
+    """
+    __slots__ = ('plan', 'source', 'query', 'order')
+
+    def __init__(self, plan, source, query, order=()):
+        self.plan = plan
+        # (table, alias) the rows are read under.
+        self.source = source
+        self.query = query
+        # What the rows are sorted on, as in OrderedRows.
+        self.order = order
+
+    def __iter__(self):
+        source = self.source
+        rowtype = source[0].rowtype
+        columns = rowtype.columns
+        make_row = rowtype._from_trusted
+        for values in self.plan.run():
+            yield frozendict({source: make_row(dict(zip(columns, values)))})
+
+
+class OrderedRows:
+    """
+    Rows of a FROM item that are known to come out sorted.
+    """
+    __slots__ = ('rows', 'order')
+
+    def __init__(self, rows, order):
+        self.rows = rows
+        # ((table, alias), column, SortByStrategy) of each sort key, most significant first.
+        self.order = order
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+def _row_order(rows):
+    """
+    What the rows of a FROM item are sorted on, as in OrderedRows, as far as that's known.
+    """
+    if isinstance(rows, (OrderedRows, InlineCteScan)):
+        return rows.order
+    return ()
+
+
+def _output_order(statement, names):
+    """
+    [(column position, SortByStrategy)] of the leading ORDER BY keys of a
+    SELECT that are output columns, so its rows come out sorted on them.
+
+    `names` are the output column names, or None for ones that can't be named.
+    """
+    order = []
+    for sortby in statement.sort_clause or ():
+        node = sortby.node
+        if isinstance(node, psqlparse.nodes.AConst) and isinstance(node.val, psqlparse.nodes.Integer):
+            position = node.val.val - 1
+            if not 0 <= position < len(names):
+                break
+        elif isinstance(node, psqlparse.nodes.ColumnRef) and len(node.fields) == 1:
+            name = getattr(node.fields[0], 'str', None)
+            if name is None or names.count(name) != 1:
+                break
+            position = names.index(name)
+        else:
+            break
+        order.append((position, SortByStrategy(sortby_dir=sortby.sortby_dir, sortby_nulls=sortby.sortby_nulls)))
+    return order
+
+
+def _source_order(table, alias, order):
+    """
+    `order`, from _output_order, as the columns of `table` read under `alias` it sorts on.
+    """
+    return tuple(((table, alias), table.rowtype.columns[position], strat) for position, strat in order)
+
+
+def _relation_references(node, relname):
+    """
+    Count the references to `relname`, without a schema, anywhere under `node`.
+    """
+    if isinstance(node, list):
+        return sum(_relation_references(item, relname) for item in node)
+    if not hasattr(node, '__dict__'):
+        return 0
+    count = int(
+        isinstance(node, psqlparse.nodes.RangeVar)
+        and node.schemaname is None
+        and node.relname == relname
+    )
+    return count + sum(
+        _relation_references(value, relname)
+        for field, value in vars(node).items()
+        if not field.startswith('_')
+    )
+
+
+def _conjuncts(expr):
+    if isinstance(expr, psqlparse.nodes.BoolExpr) and expr.boolop == 0:
+        for arg in expr.args:
+            yield from _conjuncts(arg)
+    else:
+        yield expr
+
+
+def _column_ref_key(column_ref):
+    """
+    A ColumnRef's names, column first, like (column, table, schema).
+    """
+    return tuple(getattr(piece, 'str', None) for piece in column_ref.fields[::-1])
+
+
+def _column_refs(node, skip=None):
+    """
+    Every ColumnRef under `node`, except those under `skip`.
+    """
+    if node is skip:
+        return
+    if isinstance(node, list):
+        for item in node:
+            yield from _column_refs(item, skip)
+    elif isinstance(node, psqlparse.nodes.ColumnRef):
+        yield node
+    elif hasattr(node, '__dict__'):
+        for field, value in vars(node).items():
+            if not field.startswith('_'):
+                yield from _column_refs(value, skip)
+
+
+def _read_columns(node, skip):
+    """
+    Names of the columns read anywhere under `node` but outside the query `skip`,
+    whatever table they're read from, or None if something there reads `*`.
+    """
+    names = set()
+    for column_ref in _column_refs(node, skip):
+        name = _column_ref_key(column_ref)[0]
+        if name is None:
+            return None
+        names.add(name)
+    return names
+
+
+def _column_equality(node):
+    """
+    The two ColumnRefs `node` compares for equality, if that's all it does.
+    """
+    if (
+        isinstance(node, psqlparse.nodes.AExpr)
+        and node.kind == AEXPR_OP
+        and [piece.str for piece in node.name] == ['=']
+        and isinstance(node.lexpr, psqlparse.nodes.ColumnRef)
+        and isinstance(node.rexpr, psqlparse.nodes.ColumnRef)
+    ):
+        return node.lexpr, node.rexpr
+    return None
+
+
+def _column_side(column_ref, left_sources, right_sources):
+    """
+    'left' or 'right', whichever of the QueryTables `column_ref` reads, or None if neither or both.
+    """
+    sides = []
+    for side, sources in (('left', left_sources), ('right', right_sources)):
+        try:
+            sources.get_column_source(*_column_ref_key(column_ref))
+        except (exc.PostgresError, TypeError):
+            continue
+        sides.append(side)
+    return sides[0] if len(sides) == 1 else None
+
+
+# Rows the planner guesses relations it can't count have, like inlined WITH queries.
+_UNKNOWN_RELATION_ROWS = 1000
+
+# {operator: the operator with its operands swapped}
+_COMMUTED_OPERATORS = {'=': '=', '<>': '<>', '!=': '!=', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+
+def _cheapest_join_order(estimates, joins):
+    """
+    The order to join items in, one at a time, that costs least by a simple model.
+
+    `estimates` are how many rows each item brings, and `joins` are (items,
+    selectivity, hashable) for the conditions between them. A join costs the
+    rows it reads, every pair of them unless a condition makes it a hash join,
+    plus the rows it makes. Every order is considered, so keep them short.
+    """
+    items = range(len(estimates))
+    # {items joined: (cost, rows, order)}
+    best = {frozenset([item]): (0.0, rows, (item,)) for item, rows in zip(items, estimates)}
+    for size in range(2, len(estimates) + 1):
+        for subset in itertools.combinations(items, size):
+            joined = frozenset(subset)
+            for last in subset:
+                cost, rows, order = best[joined - {last}]
+                selectivity = 1.0
+                hashed = False
+                for positions, join_selectivity, hashable in joins:
+                    if last in positions and positions <= joined:
+                        selectivity *= join_selectivity
+                        hashed = hashed or hashable
+                joined_rows = max(rows * estimates[last] * selectivity, 1.0)
+                cost += (rows + estimates[last] if hashed else rows * estimates[last]) + joined_rows
+                if joined not in best or cost < best[joined][0]:
+                    best[joined] = (cost, joined_rows, order + (last,))
+    return best[frozenset(items)][2]
+
+
+@attr.s(frozen=True, slots=True)
+class MergeKeys:
+    """
+    How to merge join two inputs sorted on the same keys.
+    """
+    # Elements computing each side's sort keys, most significant first.
+    left_keys = attr.ib()
+    right_keys = attr.ib()
+    # SortByStrategy of each key, the same on both sides.
+    strats = attr.ib()
+    # How a right row's key compares to a left row's, in sort order, when
+    # they join: '=', or for a single key, '<', '<=', '>' or '>='.
+    comparison = attr.ib()
+
+    def swapped(self):
+        return attr.evolve(
+            self,
+            left_keys=self.right_keys,
+            right_keys=self.left_keys,
+            comparison=_COMMUTED_OPERATORS[self.comparison],
+        )
+
+
+class _MergeEntry:
+    __slots__ = ('key', 'row', 'matched')
+
+    def __init__(self, key, row):
+        self.key = key
+        self.row = row
+        self.matched = False
+
+
+class _MergeScan:
+    """
+    The right side of a merge join, read once, in step with the left side.
+
+    Only the right rows that can still join to a left row are held on to: for
+    equality, the run of rows with the current key. Rows that fall behind are
+    dropped, or with `keep_passed`, handed to `take_passed()`.
+    """
+    __slots__ = ('_rows', '_merge', '_buffer', '_exhausted', '_passed')
+
+    def __init__(self, rows, merge, keep_passed=False):
+        self._rows = iter(rows)
+        self._merge = merge
+        self._buffer = collections.deque()
+        self._exhausted = False
+        self._passed = [] if keep_passed else None
+
+    def key(self, row, keys):
+        return tuple(SortByKey(strat=strat, value=key.eval(row)) for key, strat in zip(keys, self._merge.strats))
+
+    def _behind(self, right_key, left_key):
+        """
+        Whether a right row with `right_key` can't join to this or any later left row.
+        """
+        comparison = self._merge.comparison
+        if comparison in ('=', '>='):
+            return right_key < left_key
+        if comparison == '>':
+            return not left_key < right_key
+        return False
+
+    def _within(self, right_key, left_key):
+        """
+        Whether a right row with `right_key` can join to a left row with `left_key`,
+        once the rows behind it are dropped.
+        """
+        comparison = self._merge.comparison
+        if comparison in ('=', '<='):
+            return not left_key < right_key
+        if comparison == '<':
+            return right_key < left_key
+        return True
+
+    def matches(self, left_row):
+        """
+        Entries for the right rows that may join to `left_row`, in order.
+
+        Left rows have to come in sorted order.
+        """
+        left_key = self.key(left_row, self._merge.left_keys)
+        buffer = self._buffer
+        while True:
+            while buffer and self._behind(buffer[0].key, left_key):
+                entry = buffer.popleft()
+                if self._passed is not None:
+                    self._passed.append(entry)
+            if self._exhausted or (buffer and not self._within(buffer[-1].key, left_key)):
+                break
+            row = next(self._rows, _EXHAUSTED)
+            if row is _EXHAUSTED:
+                self._exhausted = True
+            else:
+                buffer.append(_MergeEntry(self.key(row, self._merge.right_keys), row))
+        return list(itertools.takewhile(lambda entry: self._within(entry.key, left_key), buffer))
+
+    def take_passed(self):
+        passed, self._passed = self._passed, []
+        return passed
+
+    def rest(self):
+        """
+        Entries for every right row not yet dropped, once the left rows are done.
+        """
+        yield from self._buffer
+        for row in self._rows:
+            yield _MergeEntry(None, row)
+
+
+def _all_of(elements):
+    elements = [element for element in elements if element is not None]
+    if len(elements) == 1:
+        return elements[0]
+    return Element(lambda row: all(element.eval(row) for element in elements))
+
+
+# Expression nodes an inlined WITH query can evaluate as well as the query reading it.
+_PUSHABLE_NODES = tuple(filter(None, (
+    getattr(psqlparse.nodes, name, None)
+    for name in [
+        'AExpr', 'BoolExpr', 'TypeCast', 'TypeName', 'AConst', 'ParamRef', 'String', 'Integer', 'Float', 'Null',
+    ]
+)))
+
+
+def _scalar_subquery_value(rows):
+    row = next(rows, None)
+    if row is None:
+        return None
+    if next(rows, None) is not None:
+        raise exc.CardinalityViolation("more than one row returned by a subquery used as an expression")
+    return row[0]
+
+
+class SubqueryValues:
+    """
+    The values of a one-column subquery, for `IN`, `ANY` and `ALL`.
+    """
+    __slots__ = ('values', 'has_null', '_hashed')
+
+    def __init__(self, rows):
+        self.values = [value for value, in rows]
+        self.has_null = any(value is None for value in self.values)
+        try:
+            self._hashed = frozenset(self.values)
+        except TypeError:
+            self._hashed = None
+
+    def contains(self, value):
+        """
+        `value = ANY (subquery)`: a hash probe, with SQL's NULL semantics.
+        """
+        if not self.values:
+            return False
+        if value is None:
+            return None
+        hashed = self._hashed
+        if value in (self.values if hashed is None else hashed):
+            return True
+        return None if self.has_null else False
+
+    def compare(self, operation, value, *, require_all):
+        """
+        `value op ANY (subquery)`, or `ALL` if `require_all`.
+        """
+        saw_null = False
+        for other in self.values:
+            result = None if value is None or other is None else operation(value, other)
+            if result is None:
+                saw_null = True
+            elif bool(result) != require_all:
+                return not require_all
+        return None if saw_null else require_all
+
+
+@attr.s(slots=True)
+class QueryTables:  # XXX bad name
+    _aliases = attr.ib(default=(), converter=dict)
+    # {relname: {schema: _}}
+    _tables = attr.ib(default=(), converter=lambda data: collections.defaultdict(dict, data))
+    # Grouping of the query level being parsed, where aggregates are allowed.
+    grouping = attr.ib(default=None)
+    # QueryScope of the query level being parsed, where subqueries are allowed.
+    scope = attr.ib(default=None)
+    # Windowing of the query level being parsed, where window calls are allowed.
+    windowing = attr.ib(default=None)
+
+    def _clone(self):
+        return attr.evolve(
+            self,
+            tables=(
+                (relname, dict(schemas))
+                for relname, schemas in self._tables.items()
+            )
+        )
+
+    def add(self, *, table, alias=None):
+        if alias:
+            if alias in self._aliases or alias in self._tables:
+                raise exc.DuplicateAliasError(alias)
+            self._aliases[alias] = table
+        else:
+            if table.relname in self._aliases or table.schema in self._tables.get(table.relname, ()):
+                raise exc.DuplicateAliasError(table.relname)
+            self._tables[table.relname][table.schema] = table
+
+    def all_tables(self):
+        for alias, table in self._aliases.items():
+            yield table, alias
+        for schemas in self._tables.values():
+            for table in schemas.values():
+                yield table, None
+
+    @classmethod
+    def merge(cls, *qts):
+        qts = iter(qts)
+        first_qt = next(qts)
+        new = first_qt._clone()
+        for qt in qts:
+            for table, alias in qt.all_tables():
+                new.add(table=table, alias=alias)
+        return new
+
+    def _get_source_by_qualified_table(self, schema_name, table_name):
+        schemas = self._tables.get(table_name)
+        table = schemas and schemas.get(schema_name)
+        if not table:
+            raise exc.UndefinedTableError(f"missing FROM-clause entry for table {table_name!r}")
+        return table, None
+
+    def _get_source_by_table(self, name):
+        if name in self._aliases:
+            return self._aliases[name], name
+        if name in self._tables:
+            tables = self._tables[name]
+            if len(tables) > 1:
+                raise exc.AmbiguousTableError(f"table reference {name!r} is ambiguous")
+            return one(tables.values()), None
+        raise exc.UndefinedTableError(f"missing FROM-clause entry for table {name!r}")
+
+    def _get_source_by_column(self, column_name):
+        column_source = None
+        for table, alias in self.all_tables():
+            if column_name in table.rowtype.columns:
+                if column_source is not None:
+                    raise exc.AmbiguousColumnError(f"column reference {column_name!r} is ambiguous")
+                column_source = table, alias
+        if not column_source:
+            raise exc.UndefinedColumnError(f"column {column_name!r} does not exist")
+        return column_source
+
+    def get_column_source(self, column_name, table_name=None, schema_name=None):
+        if not table_name:
+            return self._get_source_by_column(column_name)
+        elif not schema_name:
+            return self._get_source_by_table(table_name)
+        return self._get_source_by_qualified_table(schema_name, table_name)
+
+    def null_row(self):
+        return {
+            (table, alias): table.rowtype.null_row()
+            for table, alias in self.all_tables()
+        }
+
+
+# Node fields that say where the node came from, not what it means.
+_POSITION_FIELDS = frozenset({'location', 'stmt_location', 'stmt_len'})
+
+
+@attr.s(slots=True, frozen=True)
+class StatementFingerprint:
+    """
+    Hashable summary of a parsed statement, ignoring whitespace, comments and
+    other source positions.
+    """
+    key = attr.ib(repr=False)
+    # (schema name, name) of each relation the statement names, and of each
+    # function it calls. Schema names are None where they're left implicit.
+    relations = attr.ib()
+    functions = attr.ib()
+
+
+def fingerprint(statement, *, normalize=False):
+    """
+    Fingerprint a parsed statement. With `normalize`, statements that only
+    differ in their constants get the same key, as in pg_stat_statements.
+    """
+    relations = set()
+    functions = set()
+
+    def jumble(node):
+        if isinstance(node, list):
+            return tuple(map(jumble, node))
+        if not hasattr(node, '__dict__'):
+            return node
+        if normalize and isinstance(node, psqlparse.nodes.AConst):
+            return ('AConst',)
+        if isinstance(node, psqlparse.nodes.RangeVar):
+            relations.add((node.schemaname, node.relname))
+        elif isinstance(node, psqlparse.nodes.FuncCall):
+            names = [piece.str for piece in node.funcname]
+            functions.add((names[0] if len(names) > 1 else None, names[-1]))
+        # `public_fields` is too slow to run on every execution.
+        return (type(node).__name__, *(
+            (field, jumble(value))
+            for field, value in sorted(vars(node).items())
+            if not field.startswith('_') and field not in _POSITION_FIELDS
+        ))
+
+    key = jumble(statement)
+    return StatementFingerprint(
+        key=key,
+        relations=frozenset(relations),
+        functions=frozenset(functions),
+    )
+
+
+@attr.s(slots=True, frozen=True)
+class ResultCacheStats:
+    size = attr.ib()
+    hits = attr.ib()
+    misses = attr.ib()
+    # Entries dropped because a table they read has changed.
+    invalidations = attr.ib()
+    evictions = attr.ib()
+
+
+class ResultCache:
+    """
+    Least-recently-used cache of SELECT results.
+
+    Each entry keeps the Table objects its query read. Tables are immutable and
+    replaced on every write, so an entry only matches while every one of them
+    is still the current version.
+    """
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        self._evictions = 0
+
+    def get(self, key, tables):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            cached_tables, result = entry
+            if len(cached_tables) != len(tables) or any(
+                cached is not table for cached, table in zip(cached_tables, tables)
+            ):
+                del self._entries[key]
+                self._invalidations += 1
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return result
+
+    def put(self, key, tables, result):
+        with self._lock:
+            self._entries[key] = (tables, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return ResultCacheStats(
+                size=len(self._entries),
+                hits=self._hits,
+                misses=self._misses,
+                invalidations=self._invalidations,
+                evictions=self._evictions,
+            )
+
+
+# Quoted identifiers and comments, which are left alone, and literals, which
+# are replaced by parameters in normalized statement text.
+_STATEMENT_TEXT_RE = re.compile(r"""
+    "(?:[^"]|"")*"
+    | --[^\n]*
+    | /\*.*?\*/
+    | \$(?P<param>\d+)
+    | (?P<literal>
+        (?:\b[EeBbXxNn])?'(?:[^']|'')*'
+        | (?<![\w$.])(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?(?![\w$])
+    )
+""", re.VERBOSE | re.DOTALL)
+
+# Where one statement ends and the next begins: semicolons outside literals,
+# quoted identifiers and comments.
+_STATEMENT_SPLIT_RE = re.compile(r"""
+    '(?:[^']|'')*'
+    | "(?:[^"]|"")*"
+    | --[^\n]*
+    | /\*.*?\*/
+    | (?P<dollar>\$(?:[A-Za-z_]\w*)?\$).*?(?P=dollar)
+    | (?P<semicolon>;)
+""", re.VERBOSE | re.DOTALL)
+
+
+_COMMENT_RE = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+
+
+def _split_statements(query, count):
+    """
+    The text of each of the `count` statements in `query`.
+
+    Falls back to the whole query for each, if it doesn't split into `count` pieces.
+    """
+    pieces = []
+    start = 0
+    for match in _STATEMENT_SPLIT_RE.finditer(query):
+        if match.group('semicolon'):
+            pieces.append(query[start:match.start()])
+            start = match.end()
+    pieces.append(query[start:])
+    # Trailing comments aren't statements of their own.
+    pieces = [piece.strip() for piece in pieces if _COMMENT_RE.sub('', piece).strip()]
+    if len(pieces) != count:
+        return [query.strip()] * count
+    return pieces
+
+
+def normalize_query(text):
+    """
+    Replace the literals in a statement's text with `$n` parameters,
+    numbered after any the statement already has.
+    """
+    params = [int(number) for number in re.findall(r'\$(\d+)', text)]
+    next_param = itertools.count(max(params, default=0) + 1)
+
+    def replace(match):
+        if match.group('literal'):
+            return f"${next(next_param)}"
+        return match.group(0)
+    return _STATEMENT_TEXT_RE.sub(replace, text)
+
+
+@attr.s(slots=True, frozen=True)
+class StatementStatistics:
+    """
+    Statistics of one normalized statement. Times are in seconds.
+    """
+    queryid = attr.ib()
+    query = attr.ib()
+    calls = attr.ib()
+    total_time = attr.ib()
+    min_time = attr.ib()
+    max_time = attr.ib()
+    # Rows returned, or written by INSERT, UPDATE, DELETE and COPY.
+    rows = attr.ib()
+    parse_time = attr.ib()
+    plan_time = attr.ib()
+    exec_time = attr.ib()
+
+    @property
+    def mean_time(self):
+        return self.total_time / self.calls
+
+
+class _StatementEntry:
+    __slots__ = ('queryid', 'query', 'calls', 'total_time', 'min_time', 'max_time', 'rows',
+                 'parse_time', 'plan_time', 'exec_time')
+
+    def __init__(self, queryid, query):
+        self.queryid = queryid
+        self.query = query
+        self.calls = 0
+        self.total_time = 0.0
+        self.min_time = math.inf
+        self.max_time = 0.0
+        self.rows = 0
+        self.parse_time = 0.0
+        self.plan_time = 0.0
+        self.exec_time = 0.0
+
+
+class StatementStats:
+    """
+    Per-statement statistics, like postgres's pg_stat_statements.
+
+    Statements that only differ in their constants are counted together. Only
+    statements that complete are counted. Past `max_size` statements, the
+    least recently run is dropped.
+    """
+    def __init__(self, max_size=5000):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, statement, text, *, parse_time, plan_time, exec_time, rows, calls=1):
+        key = fingerprint(statement, normalize=True).key
+        try:
+            hash(key)
+        except TypeError:
+            key = repr(key)
+        elapsed = parse_time + plan_time + exec_time
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                # Stable across processes, unlike hash().
+                digest = hashlib.blake2b(repr(key).encode(), digest_size=8).digest()
+                query = normalize_query(text) if text is not None else type(statement).__name__
+                entry = self._entries[key] = _StatementEntry(
+                    queryid=int.from_bytes(digest, 'big', signed=True),
+                    query=query,
+                )
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(key)
+            entry.calls += calls
+            entry.total_time += elapsed
+            entry.min_time = min(entry.min_time, elapsed / calls)
+            entry.max_time = max(entry.max_time, elapsed / calls)
+            entry.rows += rows
+            entry.parse_time += parse_time
+            entry.plan_time += plan_time
+            entry.exec_time += exec_time
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+
+    def statements(self):
+        """
+        A StatementStatistics for each statement, slowest in total first.
+        """
+        with self._lock:
+            stats = [
+                StatementStatistics(**{field: getattr(entry, field) for field in _StatementEntry.__slots__})
+                for entry in self._entries.values()
+            ]
+        return sorted(stats, key=lambda stat: stat.total_time, reverse=True)
+
+
+def _result_rows(result):
+    """
+    Rows a statement returned or wrote, for its statistics.
+    """
+    if result is None:
+        return 0
+    if isinstance(result, int):
+        # COPY
+        return result
+    return max(result.rowcount, 0)
+
+
+class _Interrupts:
+    """
+    Whether a session's running statement has been canceled, or has run out of time.
+
+    The loops that can run long call `check()` every so often, which raises
+    QueryCanceled once the statement should stop. `cancel()` may be called
+    from any thread.
+    """
+    __slots__ = ('_running', '_canceled', '_pending', '_deadline', '_lock', 'yielding')
+
+    def __init__(self):
+        self._running = False
+        self._canceled = False
+        # Whether the next statement to start is canceled already.
+        self._pending = False
+        # time.monotonic() the statement times out at, or None.
+        self._deadline = None
+        self._lock = threading.Lock()
+        # Whether each check lets other threads run, like an event loop
+        # waiting on this session's statement.
+        self.yielding = False
+
+    @contextlib.contextmanager
+    def running(self, timeout):
+        """
+        Run a statement, with `timeout` seconds to finish in if it isn't None.
+        """
+        if self._running:
+            # Already counted against the statement that started first.
+            yield
+            return
+        with self._lock:
+            if self._pending:
+                self._pending = False
+                raise exc.QueryCanceled("canceling statement due to user request")
+            self._running = True
+            self._canceled = False
+            self._deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._running = False
+                self._canceled = False
+                self._deadline = None
+
+    def cancel(self, pending=False):
+        """
+        Cancel the running statement. If there isn't one, and `pending`, cancel
+        the next one to start instead, until `clear_pending()`.
+        """
+        with self._lock:
+            if self._running:
+                self._canceled = True
+            elif pending:
+                self._pending = True
+            return self._running
+
+    def clear_pending(self):
+        with self._lock:
+            self._pending = False
+
+    def check(self):
+        if self.yielding:
+            time.sleep(0)
+        if self._canceled:
+            raise exc.QueryCanceled("canceling statement due to user request")
+        deadline = self._deadline
+        if deadline is not None and time.monotonic() >= deadline:
+            raise exc.QueryCanceled("canceling statement due to statement timeout")
+
+
+# Rows between checks for a canceled statement, in the loops that can run long.
+INTERRUPT_CHECK_INTERVAL = 1024
+
+
+def _interruptible(rows):
+    """
+    `rows`, checked for a canceled statement every INTERRUPT_CHECK_INTERVAL rows.
+    """
+    session = _current_session.get(None)
+    if session is None:
+        return rows
+    return _check_every(rows, session._interrupts)
+
+
+def _check_every(rows, interrupts):
+    for index, row in enumerate(rows):
+        if not index % INTERRUPT_CHECK_INTERVAL:
+            interrupts.check()
+        yield row
+
+
+def _check_each(rows, interrupts):
+    """
+    `rows`, checked for a canceled statement before each one. For the outer
+    loop of a nested loop join, where each row can take a while.
+    """
+    for row in rows:
+        interrupts.check()
+        yield row
+
+
+class _CommittedState:
+    """
+    The latest committed Database, shared by every session of a MockDatabase.
+    """
+    __slots__ = ('db', 'lock', 'result_cache', 'statement_stats', 'hooks')
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.result_cache = None
+        self.statement_stats = None
+        # ExecutionHooks, in the order they were added.
+        self.hooks = ()
+
+
+def _replay_writes(base, ours, head):
+    """
+    Apply the changes between `base` and `ours` on top of `head`.
+
+    Tables only changed on one side are taken as they are. Writes to the same
+    table on both sides don't conflict unless they delete or update the same
+    rows: ours are made again on top of head's. Anything else raises
+    SerializationFailure.
+
+    Incremental views follow the writes replayed into their base tables. Ones
+    created on our side are only taken if their base table didn't change
+    underneath them. Sequences created on our side are taken unless head
+    created one of the same name.
+    """
+    original_head = head
+    new_views = []
+    for schema_name, schema in ours.schemas.items():
+        base_schema = base.schemas.get(schema_name)
+        head_schema = head.schemas.get(schema_name)
+        for relname, sequence in schema.sequences.items():
+            base_sequence = base_schema and base_schema.sequences.get(relname)
+            if sequence is base_sequence:
+                continue
+            if (head_schema and head_schema.sequences.get(relname)) is not base_sequence:
+                raise _serialization_failure(relname)
+            head = head.create_sequence(sequence)
+        for relname, table in schema.tables.items():
+            base_table = base_schema and base_schema.tables.get(relname)
+            if table is base_table:
+                continue
+            head_table = head_schema and head_schema.tables.get(relname)
+            if table.view is not None and table.view.incremental is not None:
+                if base_table is not None:
+                    continue
+                if head_table is None:
+                    new_views.append(table)
+                    continue
+            if head_table is base_table:
+                head = head.update_table(table)
+            elif (
+                base_table is None or head_table is None
+                or head_table.rowtype is not base_table.rowtype
+                or table.view is not None
+            ):
+                raise _serialization_failure(relname)
+            else:
+                changes = table.rows.changes_since(base_table.rows)
+                if changes is None or not head_table.rows.has_rows(changes.deleted):
+                    raise _serialization_failure(relname)
+                head = head.update_table(head_table.update(changes.deleted, changes.appended))
+    for table in new_views:
+        schema_name, relname = table.view.incremental.base
+        if original_head._find_table(relname, schema_name) is not base._find_table(relname, schema_name):
+            raise _serialization_failure(relname)
+        head = head._update_table(table)
+    return head
+
+
+def _serialization_failure(relname):
+    return exc.SerializationFailure(
+        f'could not serialize access due to concurrent update of relation "{relname}"'
+    )
+
+
+class MockDatabase:
+    """
+    A session against an in-memory database.
+
+    More sessions against the same data come from `session()`. Every transaction
+    works on its own immutable snapshot of the database, so reads never wait on
+    writers. Commits are checked against whatever other sessions have committed
+    in the meantime. A single session shouldn't be shared between threads.
+    """
+    def __init__(self, _committed=None):
+        self._committed = _CommittedState(Database()) if _committed is None else _committed
+        self._db = self._committed.db
+        # Snapshot the open transaction started from, or None in autocommit.
+        self._base = None
+        self._failed = False
+        self._settings = {}
+        # SET LOCAL values, which only last until the transaction ends.
+        self._local_settings = {}
+        # Session settings to go back to if the transaction rolls back.
+        self._settings_at_begin = None
+        self._prepared_statements = {}
+        # {Sequence: values taken from it but not handed out yet}
+        self._sequence_caches = {}
+        # {Sequence: the last value nextval() gave this session}
+        self._currvals = {}
+        self._interrupts = _Interrupts()
+
+    def session(self):
+        """
+        Open another session on the same database.
+        """
+        return MockDatabase(self._committed)
+
+    def enable_result_cache(self, max_size=1024):
+        """
+        Start caching SELECT results for every session of this database.
+
+        Writes don't need to clear the cache: results are only reused while
+        the tables they read are unchanged.
+        """
+        if self._committed.result_cache is None:
+            self._committed.result_cache = ResultCache(max_size)
+        return self._committed.result_cache
 
+    @property
+    def result_cache(self):
+        return self._committed.result_cache
 
-def create_pg_catalog():
-    integer = PgType(
-        converter=int,
-        description="-2 billion to 2 billion integer, 4-byte storage",  # TODO: ha ha ha
-    )
+    def enable_statement_stats(self, max_size=5000):
+        """
+        Start collecting per-statement statistics for every session of this
+        database, to read from `statement_stats` or the pg_stat_statements view.
+        """
+        if self._committed.statement_stats is None:
+            self._committed.statement_stats = StatementStats(max_size)
+        return self._committed.statement_stats
 
-    def pg_bool(value):
-        if value is None:
-            return None
-        if isinstance(value, str):
-            original = value
-            value = value.strip().lower()
-            if value:
-                if 'true'.startswith(value):
-                    return True
-                if 'false'.startswith(value):
-                    return False
-            raise exc.InvalidTextRepresentationError(
-                f"invalid input syntax for type boolean: {original!r}"
+    @property
+    def statement_stats(self):
+        return self._committed.statement_stats
+
+    def add_hook(self, hook):
+        """
+        Register ExecutionHooks for every session of this database.
+        """
+        with self._committed.lock:
+            self._committed.hooks = (*self._committed.hooks, hook)
+        return hook
+
+    def remove_hook(self, hook):
+        with self._committed.lock:
+            self._committed.hooks = tuple(
+                registered for registered in self._committed.hooks if registered is not hook
             )
-        if isinstance(value, int):
-            return bool(value)
-        raise NotImplementedError(type(value))
 
+    def _get_statement_stats(self):
+        stats = self._committed.statement_stats
+        if stats is None:
+            raise exc.ObjectNotInPrerequisiteStateError(
+                "statement statistics are off; turn them on with enable_statement_stats()"
+            )
+        return stats
 
-    def pg_text(value):
-        if value is None or isinstance(value, str):
-            return value
-        if value in (True, False):
-            return str(value).lower()
-        return str(value)
+    def _get_relation(self, relname, schema_name=None):
+        """
+        Look up a table to read from, or the current contents of a system view.
+        """
+        if relname in SYSTEM_VIEWS and schema_name in (None, 'pg_catalog'):
+            if schema_name is not None or self._db._find_table(relname) is None:
+                return SYSTEM_VIEWS[relname](self)
+        return self._db._get_table(relname, schema_name)
+
+    def _pg_stat_statements(self):
+        rowtype = _PG_STAT_STATEMENTS_ROWTYPE
+        make_row = rowtype._from_trusted
+        times = ('total_time', 'min_time', 'max_time', 'mean_time', 'parse_time', 'plan_time', 'exec_time')
+        rows = []
+        for stat in self._get_statement_stats().statements():
+            row = {column: getattr(stat, column) for column in rowtype.columns}
+            # In milliseconds, like postgres.
+            row.update((column, row[column] * 1000) for column in times)
+            rows.append(make_row(row))
+        return Table(schema='pg_catalog', relname='pg_stat_statements', rowtype=rowtype).insert(rows)
+
+    def _pg_stats(self):
+        rowtype = _PG_STATS_ROWTYPE
+        make_row = rowtype._from_trusted
+        rows = []
+        for schema_name, schema in self._db.schemas.items():
+            for relname, table in schema.tables.items():
+                if table.statistics is None:
+                    continue
+                for attname, stats in table.statistics.columns.items():
+                    rows.append(make_row({
+                        'schemaname': schema_name,
+                        'tablename': relname,
+                        'attname': attname,
+                        'null_frac': stats.null_frac,
+                        'n_distinct': float(stats.n_distinct),
+                        'most_common_vals': _array_text(stats.most_common_vals),
+                        'most_common_freqs': _array_text(stats.most_common_freqs),
+                        'histogram_bounds': _array_text(stats.histogram_bounds),
+                    }))
+        return Table(schema='pg_catalog', relname='pg_stats', rowtype=rowtype).insert(rows)
+
+    def snapshot(self):
+        """
+        The database as this session currently sees it.
 
+        Snapshots are immutable and share storage, so they're cheap to take.
+        """
+        if self._base is None:
+            return self._committed.db
+        return self._db
 
-    return Schema(
-        functions={'length': Function(fn=len)},
-        types={
-            'bool': PgType(
-                converter=pg_bool,
-                description="boolean, 'true'/'false'",
-            ),
-            'integer': integer,
-            'int4': integer,
-            'text': PgType(
-                converter=pg_text,
-                description="variable-length string, no limit specified",
-            ),
-        },
-    )
+    @property
+    def in_transaction(self):
+        return self._base is not None
 
+    @property
+    def transaction_failed(self):
+        return self._failed
 
-@attr.s(frozen=True, slots=True)
-class Database:
-    schemas = attr.ib(
-        converter=frozendict,
-        default={
-            'public': Schema(),
-            'pg_catalog': create_pg_catalog(),
-        },
-    )
+    def begin(self):
+        if self._base is None:
+            self._base = self._db = self._committed.db
+            self._failed = False
+            self._settings_at_begin = dict(self._settings)
 
-    def _get_table(self, relname, schema_name=None):
-        if schema_name is None:
-            # TODO: a real search path
-            search_path = ['public']
-            for schema_name in search_path:
-                schema = self.schemas[schema_name]
-                if relname in schema.tables:
-                    return schema.tables[relname]
-            raise exc.UndefinedTableError(table=relname)
+    def commit(self):
+        """
+        Publish the open transaction's writes.
+
+        Raises SerializationFailure, and rolls back, if they conflict with
+        writes committed since the transaction began.
+        """
+        if self._base is None:
+            return
+        if self._failed:
+            self.rollback()
+            return
         try:
-            return self.schemas[schema_name].tables[relname]
+            if self._db is not self._base:
+                self._publish(self._base)
+        except exc.SerializationFailure:
+            self.rollback()
+            raise
+        self._end_transaction()
+
+    def rollback(self):
+        if self._settings_at_begin is not None:
+            self._settings = self._settings_at_begin
+        self._end_transaction()
+
+    def _end_transaction(self):
+        self._base = None
+        self._failed = False
+        self._db = self._committed.db
+        self._local_settings.clear()
+        self._settings_at_begin = None
+
+    def reset(self):
+        """
+        Return the session to how it started: no transaction, no SET values,
+        no prepared statements and no cached sequence values.
+        """
+        self.rollback()
+        self._settings.clear()
+        self._prepared_statements.clear()
+        self._discard_sequences()
+
+    def _discard_sequences(self):
+        self._sequence_caches.clear()
+        self._currvals.clear()
+
+    def resolve_sequence(self, name):
+        """
+        Look up a sequence by its name as text, like `'schema.seq'`.
+        """
+        return self._db._get_sequence(*_split_relation_name(name))
+
+    def resolve_relation(self, name):
+        """
+        Look up a table or sequence by its name as text, like `'schema.table'`.
+        """
+        relname, schema_name = _split_relation_name(name)
+        table = self._db._find_table(relname, schema_name)
+        if table is not None:
+            return table
+        return self._db._get_sequence(relname, schema_name)
+
+    def next_values(self, sequence, count):
+        """
+        Hand out the next `count` values of `sequence`.
+
+        Values come from this session's cache first. The sequence itself is
+        only touched for whole blocks, of at least its CACHE size.
+        """
+        if not count:
+            return ()
+        cached = self._sequence_caches.get(sequence, ())
+        if len(cached) >= count:
+            values = cached[:count]
+            self._sequence_caches[sequence] = cached[count:]
+        else:
+            values = list(cached)
+            block = ()
+            while len(values) < count:
+                needed = count - len(values)
+                block = sequence.allocate(max(needed, sequence.cache))
+                values.extend(block[:needed])
+                block = block[needed:]
+            self._sequence_caches[sequence] = block
+        self._currvals[sequence] = values[-1]
+        return values
+
+    def currval(self, sequence):
+        try:
+            return self._currvals[sequence]
         except KeyError:
-            raise exc.UndefinedTableError(table=f"{schema_name}.{relname}") from None
+            raise exc.ObjectNotInPrerequisiteStateError(
+                f'currval of sequence "{sequence.relname}" is not yet defined in this session'
+            ) from None
+
+    def setval(self, sequence, value, is_called=True):
+        sequence.set(value, is_called)
+        # Values this session already took would come out of order.
+        self._sequence_caches.pop(sequence, None)
+        if is_called:
+            self._currvals[sequence] = value
+
+    def get_setting(self, name):
+        key = name.lower()
+        for settings in (self._local_settings, self._settings):
+            if key in settings:
+                return settings[key]
+        if key in _SETTING_NAMES:
+            return DEFAULT_SETTINGS[_SETTING_NAMES[key]]
+        raise exc.UndefinedObjectError(f'unrecognized configuration parameter "{name}"')
+
+    def set_setting(self, name, value, *, local=False):
+        """
+        Change a setting for the rest of the session, or with `local` for the
+        rest of the transaction. A `value` of None puts back the default.
+        """
+        key = name.lower()
+        # Names with a dot are extension settings, which may be made up freely.
+        if key not in _SETTING_NAMES and '.' not in key:
+            raise exc.UndefinedObjectError(f'unrecognized configuration parameter "{name}"')
+        if value is not None and key in _SETTING_VALIDATORS:
+            _SETTING_VALIDATORS[key](name, value)
+        if local and self._base is None:
+            # Postgres warns that SET LOCAL outside a transaction does nothing.
+            return
+        settings = self._local_settings if local else self._settings
+        if value is None and not local:
+            settings.pop(key, None)
+            self._local_settings.pop(key, None)
+        elif value is None:
+            settings[key] = DEFAULT_SETTINGS.get(_SETTING_NAMES.get(key), '')
+        else:
+            settings[key] = value
+            if not local:
+                self._local_settings.pop(key, None)
 
-    def create_table(self, table):
-        return self._update_table(table)
+    def abort(self):
+        """
+        Mark the open transaction failed, as any error inside one does.
+        """
+        if self._base is not None:
+            self._failed = True
 
-    def update_table(self, table):
-        return self._update_table(table)
+    def _publish(self, base):
+        committed = self._committed
+        ours = self._db
+        while True:
+            head = committed.db
+            new = ours if head is base else _replay_writes(base, ours, head)
+            with committed.lock:
+                if committed.db is head:
+                    committed.db = new
+                    break
+        self._db = new
+
+    def _run_in_transaction(self, fn, *args):
+        """
+        Run `fn` against this session's snapshot.
 
-    def _update_table(self, table):
-        schemas = dict(self.schemas)
-        schema = schemas.get(table.schema)
-        # TODO: this should be an error, but danged if it doesn't make testing easier.
-        if not schema:
-            schema = Schema()
-        tables = dict(schema.tables)
-        tables[table.relname] = table
-        schemas[table.schema] = attr.evolve(schema, tables=tables)
-        return Database(schemas=schemas)
+        Outside a transaction block, each call is its own transaction.
+        """
+        if self._base is not None:
+            if self._failed:
+                raise exc.InFailedSqlTransactionError(
+                    "current transaction is aborted, commands ignored until end of transaction block"
+                )
+            try:
+                with _bind_session(self):
+                    return fn(*args)
+            except Exception:
+                self._failed = True
+                raise
+        base = self._db = self._committed.db
+        with _bind_session(self):
+            result = fn(*args)
+        if self._db is not base:
+            self._publish(base)
+        return result
+
+    def _execute_statement(self, statement, params=(), *, text=None, parse_time=0.0):
+        stmt_type = type(statement).__name__
+        handler = QUERY_HANDLERS.get(stmt_type)
+        if not handler:
+            raise NotImplementedError(stmt_type)
+        with _bind_params(params):
+            # These start or end transactions themselves.
+            if stmt_type in ('TransactionStmt', 'DiscardStmt', 'VacuumStmt'):
+                return self._run_instrumented(statement, text, parse_time, handler, self, statement)
+            return self._run_instrumented(
+                statement, text, parse_time, self._run_in_transaction, handler, self, statement,
+            )
 
-    def parse_select_expr(self, expr, sources=None):
-        expr_type = type(expr).__name__
-        expr_method = {
-            'AConst': lambda expr, sources: Constant(expr.val.val),
-            'ColumnRef': self._parse_select_column_ref,
-            'AExpr': self._parse_select_aexpr,
-            'BoolExpr': self._parse_select_boolexpr,
-            'TypeCast': self._parse_select_typecast,
-            'FuncCall': self._parse_select_funccall,
-        }.get(expr_type)
-        if not expr_method:
-            raise NotImplementedError(expr_type)
-        return expr_method(expr=expr, sources=sources)
+    def cancel(self):
+        """
+        Cancel the statement this session is running, from any thread.
 
-    def _parse_select_column_ref(self, expr, sources):
-        last = expr.fields[-1]
-        if isinstance(last, psqlparse.nodes.AStar):
-            raise NotImplementedError("star select is not implemented")
-        column = last.str
-        column_ref = [piece.str for piece in expr.fields[::-1]]
-        column_source = sources.get_column_source(*column_ref)
-        return Element(lambda row: row[column_source][column], name=column)
+        It stops with QueryCanceled soon after. Returns whether there was a
+        statement to cancel.
+        """
+        return self._interrupts.cancel()
 
-    def _parse_select_aexpr(self, expr, sources):
-        if expr.lexpr is None:
-            return self._parse_prefix_aexpr(expr, sources)
-        if expr.rexpr is None:
-            return self._parse_postfix_aexpr(expr, sources)
-        return self._parse_binary_aexpr(expr, sources)
+    def _statement_timeout(self):
+        """
+        Seconds a statement may run for, or None if there's no limit.
+        """
+        name = 'statement_timeout'
+        timeout = _duration_setting_ms(name, self.get_setting(name))
+        return timeout / 1000 if timeout > 0 else None
 
-    def _parse_select_boolexpr(self, expr, sources):
-        # TODO: might wanna emulate postgres's strict boolean typechecking
-        bool_fn = {
-            0: self._parse_bool_and,
-            1: self._parse_bool_or,
-            2: self._parse_bool_not,
-        }[expr.boolop]
-        return bool_fn(expr, sources)
+    def _log_min_duration(self):
+        """
+        Seconds a statement has to take to be logged, or None if none are.
+        """
+        name = 'log_min_duration_statement'
+        threshold = _duration_setting_ms(name, self.get_setting(name))
+        return None if threshold < 0 else threshold / 1000
 
-    def _parse_bool_and(self, expr, sources):
-        left, right = expr.args
-        left_element = self.parse_select_expr(left, sources)
-        right_element = self.parse_select_expr(right, sources)
-        return Element(lambda row: left_element.eval(row) and right_element.eval(row))
+    def _run_instrumented(self, statement, text, parse_time, fn, *args, calls=1):
+        """
+        Run `fn(*args)` for `statement`, where it can be canceled or time out.
+        """
+        with self._interrupts.running(self._statement_timeout()):
+            return self._run_observed(statement, text, parse_time, fn, *args, calls=calls)
 
-    def _parse_bool_or(self, expr, sources):
-        left, right = expr.args
-        left_element = self.parse_select_expr(left, sources)
-        right_element = self.parse_select_expr(right, sources)
-        return Element(lambda row: left_element.eval(row) or right_element.eval(row))
+    def _run_observed(self, statement, text, parse_time, fn, *args, calls=1):
+        """
+        Run `fn(*args)` for `statement`, under the execution hooks, statement
+        statistics and slow statement log, if there are any.
+        """
+        stats = self._committed.statement_stats
+        hooks = self._committed.hooks
+        log_min_duration = self._log_min_duration()
+        if stats is None and not hooks and log_min_duration is None:
+            return fn(*args)
+        plan_shape = None
+        if log_min_duration is not None:
+            plan_shape = _PlanShape()
+            hooks = (*hooks, plan_shape)
+        timing = _StatementTiming()
+        timing_token = _statement_timing.set(timing)
+        hooks_token = _active_hooks.set(hooks)
+        _call_hooks(hooks, 'statement_start', statement, text)
+        result = error = None
+        start = time.perf_counter()
+        try:
+            result = fn(*args)
+        except BaseException as caught:
+            error = caught
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            _active_hooks.reset(hooks_token)
+            _statement_timing.reset(timing_token)
+            _call_hooks(hooks, 'statement_end', statement, text, result, error)
+            # Failed statements, like ones that time out, are logged too.
+            duration = parse_time + elapsed
+            if log_min_duration is not None and duration >= log_min_duration:
+                self._log_slow_statement(statement, text, duration, result, plan_shape, calls, error)
+        if stats is None:
+            return result
+        stats.record(
+            statement,
+            text,
+            parse_time=parse_time,
+            plan_time=timing.plan_time,
+            exec_time=elapsed - timing.plan_time,
+            rows=_result_rows(result),
+            calls=calls,
+        )
+        return result
+
+    def _log_slow_statement(self, statement, text, duration, result, plan_shape, calls, error=None):
+        params = _bound_params.get()
+        rows = None if error is not None else _result_rows(result)
+        plan = plan_shape.describe()
+        parts = [f"duration: {duration * 1000:.3f} ms", f"statement: {text or type(statement).__name__}"]
+        if calls > 1:
+            parts.append(f"calls: {calls}")
+        if params:
+            parts.append("parameters: " + ', '.join(
+                f"${number} = {value!r}" for number, value in enumerate(params, 1)
+            ))
+        if error is not None:
+            parts.append(f"error: {type(error).__name__}: {error}")
+        else:
+            parts.append(f"rows: {rows}")
+        parts.append(f"plan: {plan}")
+        logger.warning(
+            "%s", '  '.join(parts),
+            extra={
+                'duration': duration,
+                'statement': text,
+                'parameters': params,
+                'rows': rows,
+                'plan': plan,
+                'error': error,
+            },
+        )
 
-    def _parse_bool_not(self, expr, sources):
-        [subexpr] = expr.args
-        element = self.parse_select_expr(subexpr, sources)
-        return Element(lambda row: not element.eval(row))
+    def _parse(self, query):
+        """
+        Parse `query`, into (statement, text, parse time) for each statement in it.
 
-    def _parse_prefix_aexpr(self, expr, sources):
-        right_element = self.parse_select_expr(expr.rexpr, sources)
-        operation = _get_prefix_aexpr_op(expr.name[0].val)
-        return Element(lambda row: operation(right_element.eval(row)))
+        The text and time are only worked out for statement statistics,
+        execution hooks and the slow statement log. Each statement is charged
+        an equal share of the time.
+        """
+        hooks = self._committed.hooks
+        if self._committed.statement_stats is None and not hooks and self._log_min_duration() is None:
+            return [(statement, None, 0.0) for statement in psqlparse.parse(query)]
+        _call_hooks(hooks, 'parse_start', query)
+        statements = None
+        start = time.perf_counter()
+        try:
+            statements = psqlparse.parse(query)
+        finally:
+            _call_hooks(hooks, 'parse_end', query, statements)
+        if not statements:
+            return []
+        parse_time = (time.perf_counter() - start) / len(statements)
+        texts = _split_statements(query, len(statements))
+        return [(statement, text, parse_time) for statement, text in zip(statements, texts)]
+
+    def execute_one(self, query, params=()):
+        statements = self._parse(query)
+        if len(statements) != 1:
+            raise ValueError("multiple statements passed")
+        (statement, text, parse_time), = statements
+        return self._execute_statement(statement, params, text=text, parse_time=parse_time)
 
-    def _parse_postfix_aexpr(self, expr, sources):
-        left_element = self.parse_select_expr(expr.lexpr, sources)
-        operation = _get_postfix_aexpr_op(expr.name[0].val)
-        return Element(lambda row: operation(left_element.eval(row)))
+    def execute(self, query, params=()):
+        return list(self.execute_lazy(query, params))
 
-    def _parse_binary_aexpr(self, expr, sources):
-        left_element = self.parse_select_expr(expr.lexpr, sources)
-        right_element = self.parse_select_expr(expr.rexpr, sources)
-        operation = _get_binary_aexpr_op(expr.name[0].val)
-        return Element(lambda row: operation(left_element.eval(row), right_element.eval(row)))
+    def execute_lazy(self, query, params=()):
+        for statement, text, parse_time in self._parse(query):
+            yield self._execute_statement(statement, params, text=text, parse_time=parse_time)
+
+    def prepare(self, query):
+        """
+        Parse a single statement, to be executed any number of times.
+        """
+        statements = self.prepare_all(query)
+        if len(statements) != 1:
+            raise ValueError("multiple statements passed")
+        prepared, = statements
+        return prepared
+
+    def prepare_all(self, query):
+        return [
+            PreparedStatement(mock_db=self, statement=statement, text=text)
+            for statement, text, _ in self._parse(query)
+        ]
+
+    def executemany(self, query, seq_of_params):
+        """
+        Run a single statement once for each tuple of `$n` parameters.
+
+        The statement is only parsed once. INSERT ... VALUES is also only planned
+        once, and all of its rows are appended in one batch.
+        """
+        return self.prepare(query).executemany(seq_of_params)
+
+    def copy_expert(self, query, stream):
+        """
+        Run a single COPY statement, using `stream` for its STDIN or STDOUT.
+
+        Returns the number of rows copied.
+        """
+        return self.prepare(query).copy(stream)
+
+    def _handle_transaction_statement(self, statement):
+        kind = statement.kind
+        if kind in (TRANS_STMT_BEGIN, TRANS_STMT_START):
+            self.begin()
+            return CommandStatus('BEGIN')
+        if kind == TRANS_STMT_COMMIT:
+            tag = 'ROLLBACK' if self._failed else 'COMMIT'
+            self.commit()
+            return CommandStatus(tag)
+        if kind == TRANS_STMT_ROLLBACK:
+            self.rollback()
+            return CommandStatus('ROLLBACK')
+        raise NotImplementedError(f"TransactionStmt(kind={kind})")
+
+    def _handle_variable_set_statement(self, statement):
+        kind = statement.kind
+        if kind == VAR_RESET_ALL:
+            for key in list(self._settings):
+                self.set_setting(key, None)
+        elif kind == VAR_SET_MULTI:
+            # SET TRANSACTION and friends: transactions are always serializable here.
+            pass
+        elif kind in (VAR_SET_DEFAULT, VAR_RESET):
+            self.set_setting(statement.name, None, local=bool(statement.is_local))
+        elif kind == VAR_SET_VALUE:
+            value = ', '.join(_setting_value(arg) for arg in statement.args)
+            self.set_setting(statement.name, value, local=bool(statement.is_local))
+        else:
+            raise NotImplementedError(f"VariableSetStmt(kind={kind})")
+        return CommandStatus('RESET' if kind in (VAR_RESET, VAR_RESET_ALL) else 'SET')
+
+    def _handle_variable_show_statement(self, statement):
+        if statement.name == 'all':
+            names = sorted({*DEFAULT_SETTINGS, *self._settings}, key=str.lower)
+            return ResultSet(
+                row_names=['name', 'setting'],
+                rows=[(name, self.get_setting(name)) for name in names],
+            )
+        return ResultSet(row_names=[statement.name], rows=[(self.get_setting(statement.name),)])
+
+    def _describe_statement(self, statement):
+        param_count = _highest_param(statement)
+        param_types = {}
+        row_names = row_types = None
+        token = _param_types.set(param_types)
+        try:
+            # Subqueries in FROM run while planning, so the parameters need some value.
+            with _bind_params([None] * param_count):
+                stmt_type = type(statement).__name__
+                if stmt_type == 'SelectStmt':
+                    plan = self._plan_select(statement)
+                    if statement.into_clause is None:
+                        row_names, row_types = plan.names, plan.row_types
+                elif stmt_type == 'VariableShowStmt':
+                    row_names = ['name', 'setting'] if statement.name == 'all' else [statement.name]
+                    row_types = [self._db._get_type('text')] * len(row_names)
+                elif stmt_type == 'InsertStmt':
+                    self._describe_insert(statement)
+                elif stmt_type == 'UpdateStmt':
+                    table, sources, _ = self._plan_write_scan(statement.relation, statement.where_clause)
+                    for target in statement.target_list:
+                        if isinstance(target.val, psqlparse.nodes.SetToDefault):
+                            continue
+                        _note_param_type(target.val, table.rowtype.column_types.get(target.name))
+                        self._db.parse_select_expr(target.val, sources)
+                elif stmt_type == 'DeleteStmt':
+                    self._plan_write_scan(statement.relation, statement.where_clause)
+        finally:
+            _param_types.reset(token)
+        return StatementDescription(
+            param_types=[param_types.get(number) for number in range(1, param_count + 1)],
+            row_names=row_names,
+            row_types=row_types,
+        )
+
+    def _describe_insert(self, statement):
+        """
+        Note the types of the `$n` parameters an INSERT puts straight into columns.
+        """
+        table = self._db._get_table(statement.relation.relname, schema_name=statement.relation.schemaname)
+        select_stmt = statement.select_stmt
+        if select_stmt is None:
+            return
+        if statement.cols is None:
+            col_names = table.rowtype.columns
+        else:
+            col_names = [col.name for col in statement.cols]
+        column_types = [table.rowtype.column_types.get(name) for name in col_names]
+        if select_stmt.values_lists:
+            for values in select_stmt.values_lists:
+                for value, pgtype in zip(values, column_types):
+                    _note_param_type(value, pgtype)
+            return
+        self._plan_select(select_stmt)
+        for target, pgtype in zip(select_stmt.target_list or (), column_types):
+            _note_param_type(target.val, pgtype)
+
+    def _handle_prepare_statement(self, statement):
+        if statement.name in self._prepared_statements:
+            raise exc.DuplicatePreparedStatementError(
+                f'prepared statement "{statement.name}" already exists'
+            )
+        param_types = [self._get_column_type(type_name) for type_name in statement.argtypes or ()]
+        self._prepared_statements[statement.name] = (
+            PreparedStatement(mock_db=self, statement=statement.query),
+            param_types,
+        )
+        return CommandStatus('PREPARE')
+
+    def _get_prepared_statement(self, name):
+        try:
+            return self._prepared_statements[name]
+        except KeyError:
+            raise exc.InvalidSqlStatementNameError(
+                f'prepared statement "{name}" does not exist'
+            ) from None
+
+    def _handle_execute_statement(self, statement):
+        prepared, param_types = self._get_prepared_statement(statement.name)
+        params = [self._db.parse_select_expr(expr).eval(None) for expr in statement.params or ()]
+        params[:len(param_types)] = [
+            value if value is None else pgtype.converter(value)
+            for pgtype, value in zip(param_types, params)
+        ]
+        handler = QUERY_HANDLERS[prepared.statement_type]
+        with _bind_params(params):
+            return handler(self, prepared.statement)
+
+    def _handle_deallocate_statement(self, statement):
+        if statement.name is None:
+            self._prepared_statements.clear()
+            return CommandStatus('DEALLOCATE ALL')
+        self._get_prepared_statement(statement.name)
+        del self._prepared_statements[statement.name]
+        return CommandStatus('DEALLOCATE')
+
+    def _handle_discard_statement(self, statement):
+        if statement.target == DISCARD_SEQUENCES:
+            self._discard_sequences()
+            return CommandStatus('DISCARD SEQUENCES')
+        if statement.target != DISCARD_ALL:
+            # No plans are cached per session, and there are no temp tables.
+            return CommandStatus('DISCARD')
+        if self._base is not None:
+            raise exc.ActiveSqlTransactionError("DISCARD ALL cannot run inside a transaction block")
+        self.reset()
+        return CommandStatus('DISCARD ALL')
+
+    def _handle_create_statement(self, statement):
+        relation_data = statement.relation
+        schema_name = relation_data.schemaname if relation_data.schemaname is not None else 'public'
+        table_elts = statement.table_elts or []
+        column_data = [elt for elt in table_elts if isinstance(elt, psqlparse.nodes.ColumnDef)]
+        not_null = {
+            column.colname
+            for column in column_data
+            if column.is_not_null or any(
+                constraint.contype in (CONSTR_NOTNULL, CONSTR_PRIMARY)
+                for constraint in column.constraints or ()
+            )
+        }
+        for constraint in table_elts:
+            if isinstance(constraint, psqlparse.nodes.Constraint) and constraint.contype == CONSTR_PRIMARY:
+                not_null.update(key.str for key in constraint.keys)
+
+        column_types = {
+            column.colname: self._get_column_type(column.type_name)
+            for column in column_data
+        }
+        defaults = {}
+        for column in column_data:
+            if _is_serial_type(column.type_name):
+                # serial is shorthand for NOT NULL DEFAULT nextval() of a sequence of its own.
+                sequence = Sequence(
+                    schema_name,
+                    self._choose_relation_name(f"{relation_data.relname}_{column.colname}_seq", schema_name),
+                )
+                self._db = self._db.create_sequence(sequence)
+                defaults[column.colname] = ColumnDefault(sequence=sequence)
+                not_null.add(column.colname)
+            for constraint in column.constraints or ():
+                if constraint.contype == CONSTR_DEFAULT:
+                    defaults[column.colname] = self._compile_column_default(
+                        constraint.raw_expr, column_types[column.colname],
+                    )
+
+        table = Table(
+            schema=schema_name,
+            relname=relation_data.relname,
+            rowtype=Table.generate_rowtype(
+                [column.colname for column in column_data],
+                column_types=column_types,
+                not_null=not_null,
+                defaults=defaults,
+            ),
+        )
+        self._db = self._db.create_table(table)
+        return CommandStatus('CREATE TABLE')
+
+    def _choose_relation_name(self, name, schema_name):
+        """
+        `name`, or `name` with the lowest number after it that isn't taken.
+        """
+        candidate = name
+        suffix = 0
+        while self._db._relation_exists(candidate, schema_name):
+            suffix += 1
+            candidate = f"{name}{suffix}"
+        return candidate
+
+    def _compile_column_default(self, expr, pgtype):
+        sequence_name = _sequence_default_name(expr)
+        if sequence_name is not None:
+            return ColumnDefault(sequence=self.resolve_sequence(sequence_name))
+        element = self._db.parse_select_expr(expr)
+        converter = pgtype.converter
+        if isinstance(element, Constant):
+            value = element.value
+            try:
+                value = value if value is None else converter(value)
+            except (ValueError, ArithmeticError):
+                raise _text_input_error([pgtype], [value]) from None
+            return ColumnDefault(element=Constant(value))
 
-    def _parse_select_typecast(self, expr, sources):
-        verify_implemented(expr, ['arg', 'type_name'])
+        def value(row):
+            result = element.eval(row)
+            return result if result is None else converter(result)
+        return ColumnDefault(element=Element(value))
+
+    def _handle_create_sequence_statement(self, statement):
         verify_implemented(
-            expr.type_name,
-            ['names'],
-            # I don't really understand what typemod is.
-            # https://doxygen.postgresql.org/format__type_8c_source.html
-            expected_values={'typemod': -1},
+            statement,
+            ['sequence', 'options', 'if_not_exists'],
+            expected_values={'owner_id': 0},
         )
-        type_name = expr.type_name.names[-1].str
-        type_ref = [name.str for name in expr.type_name.names[::-1]]
-        pgtype = self._get_type(*type_ref)
-        elem = self.parse_select_expr(expr.arg, sources)
-        return Element(
-            lambda row: pgtype.converter(elem.eval(row)),
-            name=type_name,
+        relation = statement.sequence
+        schema_name = relation.schemaname if relation.schemaname is not None else 'public'
+        if self._db._relation_exists(relation.relname, schema_name):
+            if statement.if_not_exists:
+                return CommandStatus('CREATE SEQUENCE')
+            raise exc.DuplicateTableError(f'relation "{relation.relname}" already exists')
+
+        option_names = {
+            'increment': 'increment',
+            'minvalue': 'min_value',
+            'maxvalue': 'max_value',
+            'start': 'start',
+            'cache': 'cache',
+        }
+        options = {}
+        for option in statement.options or ():
+            name = option.defname
+            if name != 'cycle' and name not in option_names:
+                raise exc.FeatureNotSupportedError(f'sequence option "{name}" is not implemented')
+            key = option_names.get(name, name)
+            if key in options:
+                raise exc.PostgresSyntaxError("conflicting or redundant options")
+            if name == 'cycle':
+                options[key] = option.arg is None or _defelem_bool(option.arg.val)
+            else:
+                # NO MINVALUE and NO MAXVALUE leave the argument out.
+                options[key] = None if option.arg is None else int(option.arg.val)
+        self._db = self._db.create_sequence(Sequence(schema_name, relation.relname, **options))
+        return CommandStatus('CREATE SEQUENCE')
+
+    def _get_column_type(self, type_name):
+        type_ref = [name.str for name in type_name.names[::-1]]
+        if len(type_ref) == 1 and type_ref[0] in SERIAL_TYPES:
+            type_ref = [SERIAL_TYPES[type_ref[0]]]
+        return self._db._get_type(*type_ref)
+
+    def _handle_create_table_as_statement(self, statement):
+        verify_implemented(statement, ['query', 'into', 'relkind'])
+        into = statement.into
+        verify_implemented(into, ['rel', 'col_names', 'options'], expected_values={'on_commit': 0})
+        is_view = statement.relkind == OBJECT_MATVIEW
+        # 9.5 has no syntax for incremental maintenance, so it's a storage parameter.
+        incremental = False
+        for option in into.options or ():
+            if not is_view or option.defname != 'incremental':
+                raise exc.InvalidParameterValueError(f'unrecognized parameter "{option.defname}"')
+            incremental = option.arg is None or _defelem_bool(option.arg.val)
+
+        relation = into.rel
+        table = self._materialize(
+            schema=relation.schemaname if relation.schemaname is not None else 'public',
+            relname=relation.relname,
+            query=statement.query,
+            col_names=[name.str for name in into.col_names or ()],
+            is_view=is_view,
+            incremental=incremental,
         )
-
-    def _parse_select_funccall(self, expr, sources):
-        func_ref = [piece.str for piece in expr.funcname[::-1]]
-        func = self._get_function(*func_ref)
-        args = [self.parse_select_expr(arg, sources) for arg in expr.args]
-        return Element(
-            lambda row: func.fn(*(arg.eval(row) for arg in args)),
-            name=expr.funcname[-1].str,
+        self._db = self._db.create_table(table)
+        return CommandStatus(f"SELECT {len(table.rows)}")
+
+    def _handle_refresh_mat_view_statement(self, statement):
+        verify_implemented(statement, ['relation'])
+        relation = statement.relation
+        table = self._db._get_table(relation.relname, schema_name=relation.schemaname)
+        if table.view is None:
+            raise exc.WrongObjectTypeError(f'"{table.relname}" is not a materialized view')
+        table = self._materialize(
+            schema=table.schema,
+            relname=table.relname,
+            query=table.view.query,
+            col_names=table.rowtype.columns,
+            is_view=True,
+            incremental=table.view.incremental is not None,
         )
+        self._db = self._db._update_table(table)
+        return CommandStatus('REFRESH MATERIALIZED VIEW')
 
-    def _get_schema(self, schema_name):
-        if schema_name not in self.schemas:
-            raise exc.InvalidSchemaNameError(f"schema {schema_name!r} does not exist")
-        return self.schemas[schema_name]
+    def _materialize(self, *, schema, relname, query, col_names, is_view, incremental):
+        """
+        Build a table holding the result of `query`.
+        """
+        if not incremental:
+            table = self._result_table(
+                schema=schema,
+                relname=relname,
+                result=self._handle_select_statement(query),
+                col_names=col_names,
+            )
+            return attr.evolve(table, view=MaterializedView(query=query)) if is_view else table
 
-    def _get_function(self, func_name, schema_name=None):
-        if schema_name is None:
-            display_name = func_name
-            schema_name = 'pg_catalog'
-        else:
-            display_name = f"{schema_name}.{func_name}"
+        incremental = self._compile_incremental_view(query)
+        table = Table(
+            schema=schema,
+            relname=relname,
+            rowtype=_result_rowtype(
+                incremental.select_list.names,
+                [target.pgtype for target in incremental.select_list.targets],
+                col_names,
+            ),
+            view=MaterializedView(query=query, incremental=incremental),
+        )
+        base_schema, base_relname = incremental.base
+        return incremental.apply(table, self._db._get_table(base_relname, base_schema).rows)
 
-        schema = self._get_schema(schema_name)
-        if func_name not in schema.functions:
-            raise exc.UndefinedFunctionError(
-                f"function {display_name}() does not exist"
+    def _result_table(self, *, schema, relname, result, col_names=(), derived=False):
+        """
+        Build a table holding the rows of a ResultSet.
+        """
+        rowtype = _result_rowtype(result.row_names, result.row_types, col_names, derived=derived)
+        names = rowtype.columns
+        make_row = rowtype._from_trusted
+        return Table(schema=schema, relname=relname, rowtype=rowtype).insert(
+            [make_row(dict(zip(names, row))) for row in result.rows]
+        )
+
+    def _compile_incremental_view(self, query):
+        unsupported = exc.FeatureNotSupportedError(
+            "incremental materialized views can only filter, project and aggregate one table"
+        )
+        try:
+            verify_implemented(
+                query,
+                ['from_clause', 'target_list', 'where_clause', 'group_clause', 'having_clause'],
+                expected_values={'op': 0, 'statement': 'SELECT'},
             )
-        return schema.functions[func_name]
+        except NotImplementedError:
+            raise unsupported from None
+        if len(query.from_clause or ()) != 1 or not isinstance(query.from_clause[0], psqlparse.nodes.RangeVar):
+            raise unsupported
+        from_sources, _ = self._parse_from_clauses(query.from_clause[0])
+        (table, alias), = from_sources.all_tables()
+        if table.view is not None:
+            raise unsupported
+        select_list = self._compile_select_list(query, from_sources)
+        if select_list.windowing is not None:
+            raise unsupported
+        return IncrementalView(
+            base=(table.schema, table.relname),
+            source=(table, alias),
+            select_list=select_list,
+            null_row=from_sources.null_row(),
+        )
 
-    def _get_type(self, type_name, schema_name=None):
-        if schema_name is None:
-            display_name = type_name
-            schema_name = 'pg_catalog'
+    def _handle_insert_statement(self, statement):
+        return self._execute_insert(statement, [_bound_params.get()])
+
+    def _execute_insert(self, statement, seq_of_params):
+        verify_implemented(statement, ['relation', 'cols', 'select_stmt'])
+        relation_data = statement.relation
+
+        table = self._db._get_table(
+            schema_name=relation_data.schemaname,
+            relname=relation_data.relname,
+        )
+        _check_writable(table)
+
+        select_stmt = statement.select_stmt
+        if select_stmt is None:
+            # DEFAULT VALUES: a row of nothing but defaults for each set of parameters.
+            with _planning():
+                plan = self._plan_insert(table, None, 0)
+            _, inserted = self._insert_values(table, plan, [()] * len(seq_of_params))
+            return CommandStatus(f"INSERT 0 {inserted}")
+        if select_stmt.values_lists:
+            with _planning():
+                values_rows = compile_values_lists(select_stmt.values_lists, self._db)
+            value_rows = []
+            for params in seq_of_params:
+                with _bind_params(params):
+                    value_rows.extend(evaluate_values_rows(values_rows))
+            with _planning():
+                plan = self._plan_insert(table, statement.cols, len(values_rows[0]))
+            _, inserted = self._insert_values(table, plan, value_rows)
+            return CommandStatus(f"INSERT 0 {inserted}")
+
+        # Each run of the SELECT sees the rows the runs before it inserted,
+        # as it would running the statements one at a time.
+        plan = None
+        inserted = 0
+        for params in seq_of_params:
+            with _bind_params(params):
+                result = self._handle_select_statement(select_stmt)
+            if plan is None:
+                with _planning():
+                    plan = self._plan_insert(table, statement.cols, len(result.row_names))
+            table, count = self._insert_values(table, plan, list(result.rows))
+            inserted += count
+        return CommandStatus(f"INSERT 0 {inserted}")
+
+    def _insert_values(self, table, plan, value_rows):
+        """
+        Insert rows of values through an InsertPlan, returning the new table and how many rows went in.
+        """
+        with _writing(table, 'INSERT', len(value_rows)):
+            rows = plan.build_rows(value_rows)
+            table = table.insert(rows)
+            self._db = self._db.update_table(table)
+        return table, len(rows)
+
+    def _plan_insert(self, table, cols, width):
+        if cols is None:
+            if width > len(table.rowtype.columns):
+                raise exc.PostgresSyntaxError("INSERT has more expressions than target columns")
+            # Omitted trailing columns get their defaults.
+            col_names = table.rowtype.columns[:width]
         else:
-            display_name = f"{schema_name}.{type_name}"
-        schema = self._get_schema(schema_name)
-        if type_name not in schema.types:
-            raise exc.UndefinedObjectError(f'type "{display_name}" does not exist')
-        return schema.types[type_name]
+            col_names = [col.name for col in cols]
+            if width > len(col_names):
+                raise exc.PostgresSyntaxError("INSERT has more expressions than target columns")
+            if width < len(col_names):
+                raise exc.PostgresSyntaxError("INSERT has more target columns than expressions")
+        return InsertPlan.create(table, col_names)
+
+    def _handle_update_statement(self, statement):
+        verify_implemented(statement, ['relation', 'target_list', 'where_clause'])
+        table, sources, matches = self._plan_write_scan(statement.relation, statement.where_clause)
+        columns = table.rowtype.columns
+        assignments = {}
+        for target in statement.target_list:
+            verify_implemented(target, ['name', 'val'])
+            if target.name not in columns:
+                raise exc.UndefinedColumnError(
+                    f'column "{target.name}" of relation "{table.relname}" does not exist'
+                )
+            if target.name in assignments:
+                raise exc.DuplicateColumnError(f'multiple assignments to same column "{target.name}"')
+            if isinstance(target.val, psqlparse.nodes.SetToDefault):
+                assignments[target.name] = Constant(_DEFAULT)
+                continue
+            with _planning():
+                assignments[target.name] = self._db.parse_select_expr(target.val, sources)
+
+        row_ids = []
+        value_rows = []
+        for row_id, row, scan_row in matches():
+            row_ids.append(row_id)
+            value_rows.append(tuple([
+                assignments[column].eval(scan_row) if column in assignments else row[column]
+                for column in columns
+            ]))
+        if row_ids:
+            with _writing(table, 'UPDATE', len(row_ids)):
+                rows = InsertPlan.create(table, columns).build_rows(value_rows)
+                self._db = self._db.update_table(table.update(row_ids, rows))
+        return CommandStatus(f"UPDATE {len(row_ids)}")
+
+    def _handle_delete_statement(self, statement):
+        verify_implemented(statement, ['relation', 'where_clause'])
+        table, _, matches = self._plan_write_scan(statement.relation, statement.where_clause)
+        row_ids = [row_id for row_id, _, _ in matches()]
+        if row_ids:
+            with _writing(table, 'DELETE', len(row_ids)):
+                self._db = self._db.update_table(table.delete(row_ids))
+        return CommandStatus(f"DELETE {len(row_ids)}")
+
+    def _plan_write_scan(self, relation, where_clause):
+        """
+        Find the table an UPDATE or DELETE writes to, and compile its WHERE clause.
 
+        Returns the table, the QueryTables its expressions are compiled against,
+        and a function yielding (row id, row, scan row) for each row to write.
+        """
+        table = self._db._get_table(relation.relname, schema_name=relation.schemaname)
+        _check_writable(table)
+        alias = relation.alias.aliasname if relation.alias else None
+        sources = QueryTables()
+        sources.add(table=table, alias=alias)
+        sources = attr.evolve(sources, scope=QueryScope(compile_subquery=self._plan_select))
+        where = None
+        if where_clause is not None:
+            with _planning():
+                where = self._db.parse_select_expr(where_clause, sources=sources)
+        source = (table, alias)
+
+        def matches():
+            for row_id, row in table.rows.items():
+                scan_row = frozendict({source: row})
+                if where is None or where.eval(scan_row):
+                    yield row_id, row, scan_row
+        return table, sources, matches
+
+    def _handle_vacuum_statement(self, statement):
+        verify_implemented(statement, ['options', 'relation', 'va_cols'])
+        if statement.options & ~(VACOPT_VACUUM | VACOPT_ANALYZE | VACOPT_VERBOSE | VACOPT_FULL):
+            raise NotImplementedError(f"VACUUM options {statement.options}")
+        columns = [column.str for column in statement.va_cols] if statement.va_cols else None
+        if not statement.options & VACOPT_VACUUM:
+            # Unlike VACUUM, ANALYZE can run inside a transaction block.
+            self.analyze(self._get_vacuum_relation(statement, self.snapshot()), columns)
+            return CommandStatus("ANALYZE")
+        if self._base is not None:
+            self.abort()
+            raise exc.ActiveSqlTransactionError("VACUUM cannot run inside a transaction block")
+        relation = self._get_vacuum_relation(statement, self._committed.db)
+        self.vacuum(relation)
+        if statement.options & VACOPT_ANALYZE:
+            self.analyze(relation, columns)
+        return CommandStatus("VACUUM")
+
+    @staticmethod
+    def _get_vacuum_relation(statement, db):
+        relation = statement.relation
+        if relation is None:
+            return None
+        table = db._get_table(relation.relname, schema_name=relation.schemaname)
+        return table.schema, table.relname
 
-@attr.s(slots=True)
-class QueryTables:  # XXX bad name
-    _aliases = attr.ib(default=(), converter=dict)
-    # {relname: {schema: _}}
-    _tables = attr.ib(default=(), converter=lambda data: collections.defaultdict(dict, data))
+    def analyze(self, relation=None, columns=None):
+        """
+        Collect planner statistics on every table, or just the (schema, relname) `relation`.
 
-    def _clone(self):
-        return attr.evolve(
-            self,
-            tables=(
-                (relname, dict(schemas))
-                for relname, schemas in self._tables.items()
-            )
+        With `columns`, only those columns of `relation` are analyzed again.
+        """
+        self._run_in_transaction(self._analyze, relation, columns)
+
+    def _analyze(self, relation, columns):
+        target = _statistics_target_setting(
+            'default_statistics_target', self.get_setting('default_statistics_target'),
         )
+        db = self._db
+        for schema_name, schema in self._db.schemas.items():
+            for relname, table in schema.tables.items():
+                if relation is not None and relation != (schema_name, relname):
+                    continue
+                table_columns = table.rowtype.columns
+                if columns is not None:
+                    for column in columns:
+                        if column not in table_columns:
+                            raise exc.UndefinedColumnError(
+                                f'column "{column}" of relation "{relname}" does not exist'
+                            )
+                with _writing(table, 'ANALYZE', len(table.rows)):
+                    statistics = TableStatistics.collect(
+                        table,
+                        table_columns if columns is None else columns,
+                        target,
+                        previous=table.statistics if columns is not None else None,
+                    )
+                db = db._update_table(attr.evolve(table, statistics=statistics))
+        self._db = db
+
+    def vacuum(self, relation=None):
+        """
+        Compact away the tombstones of every table, or just the (schema, relname) `relation`.
 
-    def add(self, *, table, alias=None):
-        if alias:
-            if alias in self._aliases or alias in self._tables:
-                raise exc.DuplicateAliasError(alias)
-            self._aliases[alias] = table
-        else:
-            if table.relname in self._aliases or table.schema in self._tables.get(table.relname, ()):
-                raise exc.DuplicateAliasError(table.relname)
-            self._tables[table.relname][table.schema] = table
+        Tables are compacted without holding up other sessions: if one commits
+        in the meantime, compaction starts over from what it committed.
+        """
+        committed = self._committed
+        while True:
+            head = committed.db
+            db = head
+            for schema_name, schema in head.schemas.items():
+                for relname, table in schema.tables.items():
+                    if relation is not None and relation != (schema_name, relname):
+                        continue
+                    if table.rows.tombstones:
+                        with _writing(table, 'VACUUM', table.rows.tombstones):
+                            # Same rows, so incremental views don't need to hear about it.
+                            db = db._update_table(attr.evolve(table, rows=table.rows.compact()))
+            with committed.lock:
+                if committed.db is head:
+                    committed.db = db
+                    break
+        self._db = db
+
+    def _handle_copy_statement(self, statement):
+        count = self._copy(statement, stream=None)
+        return CommandStatus(f"COPY {count}")
+
+    def _copy(self, statement, stream):
+        verify_implemented(
+            statement,
+            ['relation', 'query', 'attlist', 'is_from', 'filename', 'options'],
+        )
+        copy_format = CopyFormat.from_options(statement.options or ())
+        copy_fn = self._copy_from if statement.is_from else self._copy_to
+        if statement.filename is not None:
+            mode = 'r' if statement.is_from else 'w'
+            with open(statement.filename, mode, newline='') as file:
+                return copy_fn(statement, copy_format, file)
+        if stream is None:
+            direction = 'FROM STDIN' if statement.is_from else 'TO STDOUT'
+            raise ValueError(f"COPY {direction} needs a stream; use copy_expert()")
+        return copy_fn(statement, copy_format, stream)
+
+    def _get_copy_columns(self, statement, table):
+        if not statement.attlist:
+            return list(table.rowtype.columns)
+        col_names = [col.str for col in statement.attlist]
+        for col_name in col_names:
+            if col_name not in table.rowtype.columns:
+                raise exc.UndefinedColumnError(
+                    f'column "{col_name}" of relation "{table.relname}" does not exist'
+                )
+        return col_names
 
-    def all_tables(self):
-        for alias, table in self._aliases.items():
-            yield table, alias
-        for schemas in self._tables.values():
-            for table in schemas.values():
-                yield table, None
+    def _copy_from(self, statement, copy_format, stream):
+        relation_data = statement.relation
+        table = self._db._get_table(relation_data.relname, schema_name=relation_data.schemaname)
+        _check_writable(table)
+        col_names = self._get_copy_columns(statement, table)
+        pgtypes = [table.rowtype.column_types[col_name] for col_name in col_names]
+        converters = [_text_input_converter(pgtype) for pgtype in pgtypes]
+        make_row = table.rowtype._from_trusted
+        # Columns left out of the column list get their defaults, or come up NULL.
+        left_out = [col for col in table.rowtype.columns if col not in col_names]
+        defaults = [(col, table.rowtype.defaults[col]) for col in left_out if col in table.rowtype.defaults]
+        missing = dict.fromkeys(col for col in left_out if col not in table.rowtype.defaults)
+
+        def convert(values):
+            try:
+                row = dict(zip(col_names, [
+                    value if value is None or converter is None else converter(value)
+                    for converter, value in zip(converters, values)
+                ]))
+            except (ValueError, ArithmeticError):
+                raise _text_input_error(pgtypes, values) from None
+            if missing:
+                row.update(missing)
+            return row
+
+        rows = table.rows
+        count = 0
+        records = copy_format.read(stream, width=len(col_names))
+        while True:
+            batch = [convert(values) for values in itertools.islice(records, COPY_BATCH_SIZE)]
+            if not batch:
+                break
+            for col, default in defaults:
+                for row, value in zip(batch, default.generate(len(batch))):
+                    row[col] = value
+            with _writing(table, 'COPY', len(batch)):
+                batch = [make_row(row) for row in batch]
+                _check_not_null(table.rowtype, batch)
+                rows = rows.extend(batch)
+            count += len(batch)
+
+        self._db = self._db.update_table(attr.evolve(table, rows=rows))
+        return count
+
+    def _copy_to(self, statement, copy_format, stream):
+        if statement.query is not None:
+            result = self._handle_select_statement(statement.query)
+            return copy_format.write(result.rows, stream, headers=result.row_names)
 
-    @classmethod
-    def merge(cls, *qts):
-        qts = iter(qts)
-        first_qt = next(qts)
-        new = first_qt._clone()
-        for qt in qts:
-            for table, alias in qt.all_tables():
-                new.add(table=table, alias=alias)
-        return new
+        relation_data = statement.relation
+        table = self._db._get_table(relation_data.relname, schema_name=relation_data.schemaname)
+        col_names = self._get_copy_columns(statement, table)
+        getter = operator.itemgetter(*col_names)
+        if len(col_names) == 1:
+            rows = ((getter(row),) for row in table.rows)
+        else:
+            rows = map(getter, table.rows)
+        return copy_format.write(rows, stream, headers=col_names)
 
-    def _get_source_by_qualified_table(self, schema_name, table_name):
-        schemas = self._tables.get(table_name)
-        table = schemas and schemas.get(schema_name)
-        if not table:
-            raise exc.UndefinedTableError(f"missing FROM-clause entry for table {table_name!r}")
-        return table, None
+    def _handle_select_statement(self, statement):
+        cache = self._committed.result_cache
+        if cache is None or statement.into_clause is not None or statement.locking_clause:
+            return self._execute_select(statement)
 
-    def _get_source_by_table(self, name):
-        if name in self._aliases:
-            return self._aliases[name], name
-        if name in self._tables:
-            tables = self._tables[name]
-            if len(tables) > 1:
-                raise exc.AmbiguousTableError(f"table reference {name!r} is ambiguous")
-            return one(tables.values()), None
-        raise exc.UndefinedTableError(f"missing FROM-clause entry for table {name!r}")
+        statement_fingerprint = fingerprint(statement)
+        params = tuple(_bound_params.get())
+        key = (statement_fingerprint.key, params)
+        try:
+            hash(key)
+        except TypeError:
+            return self._execute_select(statement)
+        for schema_name, func_name in statement_fingerprint.functions:
+            if self._db._get_function(func_name, schema_name).volatile:
+                return self._execute_select(statement)
+        # System views change without any table changing.
+        for schema_name, relname in statement_fingerprint.relations:
+            if relname in SYSTEM_VIEWS and schema_name in (None, 'pg_catalog'):
+                return self._execute_select(statement)
+
+        tables = tuple(
+            self._db._find_table(relname, schema_name)
+            for schema_name, relname in sorted(statement_fingerprint.relations, key=str)
+        )
+        result = cache.get(key, tables)
+        if result is None:
+            result = self._execute_select(statement)
+            cache.put(key, tables, result)
+        # Callers own the list of rows they get back.
+        return attr.evolve(result)
+
+    def _execute_select(self, statement, *, ctes=None, read=None, col_names=()):
+        """
+        Run a SELECT. As a FROM item, `read` can name the only output columns,
+        going by `col_names`, worth computing.
+        """
+        with _planning():
+            plan = self._plan_select(statement, ctes=ctes)
+            self._prune_outputs(plan, statement, read, col_names)
+        return ResultSet(
+            row_names=plan.names,
+            rows=plan.run(),
+            row_types=plan.row_types,
+        )
 
-    def _get_source_by_column(self, column_name):
-        column_source = None
-        for table, alias in self.all_tables():
-            if column_name in table.rowtype.columns:
-                if column_source is not None:
-                    raise exc.AmbiguousColumnError(f"column reference {column_name!r} is ambiguous")
-                column_source = table, alias
-        if not column_source:
-            raise exc.UndefinedColumnError(f"column {column_name!r} does not exist")
-        return column_source
+    def _plan_select(self, statement, outer=None, *, ctes=None):
+        """
+        Compile a SELECT, as a subquery of the query `outer` is the QueryTables of if given.
 
-    def get_column_source(self, column_name, table_name=None, schema_name=None):
-        if not table_name:
-            return self._get_source_by_column(column_name)
-        elif not schema_name:
-            return self._get_source_by_table(table_name)
-        return self._get_source_by_qualified_table(schema_name, table_name)
+        `ctes` are the WITH queries in view, by default those of `outer`.
+        """
+        if ctes is None:
+            ctes = outer.scope.ctes if outer is not None else collections.ChainMap()
+        if statement.with_clause is not None:
+            ctes = self._define_ctes(statement, ctes)
+        if (statement.op or SETOP_NONE) != SETOP_NONE:
+            return self._plan_set_operation(statement, outer, ctes)
+        verify_implemented(
+            statement,
+            [
+                'from_clause', 'target_list', 'where_clause', 'group_clause', 'having_clause',
+                'sort_clause', 'with_clause', 'distinct_clause', 'window_clause',
+            ],
+            expected_values={'op': SETOP_NONE, 'statement': 'SELECT'},
+        )
+        scope = QueryScope(compile_subquery=self._plan_select, outer=outer, ctes=ctes, statement=statement)
 
-    def null_row(self):
-        return {
-            (table, alias): table.rowtype.null_row()
-            for table, alias in self.all_tables()
+        from_items = [self._parse_from_clauses(clause, scope) for clause in statement.from_clause or ()]
+        from_sources = QueryTables()
+        for item_sources, _ in from_items:
+            from_sources = QueryTables.merge(item_sources, from_sources)
+        from_sources = attr.evolve(from_sources, scope=scope)
+        if statement.where_clause is not None:
+            for _, item_rows in from_items:
+                if isinstance(item_rows, InlineCteScan):
+                    self._push_down(item_rows, list(_conjuncts(statement.where_clause)), from_sources)
+
+        analyzed = any(table.statistics is not None for table, _ in from_sources.all_tables())
+        if len(from_items) > 1 and statement.where_clause is not None and analyzed:
+            rows = self._plan_from_list(from_items, statement.where_clause, from_sources)
+        else:
+            rows = [{}]
+            for position, (_, item_rows) in enumerate(from_items):
+                if position:
+                    rows = _trace('Nested Loop', self._merge_rows(rows, item_rows), 'CROSS')
+                else:
+                    rows = item_rows
+        return SelectPlan(
+            scope=scope,
+            sources=from_sources,
+            select_list=self._compile_select_list(statement, from_sources),
+            null_row=from_sources.null_row(),
+            from_rows=rows,
+            work_mem=_memory_setting_bytes('work_mem', self.get_setting('work_mem')),
+        )
+
+    def _plan_from_list(self, from_items, where_clause, from_sources):
+        """
+        Join the items of a FROM list in the order the planner statistics say is cheapest.
+
+        WHERE conjuncts that only read one item filter it before it's joined,
+        and ones reading several filter the join that brings in the last of
+        them: a merge join, if both sides are sorted on the columns they
+        compare, otherwise a hash join, if they compare columns for equality.
+        The whole WHERE clause still runs afterwards, so this only ever drops
+        rows early.
+        Lists longer than from_collapse_limit are joined in the order written.
+        """
+        item_positions = {
+            source: position
+            for position, (item_sources, _) in enumerate(from_items)
+            for source in item_sources.all_tables()
         }
 
+        def column_position(key):
+            try:
+                return item_positions.get(from_sources.get_column_source(*key))
+            except (exc.PostgresError, TypeError):
+                return None
+
+        filters = collections.defaultdict(list)
+        joins = []
+        for conjunct in _conjuncts(where_clause):
+            # Conjuncts reading outer queries can't filter rows that are only built once.
+            if not self._is_stable_expr(conjunct, lambda key: column_position(key) is not None):
+                continue
+            positions = frozenset(column_position(_column_ref_key(column)) for column in _column_refs(conjunct))
+            if len(positions) == 1:
+                filters[next(iter(positions))].append(conjunct)
+            elif positions:
+                joins.append((positions, conjunct))
+
+        order = range(len(from_items))
+        collapse_limit = _collapse_limit_setting('from_collapse_limit', self.get_setting('from_collapse_limit'))
+        if len(from_items) <= collapse_limit:
+            hash_joins = _bool_setting('enable_hashjoin', self.get_setting('enable_hashjoin'))
+            estimates = [
+                self._estimate_rows(item_sources, item_rows, filters[position], from_sources)
+                for position, (item_sources, item_rows) in enumerate(from_items)
+            ]
+            order = _cheapest_join_order(estimates, [
+                (
+                    positions,
+                    self._estimate_selectivity(conjunct, from_sources),
+                    hash_joins and _column_equality(conjunct) is not None,
+                )
+                for positions, conjunct in joins
+            ])
+
+        rows = sources = None
+        joined = set()
+        for position in order:
+            item_sources, item_rows = from_items[position]
+            item_order = _row_order(item_rows)
+            joined.add(position)
+            if filters[position]:
+                condition = _all_of([
+                    self._db.parse_select_expr(conjunct, sources=item_sources)
+                    for conjunct in filters[position]
+                ])
+                item_rows = _trace('Filter', filter(condition.eval, item_rows))
+            if rows is None:
+                # Inner joins keep the order of their left rows, so this is the order throughout.
+                rows, sources, rows_order = item_rows, item_sources, item_order
+                continue
+            left_sources, sources = sources, QueryTables.merge(sources, item_sources)
+            conjuncts = [
+                conjunct
+                for positions, conjunct in joins
+                if position in positions and positions <= joined
+            ]
+            if not conjuncts:
+                rows = _trace('Nested Loop', self._merge_rows(rows, item_rows), 'CROSS')
+                continue
+            condition = _all_of([self._db.parse_select_expr(conjunct, sources=sources) for conjunct in conjuncts])
+            merge = self._merge_join_keys(conjuncts, rows_order, item_order, left_sources, item_sources)
+            if merge is not None:
+                rows = _trace(
+                    'Merge Join',
+                    self._merge_join_rows(rows, item_rows, condition, left_sources, item_sources, merge),
+                    'INNER',
+                )
+                continue
+            keys = self._hash_join_keys(conjuncts, left_sources, item_sources)
+            rows = _trace(
+                'Nested Loop' if keys is None else 'Hash Join',
+                self._inner_merge_rows(rows, item_rows, condition, left_sources, item_sources, keys=keys),
+                'INNER',
+            )
+        return rows
 
-class MockDatabase:
-    def __init__(self):
-        self._db = Database()
+    def _estimate_rows(self, item_sources, item_rows, conjuncts, from_sources):
+        """
+        Estimated rows a FROM item brings, once the WHERE `conjuncts` that only read it filter them.
+        """
+        if isinstance(item_rows, InlineCteScan):
+            rows = _UNKNOWN_RELATION_ROWS
+        else:
+            # Joined items are guessed to have about as many rows as their biggest table.
+            rows = max(len(table.rows) for table, _ in item_sources.all_tables())
+        for conjunct in conjuncts:
+            rows *= self._estimate_selectivity(conjunct, from_sources)
+        return max(rows, 1.0)
 
-    def _execute_statement(self, statement):
-        stmt_type = type(statement).__name__
-        handler = QUERY_HANDLERS.get(stmt_type)
-        if not handler:
-            raise NotImplementedError(stmt_type)
-        return handler(self, statement)
+    def _estimate_selectivity(self, node, sources):
+        """
+        Estimated fraction of rows of `sources` that the condition `node` keeps.
+        """
+        if isinstance(node, psqlparse.nodes.BoolExpr):
+            selectivities = [self._estimate_selectivity(arg, sources) for arg in node.args]
+            if node.boolop == 0:
+                return functools.reduce(operator.mul, selectivities, 1.0)
+            if node.boolop == 1:
+                return 1 - functools.reduce(operator.mul, (1 - selectivity for selectivity in selectivities), 1.0)
+            return 1 - selectivities[0]
+        if not (
+            isinstance(node, psqlparse.nodes.AExpr) and node.kind == AEXPR_OP
+            and node.lexpr is not None and node.rexpr is not None
+        ):
+            return DEFAULT_INEQ_SEL
+        symbol = node.name[-1].str
+        default = DEFAULT_EQ_SEL if symbol == '=' else DEFAULT_INEQ_SEL
+
+        columns = _column_equality(node)
+        if columns is not None:
+            statistics = [self._column_statistics(column, sources) for column in columns]
+            statistics = [(stats, reltuples) for stats, reltuples in statistics if stats is not None]
+            if not statistics:
+                return default
+            selectivity = 1 / max(max(stats.distinct(reltuples) for stats, reltuples in statistics), 1)
+            for stats, _ in statistics:
+                selectivity *= 1 - stats.null_frac
+            return selectivity
+
+        column, other = node.lexpr, node.rexpr
+        if not isinstance(column, psqlparse.nodes.ColumnRef):
+            column, other = other, column
+            symbol = _COMMUTED_OPERATORS.get(symbol)
+        if not isinstance(column, psqlparse.nodes.ColumnRef) or symbol is None:
+            return default
+        stats, reltuples = self._column_statistics(column, sources)
+        value = self._constant_value(other)
+        if stats is None or value is None:
+            return default
+        [value] = value
+        try:
+            if symbol == '=':
+                return stats.eq_selectivity(value, reltuples)
+            if symbol in ('<>', '!='):
+                return max(1 - stats.eq_selectivity(value, reltuples) - stats.null_frac, 0.0)
+            if symbol in ('<', '<=', '>', '>='):
+                return stats.compare_selectivity(_get_binary_aexpr_op(symbol), value)
+        except TypeError:
+            pass
+        return default
 
-    def execute_one(self, query):
-        statements = psqlparse.parse(query)
-        if len(statements) != 1:
-            raise ValueError("multiple statements passed")
-        statement, = statements
-        return self._execute_statement(statement)
+    @staticmethod
+    def _column_statistics(column_ref, sources):
+        """
+        (ColumnStatistics, rows in its table) of the column `column_ref` reads, or (None, None).
+        """
+        key = _column_ref_key(column_ref)
+        try:
+            table, _ = sources.get_column_source(*key)
+        except (exc.PostgresError, TypeError):
+            return None, None
+        if table.statistics is None or key[0] not in table.statistics.columns:
+            return None, None
+        return table.statistics.columns[key[0]], len(table.rows)
+
+    def _constant_value(self, node):
+        """
+        (value,) of an expression reading no columns, or None if it can't be worked out while planning.
+        """
+        if not self._is_stable_expr(node, lambda key: False):
+            return None
+        try:
+            return (self._db.parse_select_expr(node, sources=QueryTables()).eval(frozendict()),)
+        except Exception:
+            # It's only an estimate: errors are for running the query to raise.
+            return None
+
+    def _plan_set_operation(self, statement, outer, ctes):
+        """
+        Compile a UNION, INTERSECT or EXCEPT of two queries.
+        """
+        verify_implemented(
+            statement,
+            ['op', 'all', 'larg', 'rarg', 'sort_clause', 'with_clause'],
+            expected_values={'statement': 'SELECT'},
+        )
+        left = self._plan_select(statement.larg, outer, ctes=ctes)
+        right = self._plan_select(statement.rarg, outer, ctes=ctes)
+        op_name = {SETOP_UNION: 'UNION', SETOP_INTERSECT: 'INTERSECT', SETOP_EXCEPT: 'EXCEPT'}[statement.op]
+        if len(left.names) != len(right.names):
+            raise exc.PostgresSyntaxError(f"each {op_name} query must have the same number of columns")
+        plan = SetOperationPlan(
+            op=statement.op,
+            all=bool(statement.all),
+            left=left,
+            right=right,
+            sort_keys=[
+                (
+                    SortByStrategy(sortby_dir=expr.sortby_dir, sortby_nulls=expr.sortby_nulls),
+                    self._get_set_operation_sort_index(expr.node, left.names),
+                )
+                for expr in statement.sort_clause or ()
+            ],
+            work_mem=_memory_setting_bytes('work_mem', self.get_setting('work_mem')),
+        )
+        if plan.correlated:
+            # Both sides run again for each row of the enclosing query.
+            for leaf in _set_operation_leaves(plan):
+                leaf.scope.correlated = True
+        return plan
+
+    def _get_set_operation_sort_index(self, expr, names):
+        if isinstance(expr, psqlparse.nodes.AConst):
+            if not isinstance(expr.val, psqlparse.nodes.Integer):
+                raise exc.PostgresSyntaxError("non-integer constant in ORDER BY")
+            position = expr.val.val
+            if not 0 < position <= len(names):
+                raise exc.InvalidColumnReferenceError(
+                    f"ORDER BY position {position} is not in select list"
+                )
+            return position - 1
+        if isinstance(expr, psqlparse.nodes.ColumnRef) and len(expr.fields) == 1:
+            name = getattr(expr.fields[0], 'str', None)
+            if name in names:
+                return names.index(name)
+            raise exc.UndefinedColumnError(f'column "{name}" does not exist')
+        raise exc.FeatureNotSupportedError(
+            "invalid UNION/INTERSECT/EXCEPT ORDER BY clause",
+        )
 
-    def execute(self, query):
-        return list(self.execute_lazy(query))
+    def _define_ctes(self, statement, ctes):
+        """
+        Add the WITH queries of `statement` to the `ctes` in view.
+        """
+        with_clause = statement.with_clause
+        verify_implemented(with_clause, ['ctes', 'recursive'])
+        ctes = ctes.new_child()
+        for node in with_clause.ctes:
+            name = node.ctename
+            query = node.ctequery
+            if not isinstance(query, psqlparse.nodes.SelectStmt):
+                raise NotImplementedError(f"{type(query).__name__} in WITH")
+            recursive = bool(with_clause.recursive) and _relation_references(query, name) > 0
+            # 9.5's grammar has no [NOT] MATERIALIZED; newer parsers fill this in.
+            materialize = getattr(node, 'ctematerialized', None) or CTE_MATERIALIZE_DEFAULT
+            if recursive or materialize == CTE_MATERIALIZE_ALWAYS:
+                materialized = True
+            elif materialize == CTE_MATERIALIZE_NEVER:
+                materialized = False
+            else:
+                # Like postgres: inline queries referenced once, unless inlining
+                # would change how often volatile functions run.
+                materialized = _relation_references(statement, name) > 1 or self._calls_volatile(query)
+            ctes[name] = CommonTableExpression(
+                name=name,
+                query=query,
+                col_names=[col_name.str for col_name in node.aliascolnames or ()],
+                # Without RECURSIVE, each query only sees the ones before it.
+                ctes=ctes if with_clause.recursive else collections.ChainMap(dict(ctes.maps[0]), *ctes.parents.maps),
+                materialized=materialized,
+                recursive=recursive,
+                # The recursive term reads every column of the rows before it.
+                read=None if recursive else _read_columns(statement, query),
+            )
+        return ctes
 
-    def execute_lazy(self, query):
-        statements = psqlparse.parse(query)
-        for statement in statements:
-            yield self._execute_statement(statement)
+    def _calls_volatile(self, node):
+        return any(
+            self._db._get_function(func_name, schema_name).volatile
+            for schema_name, func_name in fingerprint(node).functions
+        )
 
-    def _handle_create_statement(self, statement):
-        relation_data = statement.relation
-        column_data = statement.table_elts or []
+    def _prune_outputs(self, plan, query, read, col_names=()):
+        """
+        Stop computing the output columns of the FROM item `query` that nothing
+        outside it reads, which come out NULL instead.
 
+        `read` are the names of the columns read, or None for all of them,
+        with the first outputs going by `col_names`. Outputs calling volatile
+        functions are still computed, and SELECT DISTINCT compares every
+        output, so it computes them all.
+        """
+        if read is None or not isinstance(plan, SelectPlan) or plan.select_list.distinct:
+            return
+        select_list = plan.select_list
+        names = [*col_names, *select_list.names[len(col_names):]]
+        targets = [
+            target if name in read or self._calls_volatile(node.val) else Constant(None, target.name, target.pgtype)
+            for name, target, node in zip(names, select_list.targets, query.target_list)
+        ]
+        plan.select_list = attr.evolve(select_list, targets=targets)
+
+    def _scan_cte(self, cte, alias):
+        if cte.materialized:
+            table = self._cte_table(cte)
+            if cte.recursive:
+                return self._scan_table(table, alias)
+            # Only the columns the WITH query didn't rename go by the names its ORDER BY knows.
+            names = [None] * len(cte.col_names) + table.rowtype.columns[len(cte.col_names):]
+            return self._scan_ordered(table, alias, cte.query, names)
+        plan = self._plan_select(cte.query, ctes=cte.ctes)
+        self._prune_outputs(plan, cte.query, cte.read, cte.col_names)
         table = Table(
-            schema=relation_data.schemaname if relation_data.schemaname is not None else 'public',
-            relname=relation_data.relname,
-            rowtype=Table.generate_rowtype(column_data),
+            schema=None,
+            relname=cte.name,
+            rowtype=_result_rowtype(plan.names, plan.row_types, cte.col_names, derived=True),
+        )
+        from_source = QueryTables()
+        from_source.add(table=table, alias=alias)
+        return from_source, InlineCteScan(
+            plan=plan,
+            source=(table, alias),
+            query=cte.query,
+            order=_source_order(table, alias, _output_order(cte.query, plan.names)),
         )
-        self._db = self._db.create_table(table)
 
-    def _handle_insert_statement(self, statement):
-        relation_data = statement.relation
+    def _cte_table(self, cte):
+        if cte.working_table is not None:
+            return cte.working_table
+        if cte.running:
+            raise exc.InvalidRecursionError(
+                f'recursive reference to query "{cte.name}" must not appear within its non-recursive term'
+            )
+        if cte.table is None:
+            if cte.recursive:
+                cte.table = self._run_recursive_cte(cte)
+            else:
+                cte.table = self._result_table(
+                    schema=None,
+                    relname=cte.name,
+                    result=self._execute_select(cte.query, ctes=cte.ctes, read=cte.read, col_names=cte.col_names),
+                    col_names=cte.col_names,
+                    derived=True,
+                )
+        return cte.table
 
-        table = self._db._get_table(
-            schema_name=relation_data.schemaname,
-            relname=relation_data.relname,
-        )
+    def _run_recursive_cte(self, cte):
+        """
+        Semi-naive evaluation: each run of the recursive term only sees the rows
+        the previous run added, until a run adds none.
+        """
+        query = cte.query
+        if query.op != SETOP_UNION:
+            raise exc.InvalidRecursionError(
+                f'recursive query "{cte.name}" does not have the form '
+                "non-recursive-term UNION [ALL] recursive-term"
+            )
+        cte.running = True
+        try:
+            result = self._execute_select(query.larg, ctes=cte.ctes)
+        finally:
+            cte.running = False
+        rowtype = _result_rowtype(result.row_names, result.row_types, cte.col_names, derived=True)
+        columns = rowtype.columns
+        make_row = rowtype._from_trusted
+        # UNION, unlike UNION ALL, drops rows any earlier iteration produced.
+        seen = None if query.all else set()
+
+        def new_rows(result):
+            if len(result.row_names) != len(columns):
+                raise exc.PostgresSyntaxError("each UNION query must have the same number of columns")
+            rows = []
+            for values in result.rows:
+                if seen is not None:
+                    if values in seen:
+                        continue
+                    seen.add(values)
+                rows.append(make_row(dict(zip(columns, values))))
+            return rows
+
+        working = new_rows(result)
+        rows = RowStore().extend(working)
+        while working:
+            cte.working_table = Table(
+                schema=None,
+                relname=cte.name,
+                rowtype=rowtype,
+                rows=RowStore().extend(working),
+            )
+            try:
+                result = self._execute_select(query.rarg, ctes=cte.ctes)
+            finally:
+                cte.working_table = None
+            working = new_rows(result)
+            rows = rows.extend(working)
+        return Table(schema=None, relname=cte.name, rowtype=rowtype, rows=rows)
+
+    def _push_down(self, scan, conjuncts, from_sources):
+        """
+        Add the WHERE conjuncts that only read an inlined WITH query to its own WHERE clause.
 
-        if statement.cols is None:
-            col_names = list(table.rowtype.columns)
-        else:
-            col_names = [col.name for col in statement.cols]
-        rows = simple_select(statement.select_stmt, self._db)
+        They stay in the outer WHERE clause too, so this only ever drops rows early.
+        """
+        plan = scan.plan
+        if not isinstance(plan, SelectPlan):
+            return
+        select_list = plan.select_list
+        if select_list.grouping is not None or select_list.distinct_on or select_list.windowing is not None:
+            return
+        table, alias = scan.source
+        other_columns = {
+            column
+            for source in from_sources.all_tables()
+            if source != scan.source
+            for column in source[0].rowtype.columns
+        }
+        substitutions = {}
+        for column, target in zip(table.rowtype.columns, scan.query.target_list):
+            substitutions[column, alias or table.relname] = target.val
+            if column not in other_columns:
+                substitutions[column,] = target.val
+
+        pushed = []
+        for conjunct in conjuncts:
+            if self._can_push_down(conjunct, substitutions):
+                with plan.scope.substituting(substitutions):
+                    pushed.append(self._db.parse_select_expr(conjunct, sources=plan.sources))
+        if pushed:
+            plan.select_list = attr.evolve(
+                plan.select_list,
+                where=_all_of([plan.select_list.where, *pushed]),
+            )
 
-        table = table.insert(
-            table.rowtype(zip(
-                col_names,
-                row,
-            ))
-            for row in rows
-        )
-        self._db = self._db.update_table(table)
+    def _can_push_down(self, node, substitutions):
+        return self._is_stable_expr(node, substitutions.__contains__)
 
-    def _handle_select_statement(self, statement):
-        verify_implemented(
-            statement,
-            ['from_clause', 'target_list', 'where_clause', 'sort_clause'],
-            # Not sure what op is.
-            expected_values={'op': 0, 'statement': 'SELECT'},
+    def _is_stable_expr(self, node, has_column):
+        """
+        Whether `node` only reads constants, parameters and the columns `has_column` accepts,
+        through operators and non-volatile functions.
+
+        Those can be evaluated anywhere their columns are, as early or as often as it takes.
+        `has_column` gets a column reference as a tuple like (column, table).
+        """
+        if isinstance(node, list):
+            return all(self._is_stable_expr(item, has_column) for item in node)
+        if not hasattr(node, '__dict__'):
+            return True
+        if isinstance(node, psqlparse.nodes.ColumnRef):
+            return has_column(_column_ref_key(node))
+        if isinstance(node, psqlparse.nodes.FuncCall):
+            func_ref = [piece.str for piece in node.funcname[::-1]]
+            try:
+                func = self._db._get_function(*func_ref)
+            except exc.PostgresError:
+                return False
+            if isinstance(func, (Aggregate, WindowFunction)) or func.volatile:
+                return False
+        elif not isinstance(node, _PUSHABLE_NODES):
+            return False
+        return all(
+            self._is_stable_expr(value, has_column)
+            for field, value in vars(node).items()
+            if not field.startswith('_')
         )
-        from_sources = QueryTables()
-        rows = [{}]
-        for clause in statement.from_clause or ():
-            agg_from_source, agg_row = self._parse_from_clauses(clause)
-            from_sources = QueryTables.merge(agg_from_source, from_sources)
-            rows = self._merge_rows(rows, agg_row)
-
-        # select columns
-        row_sources = []
-        row_names = []
-        for target in statement.target_list or []:
-            element = self._db.parse_select_expr(target.val, sources=from_sources)
-            name = target.name or ('?column?' if element.name is None else element.name)
-            row_sources.append(element)
-            row_names.append(name)
 
+    def _compile_select_list(self, statement, from_sources):
+        """
+        Compile a SELECT's expressions against the tables of its FROM clause.
+        """
+        where = None
         if statement.where_clause:
-            where_expr = self._db.parse_select_expr(statement.where_clause, sources=from_sources)
-            rows = (
-                row for row in rows
-                if where_expr.eval(row)
-            )
+            where = self._db.parse_select_expr(statement.where_clause, sources=from_sources)
 
-        if statement.sort_clause:
-            rows = self._apply_sort_expr(
-                sort_clause=statement.sort_clause,
-                rows=rows,
-                sources=from_sources,
-            )
+        grouping = Grouping(has_having=statement.having_clause is not None)
+        for expr in statement.group_clause or ():
+            self._add_group_key(grouping, expr, statement.target_list or (), from_sources)
+        sources = attr.evolve(from_sources, grouping=grouping)
+        windowing = Windowing(statement.window_clause or ())
+        window_sources = attr.evolve(sources, windowing=windowing)
 
-        result_rows = (
-            tuple(
-                source.eval(row)
-                for source in row_sources
-            )
-            for row in rows
-        )
+        targets = []
+        names = []
+        for target in statement.target_list or []:
+            element = self._db.parse_select_expr(target.val, sources=window_sources)
+            name = target.name or ('?column?' if element.name is None else element.name)
+            targets.append(element)
+            names.append(name)
 
-        return ResultSet(
-            row_names=row_names,
-            rows=result_rows,
-        )
+        having = None
+        if statement.having_clause is not None:
+            having = self._db.parse_select_expr(statement.having_clause, sources=sources)
 
-    def _apply_sort_expr(self, *, sort_clause, rows, sources):
-        strats = [
+        sort_keys = [
             (
                 SortByStrategy(
                     sortby_dir=expr.sortby_dir,
                     sortby_nulls=expr.sortby_nulls,
                 ),
-                self._get_sortby_element(expr.node, sources=sources),
+                self._get_sortby_element(expr.node, sources=window_sources, targets=targets, names=names),
             )
-            for expr in sort_clause
+            for expr in statement.sort_clause or ()
         ]
 
-        return sorted(rows, key=lambda row: tuple(
-            SortByKey(
-                strat=strat,
-                value=element.eval(row),
-            )
-            for strat, element in strats
-        ))
+        distinct = False
+        distinct_on = ()
+        if statement.distinct_clause:
+            if all(expr is None for expr in statement.distinct_clause):
+                distinct = True
+                self._check_distinct_sort(statement, sort_keys, targets)
+            else:
+                distinct_on = [
+                    self._get_sortby_element(expr, sources=window_sources, targets=targets, names=names)
+                    for expr in statement.distinct_clause
+                ]
+                self._check_distinct_on_sort(statement, sort_keys, distinct_on)
+
+        if grouping.active:
+            grouping.verify()
+        else:
+            grouping = None
+        if not windowing.active:
+            windowing = None
+        return SelectList(
+            where=where,
+            grouping=grouping,
+            having=having,
+            targets=targets,
+            names=names,
+            sort_keys=sort_keys,
+            distinct=distinct,
+            distinct_on=distinct_on,
+            windowing=windowing,
+        )
 
-    def _get_sortby_element(self, expr, sources):
-        expr_type = type(expr).__name__
-        if expr_type == 'AConst':
-            const_type = type(expr.val).__name__
-            if const_type != 'Integer':
-                raise exc.PostgresSyntaxError("non-integer constant in ORDER BY")
-            raise NotImplementedError(expr_type)
-        elif expr_type == 'ColumnRef':
-            last = expr.fields[-1]
-            # I think the parser catches this as a syntax error.
-            assert not isinstance(last, psqlparse.nodes.AStar)
-            column = last.str
+    def _check_distinct_sort(self, statement, sort_keys, targets):
+        target_keys = {fingerprint(target.val).key for target in statement.target_list or ()}
+        for expr, (_, element) in zip(statement.sort_clause or (), sort_keys):
+            if not any(element is target for target in targets) and \
+                    fingerprint(expr.node).key not in target_keys:
+                raise exc.InvalidColumnReferenceError(
+                    "for SELECT DISTINCT, ORDER BY expressions must appear in select list"
+                )
+
+    def _check_distinct_on_sort(self, statement, sort_keys, distinct_on):
+        # Keeping the first row of each group only means something if the
+        # groups sort together, so ORDER BY has to start with DISTINCT ON.
+        on_keys = [fingerprint(node).key for node in statement.distinct_clause]
+        for expr, (_, element) in zip(statement.sort_clause or (), sort_keys[:len(distinct_on)]):
+            key = fingerprint(expr.node).key
+            if not any(element is on or key == on_key for on, on_key in zip(distinct_on, on_keys)):
+                raise exc.InvalidColumnReferenceError(
+                    "SELECT DISTINCT ON expressions must match initial ORDER BY expressions"
+                )
+
+    def _add_group_key(self, grouping, expr, target_list, sources):
+        if isinstance(expr, psqlparse.nodes.AConst):
+            if not isinstance(expr.val, psqlparse.nodes.Integer):
+                raise exc.PostgresSyntaxError("non-integer constant in GROUP BY")
+            position = expr.val.val
+            if not 0 < position <= len(target_list):
+                raise exc.InvalidColumnReferenceError(
+                    f"GROUP BY position {position} is not in select list"
+                )
+            expr = target_list[position - 1].val
+        elif isinstance(expr, psqlparse.nodes.ColumnRef) and len(expr.fields) == 1:
+            # Input columns win over output columns of the same name.
+            name = expr.fields[0].str
+            try:
+                sources.get_column_source(name)
+            except exc.UndefinedColumnError:
+                outputs = [target.val for target in target_list if target.name == name]
+                if not outputs:
+                    raise
+                expr = outputs[0]
+
+        column_key = None
+        if isinstance(expr, psqlparse.nodes.ColumnRef):
             column_ref = [piece.str for piece in expr.fields[::-1]]
-            column_source = sources.get_column_source(*column_ref)
-            return Element(lambda row: row[column_source][column], name=column)
-        else:
-            raise NotImplementedError(expr_type)
+            column_key = (sources.get_column_source(*column_ref), column_ref[0])
+        element = self._db.parse_select_expr(expr, sources=sources)
+        grouping.add_key(expr, element, column_key)
+
+    def _get_sortby_element(self, expr, sources, targets, names):
+        if isinstance(expr, psqlparse.nodes.AConst):
+            if not isinstance(expr.val, psqlparse.nodes.Integer):
+                raise exc.PostgresSyntaxError("non-integer constant in ORDER BY")
+            position = expr.val.val
+            if not 0 < position <= len(targets):
+                raise exc.InvalidColumnReferenceError(
+                    f"ORDER BY position {position} is not in select list"
+                )
+            return targets[position - 1]
+        if isinstance(expr, psqlparse.nodes.ColumnRef) and len(expr.fields) == 1:
+            # Output columns win over input columns of the same name.
+            name = getattr(expr.fields[0], 'str', None)
+            if name in names:
+                return targets[names.index(name)]
+        return self._db.parse_select_expr(expr, sources=sources)
 
     def _merge_rows(self, left_rows, right_rows):
-        # TODO: basic join strategies?
         right_rows = list(right_rows)
         return (
             frozendict({**left_row, **right_row})
-            for left_row in left_rows
+            for left_row in _check_each(left_rows, self._interrupts)
             for right_row in right_rows
         )
 
-    def _inner_merge_rows(self, left_rows, right_rows, quals_expr, left_sources, right_sources):
+    @staticmethod
+    def _join_candidates(right_rows, keys):
+        """
+        A function giving the `right_rows` that may join to a left row.
+
+        Without `keys`, that's all of them. With them, a (left key Elements,
+        right key Elements) pair, it's the ones with an equal key, from a hash
+        table built on the right rows. Either way in the order they came in.
+        """
+        if keys is None:
+            return lambda left_row: right_rows
+        left_keys, right_keys = keys
+        buckets = collections.defaultdict(list)
+        try:
+            for right_row in right_rows:
+                buckets[tuple(key.eval(right_row) for key in right_keys)].append(right_row)
+        except TypeError:
+            # Keys that can't be hashed, like arrays: compare every pair after all.
+            return lambda left_row: right_rows
+        empty = ()
+
+        def candidates(left_row):
+            try:
+                return buckets.get(tuple(key.eval(left_row) for key in left_keys), empty)
+            except TypeError:
+                # None of the right keys are unhashable, so none equal this one.
+                return empty
+        return candidates
+
+    def _inner_merge_rows(self, left_rows, right_rows, quals_expr, left_sources, right_sources, keys=None):
         del left_sources, right_sources
-        rows = self._merge_rows(left_rows, right_rows)
-        if quals_expr:
-            rows = filter(quals_expr.eval, rows)
-        return rows
+        if keys is None:
+            rows = self._merge_rows(left_rows, right_rows)
+            if quals_expr:
+                rows = filter(quals_expr.eval, rows)
+            return rows
+        return self._hash_merge_rows(left_rows, right_rows, quals_expr, keys)
+
+    def _hash_merge_rows(self, left_rows, right_rows, quals_expr, keys):
+        candidates = self._join_candidates(list(right_rows), keys)
+        for left_row in _check_each(left_rows, self._interrupts):
+            for right_row in candidates(left_row):
+                new_row = frozendict({**left_row, **right_row})
+                if quals_expr.eval(new_row):
+                    yield new_row
 
-    def _left_merge_rows(self, left_rows, right_rows, quals_expr, left_sources, right_sources):
+    def _left_merge_rows(self, left_rows, right_rows, quals_expr, left_sources, right_sources, keys=None):
         del left_sources
-        right_rows = list(right_rows)
-        for left_row in left_rows:
+        candidates = self._join_candidates(list(right_rows), keys)
+        for left_row in _check_each(left_rows, self._interrupts):
             lrow_used = False
-            for right_row in right_rows:
+            for right_row in candidates(left_row):
                 new_row = {**left_row, **right_row}
                 if quals_expr.eval(new_row):
                     lrow_used = True
@@ -734,7 +6057,7 @@ class MockDatabase:
             if not lrow_used:
                 yield {**left_row, **right_sources.null_row()}
 
-    def _right_merge_rows(self, left_rows, right_rows, quals_expr, left_sources, right_sources):
+    def _right_merge_rows(self, left_rows, right_rows, quals_expr, left_sources, right_sources, keys=None):
         # Sneaky. Swap left and right.
         return self._left_merge_rows(
             left_rows=right_rows,
@@ -742,14 +6065,16 @@ class MockDatabase:
             left_sources=right_sources,
             right_sources=left_sources,
             quals_expr=quals_expr,
+            keys=keys and keys[::-1],
         )
 
-    def _full_merge_rows(self, left_rows, right_rows, quals_expr, left_sources, right_sources):
+    def _full_merge_rows(self, left_rows, right_rows, quals_expr, left_sources, right_sources, keys=None):
         right_rows = list(right_rows)
+        candidates = self._join_candidates(right_rows, keys)
         missing_right = set(right_rows)
-        for left_row in left_rows:
+        for left_row in _check_each(left_rows, self._interrupts):
             lrow_used = False
-            for right_row in right_rows:
+            for right_row in candidates(left_row):
                 new_row = {**left_row, **right_row}
                 if quals_expr.eval(new_row):
                     missing_right.discard(right_row)
@@ -760,14 +6085,17 @@ class MockDatabase:
         for right_row in missing_right:
             yield {**left_sources.null_row(), **right_row}
 
-    def _merge_clauses(self, clause):
-        left_sources, left_rows = self._parse_from_clauses(clause.larg)
-        right_sources, right_rows = self._parse_from_clauses(clause.rarg)
+    def _merge_clauses(self, clause, scope=None):
+        left_sources, left_rows = self._parse_from_clauses(clause.larg, scope)
+        right_sources, right_rows = self._parse_from_clauses(clause.rarg, scope)
         sources = QueryTables.merge(left_sources, right_sources)
 
         if not clause.quals:  # cross join
             assert clause.jointype == 0, clause.jointype  # i think you can only inner cross-join
-            return sources, self._merge_rows(left_rows, right_rows)
+            return sources, _trace('Nested Loop', self._merge_rows(left_rows, right_rows), 'CROSS')
+        if scope is not None:
+            # Join rows are only built once, even for correlated subqueries.
+            sources = attr.evolve(sources, scope=attr.evolve(scope, allow_outer=False))
         quals_expr = self._db.parse_select_expr(clause.quals, sources=sources)
 
         join_fn = {
@@ -777,31 +6105,448 @@ class MockDatabase:
             3: self._right_merge_rows,
         }[clause.jointype]
 
-        rows = map(frozendict, join_fn(
-            left_rows=left_rows,
-            right_rows=right_rows,
-            quals_expr=quals_expr,
-            left_sources=left_sources,
-            right_sources=right_sources,
-        ))
-        return sources, rows
+        conjuncts = list(_conjuncts(clause.quals))
+        left_order, right_order = _row_order(left_rows), _row_order(right_rows)
+        merge = self._merge_join_keys(conjuncts, left_order, right_order, left_sources, right_sources)
+        if merge is not None:
+            rows = self._merge_join_rows(
+                left_rows, right_rows, quals_expr, left_sources, right_sources, merge, jointype=clause.jointype,
+            )
+            join_name = 'Merge Join'
+        else:
+            keys = self._hash_join_keys(conjuncts, left_sources, right_sources)
+            rows = map(frozendict, join_fn(
+                left_rows=left_rows,
+                right_rows=right_rows,
+                quals_expr=quals_expr,
+                left_sources=left_sources,
+                right_sources=right_sources,
+                keys=keys,
+            ))
+            join_name = 'Nested Loop' if keys is None else 'Hash Join'
+        rows = _trace(join_name, rows, _JOIN_TYPE_NAMES[clause.jointype])
+        # Each join goes through one side's rows in order, and keeps them in it.
+        order = {0: left_order, 1: left_order, 3: right_order}.get(clause.jointype)
+        return sources, OrderedRows(rows, order) if order else rows
 
-    def _parse_from_clauses(self, clause):
+    def _merge_join_keys(self, conjuncts, left_order, right_order, left_sources, right_sources):
+        """
+        MergeKeys for a merge join on `conjuncts`, of inputs sorted on `left_order` and `right_order`.
+
+        Equalities between the columns both sides are sorted on first are merged
+        on together, or failing that, a comparison between the first ones. None if
+        there aren't any, or merge joins are off.
+        """
+        if not left_order or not right_order:
+            return None
+        if not _bool_setting('enable_mergejoin', self.get_setting('enable_mergejoin')):
+            return None
+        # {(left (source, column), right (source, column)): [(comparison, left ColumnRef, right ColumnRef)]}
+        comparisons = collections.defaultdict(list)
+        for conjunct in conjuncts:
+            if not (
+                isinstance(conjunct, psqlparse.nodes.AExpr) and conjunct.kind == AEXPR_OP
+                and isinstance(conjunct.lexpr, psqlparse.nodes.ColumnRef)
+                and isinstance(conjunct.rexpr, psqlparse.nodes.ColumnRef)
+                and len(conjunct.name) == 1 and conjunct.name[0].str in ('=', '<', '<=', '>', '>=')
+            ):
+                continue
+            symbol = conjunct.name[0].str
+            sides = [_column_side(column, left_sources, right_sources) for column in (conjunct.lexpr, conjunct.rexpr)]
+            if sides == ['left', 'right']:
+                left_column, right_column = conjunct.lexpr, conjunct.rexpr
+            elif sides == ['right', 'left']:
+                right_column, left_column = conjunct.lexpr, conjunct.rexpr
+                symbol = _COMMUTED_OPERATORS[symbol]
+            else:
+                continue
+            left_ref, right_ref = _column_ref_key(left_column), _column_ref_key(right_column)
+            left_key = (left_sources.get_column_source(*left_ref), left_ref[0])
+            right_key = (right_sources.get_column_source(*right_ref), right_ref[0])
+            comparisons[left_key, right_key].append((symbol, left_column, right_column))
+
+        keys = []
+        for (left_source, left_name, left_strat), (right_source, right_name, right_strat) in zip(
+            left_order, right_order,
+        ):
+            if (left_strat.asc, left_strat.nulls_last) != (right_strat.asc, right_strat.nulls_last):
+                break
+            pairs = comparisons.get(((left_source, left_name), (right_source, right_name)), ())
+            equality = next((pair for pair in pairs if pair[0] == '='), None)
+            if equality is None:
+                if not keys and pairs:
+                    # A range join, on the first columns alone.
+                    keys.append((pairs[0], left_strat))
+                break
+            keys.append((equality, left_strat))
+        if not keys:
+            return None
+        (symbol, _, _), strat = keys[0]
+        # The symbol says how left compares to right, in value order.
+        comparison = _COMMUTED_OPERATORS[symbol] if strat.asc else symbol
+        return MergeKeys(
+            left_keys=[self._db.parse_select_expr(left, sources=left_sources) for (_, left, _), _ in keys],
+            right_keys=[self._db.parse_select_expr(right, sources=right_sources) for (_, _, right), _ in keys],
+            strats=[strat for _, strat in keys],
+            comparison=comparison,
+        )
+
+    def _merge_join_rows(self, left_rows, right_rows, quals_expr, left_sources, right_sources, merge, jointype=0):
+        """
+        Join rows sorted on the keys of `merge`, reading each side once, in order.
+        """
+        if jointype == 3:
+            # Sneaky. Swap left and right.
+            return self._merge_join_rows(
+                right_rows, left_rows, quals_expr, right_sources, left_sources, merge.swapped(), jointype=1,
+            )
+        return self._merge_join(
+            left_rows, right_rows, quals_expr, left_sources, right_sources, merge,
+            left_outer=jointype in (1, 2),
+            right_outer=jointype == 2,
+        )
+
+    def _merge_join(self, left_rows, right_rows, quals_expr, left_sources, right_sources, merge, *,
+                    left_outer, right_outer):
+        scan = _MergeScan(right_rows, merge, keep_passed=right_outer)
+        left_null_row = left_sources.null_row() if right_outer else None
+        for left_row in _check_each(left_rows, self._interrupts):
+            lrow_used = False
+            for entry in scan.matches(left_row):
+                new_row = frozendict({**left_row, **entry.row})
+                if quals_expr.eval(new_row):
+                    entry.matched = lrow_used = True
+                    yield new_row
+            if left_outer and not lrow_used:
+                yield frozendict({**left_row, **right_sources.null_row()})
+            if right_outer:
+                for entry in scan.take_passed():
+                    if not entry.matched:
+                        yield frozendict({**left_null_row, **entry.row})
+        if right_outer:
+            for entry in itertools.chain(scan.take_passed(), scan.rest()):
+                if not entry.matched:
+                    yield frozendict({**left_null_row, **entry.row})
+
+    def _hash_join_keys(self, conjuncts, left_sources, right_sources):
+        """
+        (left key Elements, right key Elements) for a hash join on `conjuncts`,
+        from the ones comparing a column on each side for equality.
+
+        None if there aren't any, or hash joins are off.
+        """
+        if not _bool_setting('enable_hashjoin', self.get_setting('enable_hashjoin')):
+            return None
+        left_keys = []
+        right_keys = []
+        for conjunct in conjuncts:
+            columns = _column_equality(conjunct)
+            if columns is None:
+                continue
+            sides = [_column_side(column, left_sources, right_sources) for column in columns]
+            if sides == ['left', 'right']:
+                left_column, right_column = columns
+            elif sides == ['right', 'left']:
+                right_column, left_column = columns
+            else:
+                continue
+            left_keys.append(self._db.parse_select_expr(left_column, sources=left_sources))
+            right_keys.append(self._db.parse_select_expr(right_column, sources=right_sources))
+        if not left_keys:
+            return None
+        return left_keys, right_keys
+
+    def _parse_from_clauses(self, clause, scope=None):
         if isinstance(clause, psqlparse.nodes.RangeVar):
-            from_source = QueryTables()
-            table = self._db._get_table(clause.relname, schema_name=clause.schemaname)
             alias = clause.alias.aliasname if clause.alias else None
-            from_source.add(table=table, alias=alias)
-            rows = (frozendict({(table, alias): row}) for row in table.rows)
-            return from_source, rows
+            cte = scope.ctes.get(clause.relname) if scope is not None and clause.schemaname is None else None
+            if cte is not None:
+                return self._scan_cte(cte, alias)
+            table = self._get_relation(clause.relname, schema_name=clause.schemaname)
         elif isinstance(clause, psqlparse.nodes.JoinExpr):
             verify_implemented(clause, ['larg', 'rarg', 'quals', 'jointype'])
-            return self._merge_clauses(clause)
+            return self._merge_clauses(clause, scope)
         elif isinstance(clause, psqlparse.nodes.RangeSubselect):
             verify_implemented(clause, ['subquery', 'alias'])
-            raise NotImplementedError("subselects :(")
+            if clause.alias is None:
+                raise exc.PostgresSyntaxError("subquery in FROM must have an alias")
+            alias = clause.alias.aliasname
+            col_names = [name.str for name in clause.alias.colnames or ()]
+            ctes = read = None
+            if scope is not None:
+                ctes = scope.ctes
+                if scope.statement is not None:
+                    read = _read_columns(scope.statement, clause.subquery)
+            # Materialized once, like any uncorrelated subquery.
+            result = self._execute_select(clause.subquery, ctes=ctes, read=read, col_names=col_names)
+            table = self._result_table(schema=None, relname=alias, result=result, col_names=col_names, derived=True)
+            return self._scan_ordered(table, alias, clause.subquery, result.row_names)
         else:
             raise NotImplementedError(type(clause))
+        return self._scan_table(table, alias)
+
+    def _scan_table(self, table, alias):
+        from_source = QueryTables()
+        from_source.add(table=table, alias=alias)
+        rows = _interruptible(frozendict({(table, alias): row}) for row in table.rows)
+        return from_source, _trace('Seq Scan', rows, table.relname)
+
+    def _scan_ordered(self, table, alias, query, names):
+        """
+        Scan the result of `query`, which output columns `names`, sorted as its ORDER BY left it.
+        """
+        from_source, rows = self._scan_table(table, alias)
+        order = _source_order(table, alias, _output_order(query, names))
+        return from_source, OrderedRows(rows, order) if order else rows
+
+
+@attr.s(slots=True, frozen=True)
+class PreparedStatement:
+    """
+    A parsed statement, bound to the MockDatabase it runs against.
+    """
+    _mock_db = attr.ib(repr=False)
+    statement = attr.ib()
+    # Source text, for statement statistics.
+    text = attr.ib(default=None, repr=False)
+
+    @property
+    def statement_type(self):
+        return type(self.statement).__name__
+
+    def execute(self, params=()):
+        return self._mock_db._execute_statement(self.statement, params, text=self.text)
+
+    def describe(self):
+        """
+        The StatementDescription of this statement, from planning it without running it.
+        """
+        return self._mock_db._run_in_transaction(self._mock_db._describe_statement, self.statement)
+
+    def executemany(self, seq_of_params):
+        mock_db = self._mock_db
+        if self.statement_type == 'InsertStmt':
+            seq_of_params = list(seq_of_params)
+            return mock_db._run_instrumented(
+                self.statement,
+                self.text,
+                0.0,
+                mock_db._run_in_transaction,
+                mock_db._execute_insert,
+                self.statement,
+                seq_of_params,
+                calls=len(seq_of_params) or 1,
+            )
+        for params in seq_of_params:
+            self.execute(params)
+
+    def copy(self, stream):
+        if self.statement_type != 'CopyStmt':
+            raise ValueError("expected a COPY statement")
+        mock_db = self._mock_db
+        return mock_db._run_instrumented(
+            self.statement, self.text, 0.0, mock_db._run_in_transaction, mock_db._copy, self.statement, stream,
+        )
+
+
+@attr.s(slots=True, frozen=True)
+class PoolStats:
+    size = attr.ib()
+    idle = attr.ib()
+    in_use = attr.ib()
+    # Callers currently blocked in acquire().
+    waiting = attr.ib()
+    checkouts = attr.ib()
+    # Checkouts that had to wait for a session to come back, and for how long.
+    waits = attr.ib()
+    wait_time = attr.ib()
+    max_wait_time = attr.ib()
+
+
+class SessionPool:
+    """
+    Reusable sessions on one MockDatabase.
+
+    Sessions are opened on demand, up to `max_size`. Returned sessions are
+    `reset()` and handed out again, most recently returned first.
+    """
+    def __init__(self, db, max_size=10):
+        self._db = db
+        self.max_size = max_size
+        self._idle = []
+        # Sessions checked out and not yet released.
+        self._in_use = set()
+        self._size = 0
+        self._condition = threading.Condition()
+        self._waiting = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def _available(self):
+        return self._idle or self._size < self.max_size
+
+    def acquire(self, timeout=None):
+        """
+        Check out a session, waiting up to `timeout` seconds if they're all in use.
+        """
+        with self._condition:
+            if not self._available():
+                start = time.monotonic()
+                self._waiting += 1
+                try:
+                    available = self._condition.wait_for(self._available, timeout)
+                finally:
+                    self._waiting -= 1
+                waited = time.monotonic() - start
+                self._waits += 1
+                self._wait_time += waited
+                self._max_wait_time = max(self._max_wait_time, waited)
+                if not available:
+                    raise exc.TooManyConnectionsError(
+                        f"no session available after {timeout} seconds"
+                    )
+            self._checkouts += 1
+            if self._idle:
+                session = self._idle.pop()
+            else:
+                self._size += 1
+                session = self._db.session()
+            self._in_use.add(session)
+            return session
+
+    def release(self, session):
+        """
+        Return a session checked out of this pool.
+
+        Releasing it again, or releasing one the pool didn't hand out, would
+        let two callers share it later, so those raise ValueError.
+        """
+        with self._condition:
+            if session not in self._in_use:
+                raise ValueError("session is not checked out of this pool")
+            self._in_use.remove(session)
+        session.reset()
+        with self._condition:
+            self._idle.append(session)
+            self._condition.notify()
+
+    @contextlib.contextmanager
+    def session(self, timeout=None):
+        session = self.acquire(timeout)
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def stats(self):
+        with self._condition:
+            return PoolStats(
+                size=self._size,
+                idle=len(self._idle),
+                in_use=len(self._in_use),
+                waiting=self._waiting,
+                checkouts=self._checkouts,
+                waits=self._waits,
+                wait_time=self._wait_time,
+                max_wait_time=self._max_wait_time,
+            )
+
+
+# Returned by next() on a worker thread when there's nothing left.
+_EXHAUSTED = object()
+
+
+class AsyncMockDatabase:
+    """
+    An asyncio front to a MockDatabase session.
+
+    Statements run on a worker thread of the session's own, so the event loop
+    carries on while they do: scans, sorts and joins step aside for it every
+    INTERRUPT_CHECK_INTERVAL rows. Cancelling the task waiting on a statement,
+    as `asyncio.wait_for()` does on timeout, cancels the statement.
+    """
+    def __init__(self, db=None):
+        self.db = MockDatabase() if db is None else db
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='pystgres')
+        # Created on first use, so it belongs to the running event loop.
+        self._lock = None
+
+    def session(self):
+        """
+        Open another session on the same database, with a worker thread of its own.
+        """
+        return AsyncMockDatabase(self.db.session())
+
+    async def _run(self, fn, *args):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            future = asyncio.get_running_loop().run_in_executor(self._executor, self._call, fn, args)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                interrupts = self.db._interrupts
+                # The worker may not have started the statement yet, in which case it never does.
+                interrupts.cancel(pending=True)
+                try:
+                    # The session isn't free for the next statement until this one stops.
+                    await asyncio.wait([future])
+                    # Most likely QueryCanceled, from the cancel: the caller only hears it was canceled.
+                    future.exception()
+                finally:
+                    interrupts.clear_pending()
+                raise
+
+    def _call(self, fn, args):
+        """
+        Call `fn(*args)` on the worker thread, letting the event loop run at each interrupt check.
+        """
+        interrupts = self.db._interrupts
+        interrupts.yielding = True
+        try:
+            return fn(*args)
+        finally:
+            interrupts.yielding = False
+
+    async def execute_one(self, query, params=()):
+        return await self._run(self.db.execute_one, query, params)
+
+    async def execute(self, query, params=()):
+        return [result async for result in self.execute_lazy(query, params)]
+
+    async def execute_lazy(self, query, params=()):
+        """
+        Yield the result of each statement in `query` as it finishes.
+        """
+        results = self.db.execute_lazy(query, params)
+        while True:
+            result = await self._run(next, results, _EXHAUSTED)
+            if result is _EXHAUSTED:
+                return
+            yield result
+
+    async def executemany(self, query, seq_of_params):
+        return await self._run(self.db.executemany, query, seq_of_params)
+
+    async def copy_expert(self, query, stream):
+        return await self._run(self.db.copy_expert, query, stream)
+
+    def cancel(self):
+        return self.db.cancel()
+
+    def close(self):
+        """
+        Stop the worker thread, once any statement it's running finishes.
+        """
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
 
 
 def _debug(prefix, obj):
@@ -810,16 +6555,390 @@ def _debug(prefix, obj):
     print()
 
 
-def simple_select(select_stmt, db):
-    # XXX: almost certainly gonna need to rethink how this works.
-    values = select_stmt.values_lists
-    if values:
-        for row in values:
-            yield tuple(
-                db.parse_select_expr(elem).value for elem in row
+def compile_values_lists(values_lists, db):
+    """
+    Compile the rows of a VALUES list into Constants and Elements.
+
+    Constants are read straight off the parse tree, skipping `parse_select_expr`,
+    and DEFAULT becomes a Constant of _DEFAULT.
+    """
+    width = len(values_lists[0])
+    rows = []
+    for values in values_lists:
+        if len(values) != width:
+            raise exc.PostgresSyntaxError("VALUES lists must all be the same length")
+        rows.append([
+            Constant(elem.val.val) if isinstance(elem, psqlparse.nodes.AConst)
+            else Constant(_DEFAULT) if isinstance(elem, psqlparse.nodes.SetToDefault)
+            else db.parse_select_expr(elem)
+            for elem in values
+        ])
+    return rows
+
+
+def _result_rowtype(names, row_types, col_names=(), *, derived=False):
+    """
+    Rowtype for query results, with the leading columns renamed to `col_names`.
+
+    Tables can't have two columns of the same name, but `derived` tables, of
+    subqueries and WITH queries, can. Only referring to one is an error, so
+    the columns after the first get names nothing can refer to.
+    """
+    if len(col_names) > len(names):
+        raise exc.PostgresSyntaxError("too many column names were specified")
+    names = [*col_names, *names[len(col_names):]]
+    seen = set()
+    ambiguous = set()
+    for index, name in enumerate(names):
+        if name in seen:
+            if not derived:
+                raise exc.DuplicateColumnError(f'column "{name}" specified more than once')
+            ambiguous.add(name)
+            names[index] = f"{name}\0{index}"
+        seen.add(name)
+    return Table.generate_rowtype(
+        names,
+        column_types={
+            name: pgtype
+            for name, pgtype in zip(names, row_types or ())
+            if pgtype is not None
+        },
+        ambiguous=ambiguous,
+    )
+
+
+def _is_serial_type(type_name):
+    type_ref = [name.str for name in type_name.names]
+    return len(type_ref) == 1 and type_ref[0] in SERIAL_TYPES
+
+
+def _sequence_default_name(expr):
+    """
+    The sequence name a `nextval('name')` default draws from, or None for any other default.
+    """
+    if type(expr).__name__ != 'FuncCall' or expr.over is not None:
+        return None
+    if [piece.str for piece in expr.funcname] not in (['nextval'], ['pg_catalog', 'nextval']):
+        return None
+    args = expr.args or []
+    if len(args) != 1:
+        return None
+    arg, = args
+    if type(arg).__name__ == 'TypeCast':
+        arg = arg.arg
+    if type(arg).__name__ == 'AConst' and isinstance(arg.val.val, str):
+        return arg.val.val
+    return None
+
+
+def _incremental_base(table):
+    """
+    (schema, relname) of the base table of `table`, if it's an incremental view.
+    """
+    if table is None or table.view is None or table.view.incremental is None:
+        return None
+    return table.view.incremental.base
+
+
+def _check_writable(table):
+    if table.view is not None:
+        raise exc.WrongObjectTypeError(f'cannot change materialized view "{table.relname}"')
+
+
+def _setting_value(arg):
+    if not isinstance(arg, psqlparse.nodes.AConst):
+        raise NotImplementedError(type(arg).__name__)
+    return str(arg.val.val)
+
+
+def evaluate_values_rows(values_rows):
+    return [
+        tuple([elem.eval(None) for elem in values])
+        for values in values_rows
+    ]
+
+
+# --- COPY
+
+# How many COPY rows are converted before they're appended to the row store.
+COPY_BATCH_SIZE = 10000
+# ...and how many output lines are buffered before a write.
+COPY_WRITE_BATCH_SIZE = 1000
+
+_TEXT_ESCAPES = {
+    'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v',
+}
+_TEXT_ESCAPE_RE = re.compile(r'\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))', re.DOTALL)
+
+
+def _text_unescape_match(match):
+    octal, hexadecimal, char = match.groups()
+    if octal:
+        return chr(int(octal, 8))
+    if hexadecimal:
+        return chr(int(hexadecimal, 16))
+    return _TEXT_ESCAPES.get(char, char)
+
+
+def _text_input_converter(pgtype):
+    """
+    Get the converter for a type's COPY text input, or None if it needs no conversion.
+    """
+    if pgtype.name in ('text', 'character varying'):
+        return None
+    return pgtype.converter
+
+
+def _text_input_error(pgtypes, values):
+    """
+    Build the error for a row of COPY input that failed to convert.
+    """
+    for pgtype, value in zip(pgtypes, values):
+        converter = _text_input_converter(pgtype)
+        if value is None or converter is None:
+            continue
+        try:
+            converter(value)
+        except (ValueError, ArithmeticError):
+            return exc.InvalidTextRepresentationError(
+                f'invalid input syntax for type {pgtype.name}: "{value}"'
             )
-    else:
-        raise NotImplementedError
+    return exc.InvalidTextRepresentationError("invalid input syntax")
+
+
+def _defelem_bool(value):
+    if isinstance(value, str):
+        value = value.lower()
+        if value in ('true', 'on'):
+            return True
+        if value in ('false', 'off'):
+            return False
+    elif value in (0, 1):
+        return bool(value)
+    raise exc.PostgresSyntaxError(f"{value!r} requires a Boolean value")
+
+
+def _copy_output_text(value):
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value)
+
+
+@attr.s(frozen=True, slots=True)
+class CopyFormat:
+    """
+    Options for reading and writing COPY data.
+    """
+    format = attr.ib(default='text')
+    delimiter = attr.ib(default='\t')
+    null = attr.ib(default='\\N')
+    header = attr.ib(default=False)
+    quote = attr.ib(default='"')
+    escape = attr.ib(default=None)
+    _text_escapes = attr.ib(init=False, repr=False, eq=False)
+
+    @_text_escapes.default
+    def _(self):
+        escapes = {'\\': '\\\\', '\n': '\\n', '\r': '\\r', '\t': '\\t'}
+        escapes.setdefault(self.delimiter, '\\' + self.delimiter)
+        return str.maketrans(escapes)
+
+    @classmethod
+    def from_options(cls, options):
+        kwargs = {}
+        for option in options:
+            name = option.defname
+            if name not in ('format', 'delimiter', 'null', 'header', 'quote', 'escape'):
+                raise exc.PostgresSyntaxError(f'option "{name}" not recognized')
+            if name in kwargs:
+                raise exc.PostgresSyntaxError("conflicting or redundant options")
+            value = option.arg.val if option.arg is not None else None
+            if name == 'header':
+                value = value is None or _defelem_bool(value)
+            elif value is None:
+                raise exc.PostgresSyntaxError(f"{name} requires a parameter")
+            kwargs[name] = value
+
+        copy_format = kwargs.setdefault('format', 'text').lower()
+        if copy_format not in ('text', 'csv'):
+            raise exc.InvalidParameterValueError(f'COPY format "{copy_format}" not recognized')
+        kwargs['format'] = copy_format
+        if copy_format == 'text':
+            for csv_only in ('header', 'quote', 'escape'):
+                if csv_only in kwargs:
+                    raise exc.FeatureNotSupportedError(f"COPY {csv_only} available only in CSV mode")
+        kwargs.setdefault('delimiter', '\t' if copy_format == 'text' else ',')
+        kwargs.setdefault('null', '\\N' if copy_format == 'text' else '')
+        if len(kwargs['delimiter']) != 1:
+            raise exc.FeatureNotSupportedError("COPY delimiter must be a single one-byte character")
+        return cls(**kwargs)
+
+    def read(self, stream, *, width):
+        """
+        Lazily parse `stream` into lists of raw string values (or None for NULL).
+        """
+        lines = iter(stream)
+        if self.format == 'csv':
+            if self.header:
+                next(lines, None)
+            records = self._read_csv(lines)
+        else:
+            records = self._read_text(lines)
+        for lineno, values in enumerate(records, start=1):
+            if len(values) != width:
+                message = (
+                    "extra data after last expected column"
+                    if len(values) > width else
+                    "missing data for column"
+                )
+                raise exc.BadCopyFileFormatError(f"{message} (line {lineno})")
+            yield values
+
+    def _read_text(self, lines):
+        delimiter = self.delimiter
+        null = self.null
+        for line in lines:
+            line = line.rstrip('\r\n')
+            if line == '\\.':
+                return
+            if '\\' not in line:
+                yield [None if value == null else value for value in line.split(delimiter)]
+                continue
+            yield [
+                None if value == null else _TEXT_ESCAPE_RE.sub(_text_unescape_match, value)
+                for value in self._split_escaped(line)
+            ]
+
+    def _split_escaped(self, line):
+        """
+        Split a text-format line on delimiters that aren't backslash-escaped.
+        """
+        start = 0
+        index = 0
+        while index < len(line):
+            char = line[index]
+            if char == '\\':
+                index += 2
+                continue
+            if char == self.delimiter:
+                yield line[start:index]
+                start = index + 1
+            index += 1
+        yield line[start:]
+
+    def _read_csv(self, lines):
+        delimiter = self.delimiter
+        quote = self.quote
+        null = self.null
+        for line in lines:
+            if quote not in line:
+                line = line.rstrip('\r\n')
+                if line == '\\.':
+                    return
+                yield [None if value == null else value for value in line.split(delimiter)]
+            else:
+                yield self._split_quoted(line, lines)
+
+    def _split_quoted(self, line, lines):
+        """
+        Parse one CSV record containing quotes, pulling more lines for quoted newlines.
+
+        Quoted values are never NULL, which is how CSV tells '' from NULL.
+        """
+        delimiter = self.delimiter
+        quote = self.quote
+        escape = self.escape or quote
+        values = []
+        value = []
+        quoted = False
+        in_quotes = False
+        index = 0
+        while True:
+            if index >= len(line):
+                if not in_quotes:
+                    break
+                line = next(lines, None)
+                if line is None:
+                    raise exc.BadCopyFileFormatError("unterminated CSV quoted field")
+                index = 0
+                continue
+            char = line[index]
+            if in_quotes:
+                if char == escape and line[index + 1:index + 2] == quote:
+                    value.append(quote)
+                    index += 1
+                elif char == quote:
+                    in_quotes = False
+                else:
+                    value.append(char)
+            elif char == quote:
+                in_quotes = quoted = True
+            elif char == delimiter:
+                values.append(self._csv_value(value, quoted))
+                value = []
+                quoted = False
+            elif char in '\r\n':
+                pass
+            else:
+                value.append(char)
+            index += 1
+        values.append(self._csv_value(value, quoted))
+        return values
+
+    def _csv_value(self, chars, quoted):
+        value = ''.join(chars)
+        if not quoted and value == self.null:
+            return None
+        return value
+
+    def write(self, rows, stream, *, headers):
+        """
+        Format `rows` onto `stream`, in batches. Returns the number of rows written.
+        """
+        format_line = self._format_csv if self.format == 'csv' else self._format_text
+        count = 0
+        lines = []
+        if self.header:
+            lines.append(self._format_csv(headers))
+        for row in rows:
+            lines.append(format_line(row))
+            count += 1
+            if len(lines) >= COPY_WRITE_BATCH_SIZE:
+                stream.write(''.join(lines))
+                lines = []
+        stream.write(''.join(lines))
+        return count
+
+    def _format_text(self, row):
+        null = self.null
+        escapes = self._text_escapes
+        return self.delimiter.join([
+            null if value is None
+            else value.translate(escapes) if type(value) is str
+            else _copy_output_text(value)
+            for value in row
+        ]) + '\n'
+
+    def _format_csv(self, row):
+        null = self.null
+        return self.delimiter.join([
+            null if value is None else self._quote_csv(_copy_output_text(value))
+            for value in row
+        ]) + '\n'
+
+    def _quote_csv(self, value):
+        quote = self.quote
+        needs_quotes = (
+            value == self.null
+            or self.delimiter in value
+            or quote in value
+            or '\n' in value
+            or '\r' in value
+        )
+        if not needs_quotes:
+            return value
+        escape = self.escape or quote
+        return quote + value.replace(quote, escape + quote) + quote
 
 
 @apply(''.join)
@@ -935,10 +7054,30 @@ def _get_postfix_aexpr_op(symbol):
     return operators[symbol]
 
 
+# Views in pg_catalog, built from the session's state whenever they're read.
+SYSTEM_VIEWS = {
+    'pg_stat_statements': MockDatabase._pg_stat_statements,
+    'pg_stats': MockDatabase._pg_stats,
+}
+
 QUERY_HANDLERS = {
     'CreateStmt': MockDatabase._handle_create_statement,
+    'CreateTableAsStmt': MockDatabase._handle_create_table_as_statement,
+    'CreateSeqStmt': MockDatabase._handle_create_sequence_statement,
+    'RefreshMatViewStmt': MockDatabase._handle_refresh_mat_view_statement,
     'InsertStmt': MockDatabase._handle_insert_statement,
+    'UpdateStmt': MockDatabase._handle_update_statement,
+    'DeleteStmt': MockDatabase._handle_delete_statement,
+    'VacuumStmt': MockDatabase._handle_vacuum_statement,
     'SelectStmt': MockDatabase._handle_select_statement,
+    'CopyStmt': MockDatabase._handle_copy_statement,
+    'TransactionStmt': MockDatabase._handle_transaction_statement,
+    'VariableSetStmt': MockDatabase._handle_variable_set_statement,
+    'VariableShowStmt': MockDatabase._handle_variable_show_statement,
+    'PrepareStmt': MockDatabase._handle_prepare_statement,
+    'ExecuteStmt': MockDatabase._handle_execute_statement,
+    'DeallocateStmt': MockDatabase._handle_deallocate_statement,
+    'DiscardStmt': MockDatabase._handle_discard_statement,
 }
 
 
@@ -981,6 +7120,9 @@ def _tabulate(rows, headers, *, title=None, show_row_count=True):
 def _print_result(result):
     if result is None:
         return
+    if isinstance(result, CommandStatus):
+        print(result.tag)
+        return
     _tabulate(result.rows, headers=result.row_names)
 
 
@@ -994,6 +7136,7 @@ def repl():
     import readline
 
     db = MockDatabase()
+    db.enable_statement_stats()
     print("pystgresql (pre-alpha)\nType \"help\" for help.\n")
 
     try:
@@ -1002,7 +7145,7 @@ def repl():
                 query = input('# ')
                 if _intercept_repl_command(db, query):
                     continue
-                with print_interactive_errors(query):
+                with _cancel_on_interrupt(db), print_interactive_errors(query):
                     for result in db.execute_lazy(query):
                         _print_result(result)
             except KeyboardInterrupt:
@@ -1017,6 +7160,19 @@ def repl():
         pass
 
 
+@contextlib.contextmanager
+def _cancel_on_interrupt(db):
+    """
+    Have Ctrl-C cancel the statement running, like psql, rather than stop
+    Python wherever it happens to be.
+    """
+    previous = signal.signal(signal.SIGINT, lambda signum, frame: db.cancel())
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGINT, previous)
+
+
 def _intercept_repl_command(db, query):
     query = query.rstrip()
     if query == 'help':
@@ -1026,6 +7182,7 @@ def _intercept_repl_command(db, query):
             "Type:  \\q to quit"
         )
         return True
+    raw_query = query
     # python's `split` api is a pain in the ass
     cmd, *query = query.split() or [""]
     if not cmd.startswith('\\'):
@@ -1033,12 +7190,16 @@ def _intercept_repl_command(db, query):
     cmd = cmd[1:]  # strip leading backslash
     if cmd == 'q':
         raise EOFError  # TODO i kind of hate this, circle back on it.
+    elif cmd == 'copy':
+        _repl_copy(db, raw_query.lstrip()[len('\\copy'):])
     elif cmd == '?':
         # TODO would be nice to formalize and consolidate this, so the help was sourced
         # from the actual structure of the commands.
         print(
             "General\n"
             "  \\q                     quit pystgresql\n\n"
+            "Input/Output\n"
+            "  \\copy ...              perform SQL COPY with data stream to the client host\n\n"
             "Help\n"
             "  \\?                     show help on backslash commands\n\n"
             "Informational\n"
@@ -1046,24 +7207,64 @@ def _intercept_repl_command(db, query):
             "  \\d[+]                  list tables, views, and sequences\n"
             "  \\d[+]  NAME            describe table, view, sequence, or index\n"
             "  \\dn                    list schemas\n"
-            "  \\dt                    list tables"
+            "  \\dt[+]                 list tables\n"
+            "  \\stats [N]             list the N slowest statements in total (default 10)"
         )
     elif cmd in ('d', 'd+'):
         if not query:
-            _describe_relations(db)
+            _describe_relations(db, verbose=cmd == 'd+')
         else:
             _describe_table(db, query[0])
-    elif cmd == 'dt':
-        _describe_relations(db)
+    elif cmd in ('dt', 'dt+'):
+        _describe_relations(db, verbose=cmd == 'dt+')
     elif cmd == 'dn':
         _describe_schemas(db)
+    elif cmd == 'stats':
+        _describe_statement_stats(db, int(query[0]) if query else 10)
     else:
         print(f"invalid command {cmd}\nTry \\? for help.")
     return True
 
 
+_REPL_COPY_RE = re.compile(
+    r"(?P<target>.+?)\s+(?P<direction>from|to)\s+(?P<location>'(?:[^']|'')*'|\S+)(?P<options>.*)",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+def _repl_copy(db, arguments):
+    """
+    Run psql-style `\\copy`, streaming data between a client-side file and COPY.
+    """
+    match = _REPL_COPY_RE.fullmatch(arguments.strip())
+    if not match:
+        print("\\copy: parse error at end of line")
+        return
+    copy_from = match['direction'].lower() == 'from'
+    query = "COPY {} {}{}".format(
+        match['target'],
+        'FROM STDIN' if copy_from else 'TO STDOUT',
+        match['options'],
+    )
+    location = match['location']
+    with print_interactive_errors(query):
+        if location.lower() in ('stdin', 'stdout', 'pstdin', 'pstdout'):
+            count = db.copy_expert(query, sys.stdin if copy_from else sys.stdout)
+        else:
+            if location.startswith("'"):
+                location = location[1:-1].replace("''", "'")
+            try:
+                file = open(location, 'r' if copy_from else 'w', newline='')
+            except OSError as error:
+                print(f"{location}: {error.strerror}")
+                return
+            with file:
+                count = db.copy_expert(query, file)
+        print(f"COPY {count}")
+
+
 def _describe_table(db, table_name):
-    table = db._db._get_table(table_name)
+    table = db.snapshot()._get_table(table_name)
     columns = table.rowtype.columns
     _tabulate(
         rows=[(column, '?', '', '', '') for column in columns],
@@ -1073,24 +7274,57 @@ def _describe_table(db, table_name):
     )
 
 
-def _describe_relations(db):
+def _describe_relations(db, verbose=False):
     relations = [
-        (table.schema, table.relname, 'table', '')
-        for schema in db._db.schemas.values()
+        (table, 'table' if table.view is None else 'materialized view')
+        for schema in db.snapshot().schemas.values()
         for table in schema.tables.values()
+    ] + [
+        (sequence, 'sequence')
+        for schema in db.snapshot().schemas.values()
+        for sequence in schema.sequences.values()
     ]
     if not relations:
         print("Did not find any relations.")
         return
+    headers = ['Schema', 'Name', 'Type', 'Owner']
+    rows = [(relation.schema, relation.relname, kind, '') for relation, kind in relations]
+    if verbose:
+        headers.append('Size')
+        rows = [
+            (*row, pg_size_pretty(relation.total_relation_size()))
+            for row, (relation, _) in zip(rows, relations)
+        ]
+    _tabulate(rows=rows, headers=headers, title='List of relations')
+
+
+def _describe_statement_stats(db, limit):
+    stats = db.statement_stats
+    if stats is None:
+        print("Statement statistics are off.")
+        return
     _tabulate(
-        rows=relations,
-        headers=['Schema', 'Name', 'Type', 'Owner'],
-        title='List of relations',
+        rows=[
+            (
+                stat.query,
+                stat.calls,
+                round(stat.total_time * 1000, 3),
+                round(stat.mean_time * 1000, 3),
+                round(stat.max_time * 1000, 3),
+                stat.rows,
+                round(stat.parse_time * 1000, 3),
+                round(stat.plan_time * 1000, 3),
+                round(stat.exec_time * 1000, 3),
+            )
+            for stat in stats.statements()[:limit]
+        ],
+        headers=['Query', 'Calls', 'Total ms', 'Mean ms', 'Max ms', 'Rows', 'Parse ms', 'Plan ms', 'Exec ms'],
+        title='Statement statistics',
     )
 
 
 def _describe_schemas(db):
-    schemas = [(name, '') for name in db._db.schemas]
+    schemas = [(name, '') for name in db.snapshot().schemas]
     _tabulate(
         rows=schemas,
         headers=['Name', 'Owner'],
@@ -1120,12 +7354,33 @@ def run_command(command):
         _print_result(result)
 
 
+def _host_port(value):
+    host, sep, port = value.rpartition(':')
+    if not sep or not port.isdigit():
+        raise argparse.ArgumentTypeError(f"expected host:port, got {value!r}")
+    return host or 'localhost', int(port)
+
+
 def pystgresql_cmdline():
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--command", nargs='?')
+    parser.add_argument(
+        "--listen",
+        type=_host_port,
+        metavar="HOST:PORT",
+        help="serve the postgres wire protocol instead of starting a repl",
+    )
 
     args = parser.parse_args()
-    if args.command is not None:
+    if args.listen is not None:
+        import asyncio
+        import server
+
+        try:
+            asyncio.run(server.Server().serve_forever(*args.listen))
+        except KeyboardInterrupt:
+            pass
+    elif args.command is not None:
         run_command(args.command)
     else:
         repl()
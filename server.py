@@ -0,0 +1,743 @@
+"""
+PostgreSQL v3 frontend/backend protocol server, on asyncio.
+
+Every client connection gets its own session on one MockDatabase, so
+unmodified postgres clients can talk to pystgres. Statements run in an
+executor, so a slow one only holds up its own connection.
+"""
+import asyncio
+import decimal
+import functools
+import io
+import itertools
+import secrets
+import struct
+
+import psqlparse
+
+import exc
+import pystgres
+
+PROTOCOL_VERSION = 196608  # 3.0
+SSL_REQUEST_CODE = 80877103
+GSSENC_REQUEST_CODE = 80877104
+CANCEL_REQUEST_CODE = 80877102
+
+# Settings reported to the client with ParameterStatus, at startup and whenever they change.
+REPORTED_SETTINGS = [
+    'server_version',
+    'server_encoding',
+    'client_encoding',
+    'application_name',
+    'is_superuser',
+    'DateStyle',
+    'IntervalStyle',
+    'TimeZone',
+    'integer_datetimes',
+    'standard_conforming_strings',
+]
+# Startup packet fields that aren't settings.
+STARTUP_FIELDS = {'user', 'database', 'options', 'replication'}
+
+# Transaction status indicators for ReadyForQuery.
+IDLE = b'I'
+IN_TRANSACTION = b'T'
+FAILED_TRANSACTION = b'E'
+
+
+class _NumericBinary:
+    """
+    The binary format of numeric, like a struct.Struct: a header of ndigits,
+    weight, sign and dscale, then base-10000 digits from the most significant.
+    """
+    _header = struct.Struct('!hhHH')
+    _POSITIVE = 0x0000
+    _NEGATIVE = 0x4000
+    _NAN = 0xC000
+    _INFINITY = 0xD000
+    _NEGATIVE_INFINITY = 0xF000
+    # {sign: value} of the values with no digits.
+    _SPECIAL = {
+        _NAN: decimal.Decimal('NaN'),
+        _INFINITY: decimal.Decimal('Infinity'),
+        _NEGATIVE_INFINITY: decimal.Decimal('-Infinity'),
+    }
+
+    @classmethod
+    def pack(cls, value):
+        value = decimal.Decimal(str(value))
+        if value.is_nan():
+            return cls._header.pack(0, 0, cls._NAN, 0)
+        if value.is_infinite():
+            return cls._header.pack(0, 0, cls._NEGATIVE_INFINITY if value < 0 else cls._INFINITY, 0)
+        sign, digits, exponent = value.as_tuple()
+        digits = ''.join(map(str, digits))
+        if exponent >= 0:
+            whole, fraction = digits + '0' * exponent, ''
+        else:
+            whole, fraction = digits[:exponent], digits[exponent:].rjust(-exponent, '0')
+        whole = whole.lstrip('0')
+        whole = whole.rjust(-(-len(whole) // 4) * 4, '0')
+        fraction = fraction.ljust(-(-len(fraction) // 4) * 4, '0')
+        groups = [int(whole[index:index + 4]) for index in range(0, len(whole), 4)]
+        weight = len(groups) - 1
+        groups += [int(fraction[index:index + 4]) for index in range(0, len(fraction), 4)]
+        while groups and not groups[0]:
+            del groups[0]
+            weight -= 1
+        while groups and not groups[-1]:
+            del groups[-1]
+        if not groups:
+            sign = weight = 0
+        return cls._header.pack(
+            len(groups), weight, cls._NEGATIVE if sign else cls._POSITIVE, max(-exponent, 0),
+        ) + struct.pack(f'!{len(groups)}H', *groups)
+
+    @classmethod
+    def unpack(cls, data):
+        ndigits, weight, sign, dscale = cls._header.unpack_from(data)
+        if sign in cls._SPECIAL:
+            return (cls._SPECIAL[sign],)
+        if sign not in (cls._POSITIVE, cls._NEGATIVE):
+            raise ValueError('invalid sign in external "numeric" value')
+        groups = struct.unpack_from(f'!{ndigits}H', data, cls._header.size)
+        number = int(''.join(f'{group:04}' for group in groups) or '0')
+        # The digits stand for number * 10000 ** (weight + 1 - ndigits): rescale them to dscale places.
+        shift = (weight + 1 - ndigits) * 4 + dscale
+        number = number * 10 ** shift if shift >= 0 else number // 10 ** -shift
+        value = decimal.Decimal((sign == cls._NEGATIVE, tuple(map(int, str(number))), -dscale))
+        return (value,)
+
+
+class PgWireType:
+    """
+    How one postgres type is described and encoded on the wire.
+
+    `binary_format` is a struct format for the type's binary representation,
+    or an object with struct.Struct's pack and unpack for one that isn't fixed.
+    None means it's the same as the text representation, as for string types.
+    """
+    def __init__(self, oid, size, binary_format, *, decode_text):
+        self.oid = oid
+        self.size = size
+        if isinstance(binary_format, str):
+            binary_format = struct.Struct(binary_format)
+        self._struct = binary_format
+        self._decode_text = decode_text
+
+    def encode(self, value, binary):
+        if not binary or self._struct is None:
+            # Binary and text representations of string types are the same.
+            return pystgres._copy_output_text(value).encode()
+        return self._struct.pack(value)
+
+    def decode(self, data, binary):
+        if not binary:
+            return self._decode_text(data.decode())
+        if self._struct is None:
+            return data.decode()
+        value, = self._struct.unpack(data)
+        return value
+
+
+TEXT = PgWireType(25, -1, None, decode_text=str)
+WIRE_TYPES = {
+    wire_type.oid: wire_type
+    for wire_type in [
+        PgWireType(16, 1, '?', decode_text=pystgres.PG_CATALOG.types['bool'].converter),
+        PgWireType(20, 8, '!q', decode_text=int),
+        PgWireType(21, 2, '!h', decode_text=int),
+        PgWireType(23, 4, '!i', decode_text=int),
+        TEXT,
+        PgWireType(700, 4, '!f', decode_text=float),
+        PgWireType(701, 8, '!d', decode_text=float),
+        PgWireType(1043, -1, None, decode_text=str),
+        PgWireType(1700, -1, _NumericBinary, decode_text=decimal.Decimal),
+    ]
+}
+# Parameters the client leaves untyped, that the statement doesn't imply a type
+# for either, are passed through as strings.
+UNKNOWN = PgWireType(705, -2, None, decode_text=str)
+
+WIRE_TYPES_BY_NAME = {
+    'boolean': WIRE_TYPES[16],
+    'bigint': WIRE_TYPES[20],
+    'smallint': WIRE_TYPES[21],
+    'integer': WIRE_TYPES[23],
+    'text': TEXT,
+    'real': WIRE_TYPES[700],
+    'double precision': WIRE_TYPES[701],
+    'character varying': WIRE_TYPES[1043],
+    'numeric': WIRE_TYPES[1700],
+}
+
+
+def _wire_type_for(value):
+    """
+    Guess the wire type for a result column from one of its values.
+    """
+    if isinstance(value, bool):
+        return WIRE_TYPES[16]
+    if isinstance(value, int):
+        return WIRE_TYPES[20]
+    if isinstance(value, float):
+        return WIRE_TYPES[701]
+    if isinstance(value, decimal.Decimal):
+        return WIRE_TYPES[1700]
+    return TEXT
+
+
+def _known_wire_type(pgtype, default=None):
+    if pgtype is None:
+        return default
+    return WIRE_TYPES_BY_NAME.get(pgtype.name, default)
+
+
+def _row_wire_types(result):
+    types = []
+    row_types = result.row_types or [None] * len(result.row_names)
+    for column, pgtype in enumerate(row_types):
+        wire_type = _known_wire_type(pgtype)
+        if wire_type is not None:
+            types.append(wire_type)
+            continue
+        value = next(
+            (row[column] for row in result.rows if row[column] is not None),
+            None,
+        )
+        types.append(_wire_type_for(value))
+    return types
+
+
+class _MessageBody:
+    """
+    Cursor for unpacking a message's fields.
+    """
+    def __init__(self, data):
+        self._data = data
+        self._offset = 0
+
+    def _unpack(self, fmt):
+        values = struct.unpack_from(fmt, self._data, self._offset)
+        self._offset += struct.calcsize(fmt)
+        return values
+
+    def int16(self):
+        value, = self._unpack('!h')
+        return value
+
+    def int32(self):
+        value, = self._unpack('!i')
+        return value
+
+    def cstring(self):
+        end = self._data.index(b'\0', self._offset)
+        value = self._data[self._offset:end].decode()
+        self._offset = end + 1
+        return value
+
+    def bytes(self, length):
+        value = self._data[self._offset:self._offset + length]
+        self._offset += length
+        return value
+
+
+def _cstring(value):
+    return value.encode() + b'\0'
+
+
+class _Statement:
+    def __init__(self, prepared, param_oids):
+        self.prepared = prepared
+        self.param_oids = param_oids
+        # Result types, once a Describe has told them to the client.
+        self.wire_types = None
+        self._description = None
+
+    def describe(self):
+        if self._description is None:
+            if self.prepared is None:
+                self._description = pystgres.StatementDescription(param_types=())
+            else:
+                self._description = self.prepared.describe()
+        return self._description
+
+    def param_wire_type(self, index):
+        """
+        The wire type of parameter `index`: as the client declared it, or as the statement implies.
+        """
+        oid = self.param_oids[index] if index < len(self.param_oids) else 0
+        if oid:
+            return WIRE_TYPES.get(oid, UNKNOWN)
+        param_types = self.describe().param_types
+        return _known_wire_type(param_types[index] if index < len(param_types) else None, UNKNOWN)
+
+    def param_oid(self, index):
+        oid = self.param_oids[index] if index < len(self.param_oids) else 0
+        if oid:
+            return oid
+        wire_type = self.param_wire_type(index)
+        # Parameters nothing implies a type for are text, as postgres resolves them.
+        return TEXT.oid if wire_type is UNKNOWN else wire_type.oid
+
+
+class _Portal:
+    def __init__(self, prepared, params, result_formats, wire_types=None):
+        self.prepared = prepared
+        self.params = params
+        self.result_formats = result_formats
+        self.result = None
+        self.wire_types = wire_types
+        self.pending_rows = None
+
+    def run(self):
+        if self.result is None:
+            self.result = self.prepared.execute(self.params)
+            if isinstance(self.result, pystgres.ResultSet):
+                if self.wire_types is None:
+                    self.wire_types = _row_wire_types(self.result)
+                self.pending_rows = iter(self.result.rows)
+        return self.result
+
+
+class _CopyOutStream:
+    """
+    Writable stream that forwards COPY TO STDOUT output as CopyData messages.
+    """
+    def __init__(self, connection):
+        self._connection = connection
+
+    def write(self, data):
+        if data:
+            self._connection.send(b'd', data.encode())
+
+
+class ClientConnection:
+    """
+    Protocol state for one client.
+    """
+    def __init__(self, server, reader, writer):
+        self._server = server
+        self._reader = reader
+        self._writer = writer
+        self._prepared = {}
+        self._portals = {}
+        self._session = server.db.session()
+        # Setting values the client was last told about.
+        self._reported_settings = {}
+        # After an error in the extended protocol, skip messages until Sync.
+        self._skip_until_sync = False
+        # Messages waiting to be written. Statements running in the executor
+        # add to this, and the event loop writes it out once they're done.
+        self._outgoing = []
+        self._backend_key = None
+
+    @property
+    def _db(self):
+        return self._session
+
+    @property
+    def _status(self):
+        if not self._session.in_transaction:
+            return IDLE
+        if self._session.transaction_failed:
+            return FAILED_TRANSACTION
+        return IN_TRANSACTION
+
+    def send(self, msg_type, payload=b''):
+        self._outgoing.append(msg_type + struct.pack('!i', len(payload) + 4) + payload)
+
+    async def _flush(self):
+        outgoing, self._outgoing = self._outgoing, []
+        self._writer.write(b''.join(outgoing))
+        await self._writer.drain()
+
+    @staticmethod
+    async def _in_executor(fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args))
+
+    def cancel(self):
+        return self._session.cancel()
+
+    async def run(self):
+        try:
+            if not await self._startup():
+                return
+            while True:
+                try:
+                    header = await self._reader.readexactly(5)
+                except asyncio.IncompleteReadError:
+                    break
+                msg_type, length = struct.unpack('!ci', header)
+                body = _MessageBody(await self._reader.readexactly(length - 4))
+                if msg_type == b'X':
+                    break
+                await self._dispatch(msg_type, body)
+                await self._flush()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if self._backend_key is not None:
+                self._server.unregister(self._backend_key)
+            self._writer.close()
+
+    async def _startup(self):
+        while True:
+            length, = struct.unpack('!i', await self._reader.readexactly(4))
+            body = _MessageBody(await self._reader.readexactly(length - 4))
+            code = body.int32()
+            if code in (SSL_REQUEST_CODE, GSSENC_REQUEST_CODE):
+                self._writer.write(b'N')
+                await self._writer.drain()
+                continue
+            if code == CANCEL_REQUEST_CODE:
+                # Sent on a connection of its own, which closes without a reply.
+                self._server.cancel((body.int32(), body.int32()))
+                return False
+            if code != PROTOCOL_VERSION:
+                self._send_error(exc.FeatureNotSupportedError(
+                    f"unsupported frontend protocol {code >> 16}.{code & 0xffff}"
+                ))
+                await self._flush()
+                return False
+            break
+
+        while True:
+            key = body.cstring()
+            if not key:
+                break
+            value = body.cstring()
+            if key not in STARTUP_FIELDS:
+                try:
+                    self._session.set_setting(key, value)
+                except exc.UndefinedObjectError:
+                    pass
+
+        self.send(b'R', struct.pack('!i', 0))  # AuthenticationOk
+        self._report_settings()
+        self._backend_key = self._server.register(self)
+        self.send(b'K', struct.pack('!ii', *self._backend_key))  # BackendKeyData
+        self._ready_for_query()
+        await self._flush()
+        return True
+
+    def _ready_for_query(self):
+        self._report_settings()
+        self.send(b'Z', self._status)
+
+    def _report_settings(self):
+        for name in REPORTED_SETTINGS:
+            value = self._session.get_setting(name)
+            if self._reported_settings.get(name) != value:
+                self._reported_settings[name] = value
+                self.send(b'S', _cstring(name) + _cstring(value))
+
+    async def _dispatch(self, msg_type, body):
+        if msg_type == b'Q':
+            await self._simple_query(body.cstring())
+            return
+        if msg_type == b'S':
+            self._skip_until_sync = False
+            self._portals.pop('', None)
+            self._ready_for_query()
+            return
+        if msg_type == b'H':
+            return
+        if self._skip_until_sync:
+            return
+        handler = {
+            b'P': self._parse_message,
+            b'B': self._bind_message,
+            b'D': self._describe_message,
+            b'E': self._execute_message,
+            b'C': self._close_message,
+        }.get(msg_type)
+        if handler is None:
+            self._send_error(exc.PostgresError(f"unexpected message type {msg_type!r}"))
+            return
+        try:
+            await self._in_executor(handler, body)
+        except Exception as error:  # pylint: disable=broad-except
+            self._fail(error)
+            self._skip_until_sync = True
+
+    # --- Simple query
+
+    async def _simple_query(self, query):
+        try:
+            statements = await self._in_executor(self._db.prepare_all, query)
+        except Exception as error:  # pylint: disable=broad-except
+            self._fail(error)
+            self._ready_for_query()
+            return
+
+        if not statements:
+            self.send(b'I')  # EmptyQueryResponse
+        for prepared in statements:
+            try:
+                if prepared.statement_type == 'CopyStmt':
+                    await self._simple_copy(prepared)
+                else:
+                    await self._in_executor(self._execute_and_send, prepared)
+            except Exception as error:  # pylint: disable=broad-except
+                self._fail(error)
+                break
+        self._ready_for_query()
+
+    def _execute_and_send(self, prepared):
+        self._send_result(prepared.execute(), binary_formats=())
+
+    async def _simple_copy(self, prepared):
+        if prepared.statement.filename is not None:
+            await self._in_executor(self._execute_and_send, prepared)
+        elif prepared.statement.is_from:
+            count = await self._in_executor(prepared.copy, await self._receive_copy_data())
+            self.send(b'C', _cstring(f"COPY {count}"))
+        else:
+            self.send(b'H', struct.pack('!bh', 0, 0))  # CopyOutResponse
+            count = await self._in_executor(prepared.copy, _CopyOutStream(self))
+            self.send(b'c')  # CopyDone
+            self.send(b'C', _cstring(f"COPY {count}"))
+
+    async def _receive_copy_data(self):
+        """
+        Collect the client's CopyData messages into a readable stream.
+        """
+        # XXX: the whole payload is buffered before COPY starts parsing it.
+        self.send(b'G', struct.pack('!bh', 0, 0))  # CopyInResponse
+        await self._flush()
+        buffer = io.StringIO()
+        while True:
+            msg_type, length = struct.unpack('!ci', await self._reader.readexactly(5))
+            data = await self._reader.readexactly(length - 4)
+            if msg_type == b'd':
+                buffer.write(data.decode())
+            elif msg_type == b'c':
+                break
+            elif msg_type == b'f':
+                message = _MessageBody(data).cstring()
+                raise exc.QueryCanceled(f"COPY from stdin failed: {message}")
+        buffer.seek(0)
+        return buffer
+
+    # --- Extended query
+
+    def _parse_message(self, body):
+        name = body.cstring()
+        query = body.cstring()
+        param_oids = [body.int32() for _ in range(body.int16())]
+        statements = self._db.prepare_all(query)
+        if len(statements) > 1:
+            raise exc.PostgresSyntaxError("cannot insert multiple commands into a prepared statement")
+        prepared = statements[0] if statements else None
+        if name and name in self._prepared:
+            raise exc.DuplicatePreparedStatementError(f'prepared statement "{name}" already exists')
+        self._prepared[name] = _Statement(prepared, param_oids)
+        self.send(b'1')  # ParseComplete
+
+    def _bind_message(self, body):
+        portal_name = body.cstring()
+        statement = self._get_prepared(body.cstring())
+        param_formats = [body.int16() for _ in range(body.int16())]
+        params = []
+        for index in range(body.int16()):
+            length = body.int32()
+            if length == -1:
+                params.append(None)
+                continue
+            data = body.bytes(length)
+            binary = _format_for(param_formats, index)
+            params.append(statement.param_wire_type(index).decode(data, binary))
+        result_formats = [body.int16() for _ in range(body.int16())]
+        self._portals[portal_name] = _Portal(
+            statement.prepared,
+            params,
+            result_formats,
+            wire_types=statement.wire_types,
+        )
+        self.send(b'2')  # BindComplete
+
+    def _describe_message(self, body):
+        kind = body.bytes(1)
+        name = body.cstring()
+        if kind == b'S':
+            statement = self._get_prepared(name)
+            description = statement.describe()
+            param_count = max(len(statement.param_oids), len(description.param_types))
+            oids = [statement.param_oid(index) for index in range(param_count)]
+            self.send(b't', struct.pack(f'!h{len(oids)}i', len(oids), *oids))
+            if description.row_names is None:
+                self.send(b'n')  # NoData
+                return
+            statement.wire_types = [_known_wire_type(pgtype, TEXT) for pgtype in description.row_types]
+            self._send_row_description(description.row_names, statement.wire_types, binary_formats=())
+            return
+        portal = self._get_portal(name)
+        if portal.prepared is None or not isinstance(portal.run(), pystgres.ResultSet):
+            self.send(b'n')  # NoData
+            return
+        self._send_row_description(portal.result.row_names, portal.wire_types, portal.result_formats)
+
+    def _execute_message(self, body):
+        portal = self._get_portal(body.cstring())
+        max_rows = body.int32()
+        if portal.prepared is None:
+            self.send(b'I')
+            return
+        result = portal.run()
+        if not isinstance(result, pystgres.ResultSet):
+            self._send_status(result)
+            return
+        rows = portal.pending_rows
+        if max_rows > 0:
+            rows = itertools.islice(rows, max_rows)
+        sent = self._send_data_rows(rows, portal.wire_types, portal.result_formats)
+        if max_rows > 0 and sent == max_rows:
+            self.send(b's')  # PortalSuspended
+        else:
+            self.send(b'C', _cstring(result.tag))
+
+    def _close_message(self, body):
+        kind = body.bytes(1)
+        name = body.cstring()
+        if kind == b'S':
+            self._prepared.pop(name, None)
+        else:
+            self._portals.pop(name, None)
+        self.send(b'3')  # CloseComplete
+
+    def _get_prepared(self, name):
+        if name not in self._prepared:
+            raise exc.InvalidSqlStatementNameError(f'prepared statement "{name}" does not exist')
+        return self._prepared[name]
+
+    def _get_portal(self, name):
+        if name not in self._portals:
+            raise exc.InvalidCursorNameError(f'portal "{name}" does not exist')
+        return self._portals[name]
+
+    # --- Results
+
+    def _send_result(self, result, binary_formats):
+        if isinstance(result, pystgres.ResultSet):
+            portal = _Portal(None, (), binary_formats)
+            portal.result = result
+            portal.wire_types = _row_wire_types(result)
+            self._send_row_description(result.row_names, portal.wire_types, binary_formats)
+            self._send_data_rows(result.rows, portal.wire_types, binary_formats)
+            self.send(b'C', _cstring(result.tag))
+        else:
+            self._send_status(result)
+
+    def _send_status(self, result):
+        tag = result.tag if isinstance(result, pystgres.CommandStatus) else ''
+        self.send(b'C', _cstring(tag))
+
+    def _send_row_description(self, row_names, wire_types, binary_formats):
+        fields = [struct.pack('!h', len(row_names))]
+        for index, (name, wire_type) in enumerate(zip(row_names, wire_types)):
+            fields.append(_cstring(name))
+            fields.append(struct.pack(
+                '!ihihih',
+                0,  # table oid
+                0,  # column number
+                wire_type.oid,
+                wire_type.size,
+                -1,  # type modifier
+                int(_format_for(binary_formats, index)),
+            ))
+        self.send(b'T', b''.join(fields))
+
+    def _send_data_rows(self, rows, wire_types, binary_formats):
+        binary = [_format_for(binary_formats, index) for index in range(len(wire_types))]
+        count = 0
+        for row in rows:
+            fields = [struct.pack('!h', len(row))]
+            for value, wire_type, is_binary in zip(row, wire_types, binary):
+                if value is None:
+                    fields.append(struct.pack('!i', -1))
+                else:
+                    data = wire_type.encode(value, is_binary)
+                    fields.append(struct.pack('!i', len(data)) + data)
+            self.send(b'D', b''.join(fields))
+            count += 1
+        return count
+
+    def _fail(self, error):
+        self._session.abort()
+        self._send_error(error)
+
+    def _send_error(self, error):
+        fields = {
+            b'S': 'ERROR',
+            b'V': 'ERROR',
+            b'C': _error_code(error),
+            b'M': str(error) or type(error).__name__,
+        }
+        if isinstance(error, psqlparse.exceptions.PSqlParseError):
+            fields[b'P'] = str(error.cursorpos)
+        payload = b''.join(key + _cstring(value) for key, value in fields.items())
+        self.send(b'E', payload + b'\0')
+
+
+def _error_code(error):
+    if isinstance(error, exc.PostgresError):
+        return getattr(error, 'error_code', 'XX000')
+    if isinstance(error, psqlparse.exceptions.PSqlParseError):
+        return exc.PostgresSyntaxError.error_code
+    if isinstance(error, NotImplementedError):
+        return exc.FeatureNotSupportedError.error_code
+    return 'XX000'  # internal_error
+
+
+def _format_for(formats, index):
+    """
+    Return whether column `index` uses the binary format.
+
+    Per the protocol, no format codes means all text, and a single code applies to all columns.
+    """
+    if not formats:
+        return False
+    if len(formats) == 1:
+        return formats[0] == 1
+    return formats[index] == 1
+
+
+class Server:
+    """
+    Accepts client connections, each with its own session on one MockDatabase.
+    """
+    def __init__(self, db=None):
+        self.db = pystgres.MockDatabase() if db is None else db
+        self._process_ids = itertools.count(1)
+        # {(process id, secret key): ClientConnection}, for CancelRequests to find.
+        self._connections = {}
+
+    def register(self, connection):
+        """
+        Give a connection the key a CancelRequest has to quote to cancel its statements.
+        """
+        key = (next(self._process_ids), secrets.randbits(31))
+        self._connections[key] = connection
+        return key
+
+    def unregister(self, key):
+        self._connections.pop(key, None)
+
+    def cancel(self, key):
+        connection = self._connections.get(key)
+        return connection is not None and connection.cancel()
+
+    async def _handle_client(self, reader, writer):
+        await ClientConnection(self, reader, writer).run()
+
+    async def start(self, host, port):
+        return await asyncio.start_server(self._handle_client, host, port)
+
+    async def serve_forever(self, host, port):
+        server = await self.start(host, port)
+        sockets = ', '.join(str(sock.getsockname()) for sock in server.sockets)
+        print(f"pystgresql listening on {sockets}")
+        async with server:
+            await server.serve_forever()
+
@@ -0,0 +1,123 @@
+"""
+Execution hooks that record a trace, for chrome://tracing or Perfetto.
+
+    hooks = db.add_hook(tracing.ChromeTraceHooks())
+    db.execute_one("SELECT ...;")
+    hooks.save('trace.json')
+"""
+import json
+import os
+import threading
+import time
+
+import pystgres
+
+
+class ChromeTraceHooks(pystgres.ExecutionHooks):
+    """
+    Record what a MockDatabase does as Trace Event Format complete events.
+
+    Statements, parsing, planning, plan operators and writes each get an event,
+    on a track per thread. An operator's event runs from when it was first
+    asked for a row to when it finished, so it includes the time spent in the
+    operators feeding it, and in whatever consumed its rows.
+    """
+    def __init__(self):
+        self._events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._operators = {}
+        self._pid = os.getpid()
+
+    @property
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    @staticmethod
+    def _now():
+        return time.perf_counter_ns() / 1000
+
+    def _begin(self):
+        self._stack().append(self._now())
+
+    def _end(self, name, category, args=None):
+        self._emit(name, category, self._stack().pop(), args)
+
+    def _emit(self, name, category, start, args):
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': start,
+            'dur': self._now() - start,
+            'pid': self._pid,
+            'tid': threading.get_ident(),
+        }
+        if args:
+            event['args'] = args
+        with self._lock:
+            self._events.append(event)
+
+    def parse_start(self, query):
+        self._begin()
+
+    def parse_end(self, query, statements):
+        self._end('parse', 'parse', {'query': query})
+
+    def statement_start(self, statement, text):
+        self._begin()
+
+    def statement_end(self, statement, text, result, error):
+        args = {'text': text}
+        if error is not None:
+            args['error'] = repr(error)
+        self._end(type(statement).__name__, 'statement', args)
+
+    def plan_start(self):
+        self._begin()
+
+    def plan_end(self):
+        self._end('plan', 'plan')
+
+    def operator_open(self, operator):
+        self._operators[operator] = self._now()
+
+    def operator_close(self, operator, rows):
+        start = self._operators.pop(operator, None)
+        if start is None:
+            return
+        args = {'rows': rows}
+        if operator.detail is not None:
+            args['detail'] = operator.detail
+        self._emit(operator.name, 'operator', start, args)
+
+    def write_start(self, table, operation, rows):
+        self._begin()
+
+    def write_end(self, table, operation, rows):
+        self._end(operation, 'write', {'table': table.relname, 'rows': rows})
+
+    def trace(self):
+        """
+        The trace so far, as a JSON-serializable dict.
+        """
+        return {'traceEvents': self.events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, file):
+        json.dump(self.trace(), file)
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            self.dump(file)
+
+    def clear(self):
+        with self._lock:
+            self._events.clear()